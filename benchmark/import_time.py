@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script imports modules of persepolis_lib in new processes with 'python -X importtime' and reports
+# import time of every module, its slowest imports and modules that must not be imported at import time.
+# Every process runs with an empty home directory, so files that are created by importing are found too.
+# With --check, it exits with status 1 if a module imports requests or urllib3, creates a file
+# or its import time is more than --max-ms milliseconds.
+#
+# example:
+#     python3 -m benchmark.import_time --repeat 5
+#     python3 -m benchmark.import_time --check --max-ms 50
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+cwd = os.path.abspath(__file__)
+run_dir = os.path.dirname(cwd)
+parent_dir = os.path.dirname(run_dir)
+
+default_modules = ['persepolis_lib.useful_tools',
+                   'persepolis_lib.persepolis_lib',
+                   'persepolis_lib.async_download',
+                   'persepolis_lib.download_manager',
+                   'persepolis_lib.process_download']
+
+# these modules are imported when download starts.
+deferred_modules = ['requests', 'urllib3']
+
+
+# this function parses stderr of 'python -X importtime'.
+# It returns a list of (module name, self time, cumulative time, depth). Times are in microseconds.
+def parseImportTime(output):
+    import_list = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+
+        self_time, cumulative_time, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        import_list.append((name.strip(), int(self_time), int(cumulative_time), depth))
+
+    return import_list
+
+
+# this function imports module in a new process and returns (import list, created files).
+def importModule(module):
+    home_dir = tempfile.mkdtemp(prefix='persepolis_import_')
+    environment = dict(os.environ)
+    environment['HOME'] = home_dir
+    environment['USERPROFILE'] = home_dir
+    environment['PYTHONPATH'] = parent_dir + os.pathsep + environment.get('PYTHONPATH', '')
+
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, env=environment)
+
+    created_files = os.listdir(home_dir)
+    shutil.rmtree(home_dir, ignore_errors=True)
+
+    if process.returncode != 0:
+        raise RuntimeError('Importing ' + module + ' failed:\n' + process.stderr[-2000:])
+
+    return parseImportTime(process.stderr), created_files
+
+
+# this function returns import result of module from repeat runs.
+def measureModule(module, repeat):
+    cumulative_times = []
+    for i in range(0, repeat):
+        import_list, created_files = importModule(module)
+        for name, self_time, cumulative_time, depth in import_list:
+            if name == module:
+                cumulative_times.append(cumulative_time)
+                break
+
+    # imports of the last run. importtime writes a module after the modules that it imports,
+    # so imports of module are the lines after the previous top level import.
+    module_index = [name for name, self_time, cumulative_time, depth in import_list].index(module)
+    first_index = module_index
+    while first_index > 0 and import_list[first_index - 1][3] > 0:
+        first_index -= 1
+    imported_modules = import_list[first_index:module_index + 1]
+
+    slowest_imports = sorted((item for item in imported_modules if item[0] != module),
+                             key=lambda item: item[2], reverse=True)[:5]
+
+    return {'module': module,
+            'median_ms': round(statistics.median(cumulative_times) / 1000, 2),
+            'min_ms': round(min(cumulative_times) / 1000, 2),
+            'number_of_imported_modules': len(imported_modules),
+            'slowest_imports': [{'module': name, 'cumulative_ms': round(cumulative_time / 1000, 2)}
+                                for name, self_time, cumulative_time, depth in slowest_imports],
+            'deferred_modules_imported': sorted(name for name, self_time, cumulative_time, depth in imported_modules
+                                                if name in deferred_modules),
+            'created_files': created_files}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='persepolis_lib import time benchmark')
+    parser.add_argument('--modules', default=','.join(default_modules),
+                        help='Modules that are imported. Default is all public modules')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of imports of every module. Default is 5')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit with status 1 if a module imports requests or urllib3, creates a file '
+                        'or is slower than --max-ms')
+    parser.add_argument('--max-ms', type=float, help='Maximum median import time in milliseconds for --check')
+    parser.add_argument('--output', help='Write JSON result in this file. Default is stdout')
+    args = parser.parse_args()
+
+    # bytecode is compiled once, so compiling is not counted in import time.
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(parent_dir, 'persepolis_lib')],
+                   stdout=subprocess.DEVNULL)
+
+    results = []
+    for module in [item.strip() for item in args.modules.split(',') if item.strip()]:
+        result = measureModule(module, max(args.repeat, 1))
+        results.append(result)
+        sys.stderr.write('%s: %s ms %s\n' % (module, result['median_ms'],
+                                             ', '.join(result['deferred_modules_imported'] + result['created_files'])))
+
+    report = {'python': sys.version.split()[0],
+              'platform': sys.platform,
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.check:
+        failed = False
+        for result in results:
+            if result['deferred_modules_imported'] or result['created_files'] or \
+                    (args.max_ms is not None and result['median_ms'] > args.max_ms):
+                sys.stderr.write('import check failed: ' + result['module'] + '\n')
+                failed = True
+
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script downloads files from a local server with different settings and reports
+# throughput, time to first byte, CPU time per GiB, peak memory and copied bytes per received byte in JSON format.
+# Every case runs in a new process, so CPU time and memory of cases are not mixed.
+#
+# example:
+#     python3 -m benchmark.run_benchmark --sizes 64M,256M --threads 1,16,64 --speed-limits 0,10M --output result.json
+#     python3 -m benchmark.run_benchmark --sizes 1G --threads 8 --receive-modes iter_content,readinto
+#     python3 -m benchmark.run_benchmark --sizes 1G --threads 64 --write-modes pwrite,mmap
+#     python3 -m benchmark.run_benchmark --sizes 1G --threads 16 --cache-policies default,dontneed,direct
+#     python3 -m benchmark.run_benchmark --sizes 1G --threads 64 --engines thread,process --processes 4
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+cwd = os.path.abspath(__file__)
+run_dir = os.path.dirname(cwd)
+parent_dir = os.path.dirname(run_dir)
+
+sys.path.insert(0, parent_dir)
+
+from benchmark.server import startServer, verifyFile
+
+# child process prints result after this prefix.
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+
+
+# convert size string to bytes. e.g. 64M, 1G, 1000
+def parseSize(size_str):
+    size_str = size_str.strip().upper()
+    if size_str and size_str[-1] in units:
+        return int(float(size_str[:-1]) * units[size_str[-1]])
+    return int(float(size_str))
+
+
+def parseList(list_str, function):
+    return [function(item) for item in list_str.split(',') if item.strip()]
+
+
+# this function returns number of bytes of file that are in page cache.
+# It uses mincore and returns None if mincore is not available.
+def cachedSize(file_path):
+    try:
+        import ctypes
+        import mmap
+        libc = ctypes.CDLL(None, use_errno=True)
+        mincore = libc.mincore
+    except (OSError, AttributeError):
+        return None
+
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        return 0
+
+    # ACCESS_COPY mapping is writable, so ctypes can get its address. Pages are not copied by mincore.
+    with open(file_path, 'rb') as file:
+        mapping = mmap.mmap(file.fileno(), file_size, access=mmap.ACCESS_COPY)
+
+    number_of_pages = (file_size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    vector = (ctypes.c_ubyte * number_of_pages)()
+    first_byte = ctypes.c_char.from_buffer(mapping)
+    result = mincore(ctypes.c_void_p(ctypes.addressof(first_byte)), ctypes.c_size_t(file_size), vector)
+    del first_byte
+    mapping.close()
+
+    if result != 0:
+        return None
+    return sum(page & 1 for page in vector) * mmap.PAGESIZE
+
+
+# this function returns peak memory of this process in bytes.
+# resource is not available on Windows. There psutil is used if it's installed, else None is returned.
+def peakMemory():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KiB on other systems.
+        if sys.platform == 'darwin':
+            return peak
+        return peak * 1024
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    memory_info = psutil.Process().memory_info()
+    return getattr(memory_info, 'peak_wset', memory_info.rss)
+
+
+# this function downloads a file with case settings in this process and returns the result.
+def runCase(case, port):
+    from persepolis_lib.persepolis_lib import Download
+    from persepolis_lib.async_download import AsyncDownload
+    from persepolis_lib.process_download import ProcessDownload
+
+    download_options = {}
+    if case['engine'] == 'async':
+        download_class = AsyncDownload
+    elif case['engine'] == 'process':
+        download_class = ProcessDownload
+        download_options['number_of_processes'] = case.get('processes')
+    else:
+        download_class = Download
+
+    # BenchmarkDownload saves the time of receiving the first byte and the last byte.
+    # Data is received by worker processes in 'process' engine, so copied bytes are not counted.
+    # It counts received bytes and bytes that are copied after receiving.
+    # A chunk that is not a memoryview of a receive buffer is a new bytes object,
+    # so its bytes are copied at least once after they are received from socket.
+    class BenchmarkDownload(download_class):
+        first_byte_time = None
+        last_byte_time = None
+        received_size = 0
+        copied_size = 0
+
+        def storeData(self, part_number, offset, data, thread_number=None):
+            if not isinstance(data, memoryview):
+                self.copied_size += len(data)
+            return super().storeData(part_number, offset, data, thread_number)
+
+        def addProgress(self, part_number, update_size, size, thread_number=None):
+            if self.first_byte_time is None:
+                self.first_byte_time = time.perf_counter()
+            self.received_size += size
+            super().addProgress(part_number, update_size, size, thread_number)
+            self.last_byte_time = time.perf_counter()
+
+    download_path = tempfile.mkdtemp(prefix='persepolis_benchmark_')
+    add_link_dictionary = {'link': 'http://127.0.0.1:%d/%d/file.bin' % (port, case['size']),
+                           'out': None,
+                           'download_path': download_path,
+                           'ip': None,
+                           'port': None,
+                           'proxy_user': None,
+                           'proxy_passwd': None,
+                           'proxy_type': None,
+                           'download_user': None,
+                           'download_passwd': None,
+                           'header': None,
+                           'user_agent': None,
+                           'load_cookies': None,
+                           'referer': None,
+                           'check_certificate': True}
+
+    download_item = BenchmarkDownload(add_link_dictionary, case['threads'], case['chunk_size'],
+                                      progress_bar=False, threads_progress_bar=False,
+                                      receive_mode=case.get('receive_mode', 'iter_content'),
+                                      write_mode=case.get('write_mode', 'pwrite'),
+                                      cache_policy=case.get('cache_policy', 'default'),
+                                      **download_options)
+    if case['speed_limit']:
+        download_item.limitSpeed(bytes_per_second=case['speed_limit'])
+
+    # CPU time of worker processes is added after they exit.
+    start_cpu_time = time.process_time()
+    start_children_times = os.times()
+    start_time = time.perf_counter()
+    download_item.start()
+    elapsed_time = time.perf_counter() - start_time
+    cpu_time = time.process_time() - start_cpu_time
+    children_times = os.times()
+    cpu_time += (children_times.children_user - start_children_times.children_user) + \
+        (children_times.children_system - start_children_times.children_system)
+
+    file_path = os.path.join(download_path, 'file.bin')
+    result = dict(case)
+    result['status'] = download_item.download_status
+
+    # page cache is measured before verifying, because verifyFile reads the file.
+    if os.path.isfile(file_path):
+        cached_size = cachedSize(file_path)
+        if cached_size is not None:
+            result['cached_mib'] = round(cached_size / 1024**2, 1)
+
+    result['verified'] = os.path.isfile(file_path) and verifyFile(file_path, case['size'])
+    result['seconds'] = round(elapsed_time, 3)
+    result['mb_per_second'] = round(case['size'] / elapsed_time / 10**6, 3)
+    # transfer rate is calculated from the first byte to the last byte,
+    # so preparing and closing download are not counted.
+    if download_item.first_byte_time is not None and download_item.last_byte_time > download_item.first_byte_time:
+        result['time_to_first_byte'] = round(download_item.first_byte_time - start_time, 4)
+        transfer_rate = download_item.downloaded_size / (download_item.last_byte_time - download_item.first_byte_time)
+        result['transfer_mb_per_second'] = round(transfer_rate / 10**6, 3)
+    else:
+        result['time_to_first_byte'] = None
+        transfer_rate = None
+    result['cpu_seconds_per_gib'] = round(cpu_time / (case['size'] / 1024**3), 3)
+    peak_memory = peakMemory()
+    result['peak_rss_mib'] = None if peak_memory is None else round(peak_memory / 1024**2, 1)
+    if download_item.received_size and case['engine'] != 'process':
+        result['copied_bytes_per_received_byte'] = round(download_item.copied_size / download_item.received_size, 3)
+
+    status = download_item.tellStatus()
+    result['new_connections'] = int(status['new_connections'])
+    result['reused_connections'] = int(status['reused_connections'])
+
+    # difference between transfer rate and speed limit
+    if case['speed_limit'] and transfer_rate is not None:
+        result['speed_limit_error_percent'] = round(
+            (transfer_rate - case['speed_limit']) / case['speed_limit'] * 100, 2)
+
+    shutil.rmtree(download_path, ignore_errors=True)
+    return result
+
+
+# this function runs a case in a new process and returns its result.
+def runCaseProcess(case, port):
+    command = [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case), '--port', str(port)]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+
+    result = dict(case)
+    result['status'] = 'benchmark error'
+    result['error'] = process.stderr[-2000:]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='persepolis_lib throughput benchmark')
+    parser.add_argument('--sizes', default='16M,128M', help='File sizes. e.g. 16M,1G. Default is 16M,128M')
+    parser.add_argument('--threads', default='1,8,64', help='Values of number_of_threads. Default is 1,8,64')
+    parser.add_argument('--chunk-sizes', default='100', help='Values of python_request_chunk_size in KiB. Default is 100')
+    parser.add_argument('--speed-limits', default='0',
+                        help='Speed limits in bytes per second. e.g. 0,10M. 0 means no limit. Default is 0')
+    parser.add_argument('--engines', default='thread', help='Download engines. thread, async or process. Default is thread')
+    parser.add_argument('--processes', type=int,
+                        help='number_of_processes of process engine. Default is number of CPUs')
+    parser.add_argument('--receive-modes', default='iter_content',
+                        help='Values of receive_mode. iter_content or readinto. Default is iter_content')
+    parser.add_argument('--write-modes', default='pwrite',
+                        help='Values of write_mode. pwrite, mmap or queue. Default is pwrite')
+    parser.add_argument('--cache-policies', default='default',
+                        help='Values of cache_policy. default, dontneed or direct. Default is default')
+    parser.add_argument('--bandwidth', default='0',
+                        help='Bandwidth of every server connection in bytes per second. e.g. 5M. Default is 0 (no limit)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Server delay before every response in seconds. Default is 0')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of runs for every case. Default is 1')
+    parser.add_argument('--output', help='Write JSON result in this file. Default is stdout')
+
+    # these arguments are used for running a case in child process.
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        result = runCase(json.loads(args.case), args.port)
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+        return
+
+    server = startServer(bandwidth=parseSize(args.bandwidth), latency=args.latency)
+    port = server.server_address[1]
+
+    results = []
+    matrix = itertools.product(parseList(args.engines, str.strip),
+                               parseList(args.receive_modes, str.strip),
+                               parseList(args.write_modes, str.strip),
+                               parseList(args.cache_policies, str.strip),
+                               parseList(args.sizes, parseSize),
+                               parseList(args.threads, int),
+                               parseList(args.chunk_sizes, int),
+                               parseList(args.speed_limits, parseSize))
+
+    for engine, receive_mode, write_mode, cache_policy, size, threads, chunk_size, speed_limit in matrix:
+        case = {'engine': engine,
+                'receive_mode': receive_mode,
+                'write_mode': write_mode,
+                'cache_policy': cache_policy,
+                'size': size,
+                'threads': threads,
+                'chunk_size': chunk_size,
+                'speed_limit': speed_limit,
+                'server_bandwidth': parseSize(args.bandwidth),
+                'server_latency': args.latency}
+        if engine == 'process':
+            case['processes'] = args.processes
+
+        for i in range(0, args.repeat):
+            result = runCaseProcess(case, port)
+            results.append(result)
+            sys.stderr.write('%s %s %s %s size=%d threads=%d chunk=%dKiB limit=%d: %s MB/s %s\n' % (
+                engine, receive_mode, write_mode, cache_policy, size, threads, chunk_size, speed_limit,
+                result.get('mb_per_second'), result['status']))
+
+    server.shutdown()
+
+    report = {'python': sys.version.split()[0],
+              'platform': sys.platform,
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import http.server
+import random
+import sys
+import threading
+import time
+
+
+# Content of every file is a 1 MiB pseudo random block that is repeated.
+# So files of any size can be served and verified without keeping them in memory.
+BLOCK_SIZE = 1024**2
+BLOCK = random.Random(1234).getrandbits(8 * BLOCK_SIZE).to_bytes(BLOCK_SIZE, 'little')
+
+# size of every write to socket
+WRITE_SIZE = 64 * 1024
+
+
+# this function returns length bytes of file content from offset.
+def fileContent(offset, length):
+    content = bytearray()
+    while length > 0:
+        block_offset = offset % BLOCK_SIZE
+        piece = BLOCK[block_offset:block_offset + length]
+        content += piece
+        offset += len(piece)
+        length -= len(piece)
+    return bytes(content)
+
+
+# this function compares file with the content that server sends.
+def verifyFile(file_path, file_size):
+    offset = 0
+    with open(file_path, 'rb') as downloaded_file:
+        while True:
+            data = downloaded_file.read(BLOCK_SIZE)
+            if not data:
+                break
+            if data != fileContent(offset, len(data)):
+                return False
+            offset += len(data)
+    return offset == file_size
+
+
+# BenchmarkRequestHandler serves files for benchmark.
+# Path of link is /<file size in bytes>/<file name>. e.g. /1048576/file.bin
+# It supports HEAD, GET, single Range requests, ETag, Accept-Ranges and keep-alive connections.
+# bandwidth limits every connection in bytes per second. 0 means no limit.
+# latency is the delay in seconds before sending response of every request.
+class BenchmarkRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    bandwidth = 0
+    latency = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.sendFile(send_body=False)
+
+    def do_GET(self):
+        self.sendFile(send_body=True)
+
+    # this method returns length bytes of file from offset.
+    def fileData(self, offset, length):
+        return fileContent(offset, length)
+
+    # this method returns file size from path or None.
+    def fileSize(self):
+        try:
+            return int(self.path.split('/')[1])
+        except (IndexError, ValueError):
+            return None
+
+    # this method returns (start, end) of requested range. end is not part of range.
+    # It returns None if Range header is not valid.
+    def requestedRange(self, file_size):
+        range_header = self.headers.get('Range')
+        if range_header is None:
+            return 0, file_size
+
+        try:
+            unit, byte_range = range_header.split('=', 1)
+            start, end = byte_range.split('-', 1)
+            if unit.strip() != 'bytes' or ',' in byte_range:
+                return None
+            if start == '':
+                # suffix range. e.g. bytes=-500
+                start = max(file_size - int(end), 0)
+                end = file_size
+            else:
+                start = int(start)
+                end = file_size if end == '' else min(int(end) + 1, file_size)
+        except ValueError:
+            return None
+
+        if start >= end:
+            return None
+        return start, end
+
+    def sendFile(self, send_body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        file_size = self.fileSize()
+        if file_size is None:
+            self.send_error(404)
+            return
+
+        requested_range = self.requestedRange(file_size)
+        if requested_range is None:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % file_size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = requested_range
+        if self.headers.get('Range') is None:
+            self.send_response(200)
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, file_size))
+
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"benchmark-%d"' % file_size)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        begin_time = time.monotonic()
+        offset = start
+        try:
+            while offset < end:
+                length = min(WRITE_SIZE, end - offset)
+                self.wfile.write(self.fileData(offset, length))
+                offset += length
+
+                # wait until the sent data matches bandwidth.
+                if self.bandwidth:
+                    delay = (offset - start) / self.bandwidth - (time.monotonic() - begin_time)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (ConnectionError, OSError):
+            # client closed connection. e.g. part was splitted or download was stopped.
+            self.close_connection = True
+
+
+class BenchmarkServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    # clients close connections when parts are splitted or download is stopped.
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+
+# this function starts server in a thread and returns it.
+# port 0 means a free port. server.server_address[1] is the port.
+def startServer(port=0, bandwidth=0, latency=0):
+    handler = type('BenchmarkRequestHandler', (BenchmarkRequestHandler,),
+                   {'bandwidth': bandwidth, 'latency': latency})
+    server = BenchmarkServer(('127.0.0.1', port), handler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP server for persepolis_lib benchmark')
+    parser.add_argument('--port', type=int, default=8000, help='Server port. Default is 8000')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='Bandwidth of every connection in bytes per second. Default is 0 (no limit)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay before every response in seconds. Default is 0')
+    args = parser.parse_args()
+
+    server = startServer(args.port, args.bandwidth, args.latency)
+    print('Serving on http://127.0.0.1:%d/<file size>/file.bin' % server.server_address[1], flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,752 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import ssl
+import threading
+import time
+import urllib.parse
+from persepolis_lib.persepolis_lib import Download
+from persepolis_lib.useful_tools import sendToLog, convertHeaderToDictionary, readCookieJar
+from persepolis_lib.part_table import PartStatus
+from persepolis_lib.async_http import AsyncHTTPConnection, AsyncConnectionGate
+from persepolis_lib.mirror_list import MirrorList
+
+
+# AsyncDownload downloads parts with coroutines instead of threads.
+# Every download connection is an asyncio task, so hundreds of downloads
+# can run in one event loop with a few threads.
+# It uses the same control file and part_table as Download class.
+# So a download that is started by Download can be resumed by AsyncDownload and vice versa.
+# HTTP requests are sent by async_http module. proxies are not supported.
+# Received data is written and hashed by writer threads. So a slow disk or a full write queue
+# of QueuedOutputSink doesn't block event loop. Received chunks are written in batches,
+# so data doesn't pass to a writer thread for every chunk.
+#
+# usage:
+#     download_session = AsyncDownload(add_link_dictionary, number_of_threads=64)
+#     await download_session.run()
+# or start() for running it in a new event loop.
+class AsyncDownload(Download):
+    # These status codes are retried like Download.setRetry
+    retry_status_list = [429, 500, 502, 503, 504]
+
+    # redirect status codes
+    redirect_status_list = [301, 302, 303, 307, 308]
+    max_redirects = 30
+
+    # maximum number of writer threads. see runInWriter
+    writer_threads = 4
+
+    # received chunks of a part are written together when they reach write_batch_size bytes
+    # or write_batch_interval seconds passed after the last write. see downloadPart
+    write_batch_size = 1024**2
+    write_batch_interval = 0.2
+
+    # event loop of run(). It's None if download is not running.
+    loop = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # request headers that are sent with every request. see createSession
+        self.session_headers = {}
+        self.cookie_jar = None
+        self.ssl_context = None
+
+        # part_condition is notified when a part is completed or released.
+        # It's created in run(), because it must be created in the running event loop.
+        self.part_condition = None
+
+        # connections of GET probe. Response of GET probe is read by the task that downloads part 0,
+        # so its connection is given to that task. see takeProbeResponse
+        self.probe_connection_dict = {}
+
+        # connections that are opened while download file is created.
+        # Every download task takes one of them. see warmUpConnectionsAsync
+        self.warm_connection_list = []
+
+        # writer threads of storeData and completePart. It's created in run(). see runInWriter
+        self.write_executor = None
+
+    # this coroutine runs function in a writer thread and returns its result.
+    async def runInWriter(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.write_executor, function, *args)
+
+    # this coroutine writes received chunks of part at offset and returns number of written bytes.
+    async def writeChunks(self, part_number, offset, chunk_list, task_number):
+        if len(chunk_list) == 1:
+            data = chunk_list[0]
+        else:
+            data = b''.join(chunk_list)
+        return await self.runInWriter(self.storeData, part_number, offset, data, task_number)
+
+    # download status may be changed from another thread. e.g. by stop()
+    # So tasks that wait for part_condition are notified in event loop.
+    def wakeUpWaiters(self):
+        super().wakeUpWaiters()
+
+        loop = self.loop
+        if loop is None or self.part_condition is None:
+            return
+
+        try:
+            loop.call_soon_threadsafe(self.notifyTasks)
+        except RuntimeError:
+            # event loop is closed.
+            pass
+
+    def notifyTasks(self):
+        asyncio.ensure_future(self.notifyPartCondition())
+
+    # wake up tasks that are waiting for new part.
+    async def notifyPartCondition(self):
+        async with self.part_condition:
+            self.part_condition.notify_all()
+
+    # create ssl context, cookie jar and default headers
+    def createSession(self):
+        from persepolis_lib.http_adapter import ConnectionStatistics
+
+        self.connection_statistics = ConnectionStatistics()
+
+        # New connections are opened through connection_gate and host is resolved once.
+        self.connection_gate = AsyncConnectionGate(self.connect_concurrency, self.connect_rate)
+
+        self.ssl_context = ssl.create_default_context()
+        if not self.check_certificate:
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+
+        # set cookies
+        if self.load_cookies:
+            self.cookie_jar = readCookieJar(self.load_cookies)
+
+        if not self.user_agent:
+            self.user_agent = 'Persepolis lib/' + self.version
+
+        # data is written to the file as it's received. So don't ask server for compressed data.
+        self.session_headers = {'User-Agent': self.user_agent,
+                                'Accept': '*/*',
+                                'Accept-Encoding': 'identity',
+                                'Connection': 'keep-alive'}
+
+        # set referer
+        if self.referer:
+            self.session_headers['Referer'] = self.referer
+
+        if self.header is not None:
+            # convert header to dictionary
+            self.session_headers.update(convertHeaderToDictionary(self.header))
+
+    # this method sends request and follows redirects.
+    # connection_dict contains connections of the caller. Keys are (scheme, host, port).
+    # So every coroutine reuses its own keep-alive connections.
+    async def sendRequest(self, method, link, connection_dict, headers={}):
+        for i in range(0, self.max_redirects + 1):
+            parsed_link = urllib.parse.urlsplit(link)
+            connection_key = self.connectionKey(link)
+            if connection_key not in connection_dict:
+                connection_dict[connection_key] = self.newConnection(connection_key)
+            connection = connection_dict[connection_key]
+
+            target = parsed_link.path or '/'
+            if parsed_link.query:
+                target = target + '?' + parsed_link.query
+
+            request_headers = {'Host': parsed_link.netloc.rsplit('@', 1)[-1]}
+            request_headers.update(self.session_headers)
+            request_headers.update(headers)
+
+            # add cookies
+            if self.cookie_jar is not None:
+                from urllib.request import Request
+                cookie_request = Request(link, headers=request_headers, method=method)
+                self.cookie_jar.add_cookie_header(cookie_request)
+                cookie = cookie_request.get_header('Cookie')
+                if cookie:
+                    request_headers['Cookie'] = cookie
+
+            try:
+                response, new_connection = await connection.request(method, target, request_headers)
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                self.connection_statistics.addFailure()
+                raise
+            self.connection_statistics.add(new_connection)
+            self.connection_statistics.addResponse(response.status)
+
+            # save cookies of response
+            if self.cookie_jar is not None:
+                self.cookie_jar.extract_cookies(response, cookie_request)
+
+            if response.status in self.redirect_status_list and response.headers.get('Location'):
+                response.close()
+                link = urllib.parse.urljoin(link, response.headers.get('Location'))
+                if response.status == 303 and method != 'HEAD':
+                    method = 'GET'
+                continue
+
+            # final link of the request after redirects
+            response.url = link
+            return response
+
+        raise ConnectionError('Too many redirects')
+
+    # this method returns (scheme, host, port) of link.
+    def connectionKey(self, link):
+        parsed_link = urllib.parse.urlsplit(link)
+        scheme = parsed_link.scheme.lower()
+        if scheme not in ['http', 'https']:
+            raise ValueError('Unsupported scheme: ' + scheme)
+
+        if parsed_link.port:
+            port = parsed_link.port
+        elif scheme == 'https':
+            port = 443
+        else:
+            port = 80
+
+        return (scheme, parsed_link.hostname, port)
+
+    # this method creates a connection that is not connected yet.
+    def newConnection(self, connection_key):
+        scheme, host, port = connection_key
+        return AsyncHTTPConnection(scheme, host, port, self.timeout, self.ssl_context,
+                                   read_limit=max(2 * 1024 * self.python_request_chunk_size, 65536),
+                                   connection_gate=self.connection_gate)
+
+    # this coroutine does the same work as Download.warmUpConnections.
+    # Connections are opened in parallel and download tasks take them. see downloadTask
+    async def warmUpConnectionsAsync(self):
+        if self.warm_up_link is None:
+            return
+
+        # connection of GET probe is given to the task that downloads part 0. see warmUpCount
+        count = self.warmUpCount()
+        connection_key = self.connectionKey(self.warm_up_link)
+        connection_list = [self.newConnection(connection_key) for i in range(0, count)]
+        result_list = await asyncio.gather(*[connection.connect() for connection in connection_list],
+                                           return_exceptions=True)
+
+        for connection, result in zip(connection_list, result_list):
+            if result is None:
+                connection.warm_connection = True
+                self.warm_connection_list.append((connection_key, connection))
+            else:
+                connection.close()
+                sendToLog('Connection warm-up error: ' + str(result), 'ERROR')
+
+    # close connections that are not taken by download tasks.
+    def closeWarmConnections(self):
+        for connection_key, connection in self.warm_connection_list:
+            connection.close()
+        self.warm_connection_list = []
+
+    # this method sends request and retries it, if connection failed or
+    # server returned one of retry_status_list codes.
+    # waiting time between retries is like backoff_factor in Download.setRetry.
+    async def sendRequestWithRetry(self, method, link, connection_dict, headers={}):
+        for i in range(0, self.retry + 1):
+            try:
+                response = await self.sendRequest(method, link, connection_dict, headers)
+                if response.status not in self.retry_status_list or i == self.retry:
+                    return response
+                response.close()
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                if i == self.retry:
+                    raise
+
+            if self.download_status == 'stopped':
+                raise ConnectionError('Download stopped')
+
+            await asyncio.sleep(min(self.retry_wait * (2 ** i), 120))
+
+    # get file size and headers.
+    # It returns empty dictionary if link is invalid.
+    # If download has some mirrors, the next mirror is tried.
+    async def requestFileHeader(self):
+        from requests.structures import CaseInsensitiveDict
+
+        for link in self.mirror_links:
+            self.link = link
+            error_message = None
+            error_message2 = None
+            connection_dict = {}
+            self.file_header = {}
+
+            # response of the previous mirror is not used.
+            self.closeProbeResponse()
+            try:
+                if self.probe == 'get':
+                    response = await self.sendRequestWithRetry('GET', self.link, connection_dict, {'Range': 'bytes=0-'})
+                else:
+                    response = await self.sendRequestWithRetry('HEAD', self.link, connection_dict)
+                    response.close()
+
+                if response.status >= 400:
+                    response.close()
+                    raise ConnectionError(str(response.status) + ' ' + response.reason)
+
+                if self.probe == 'get':
+                    self.probe_response = response
+                    self.probe_status = response.status
+                    self.probe_connection_dict = connection_dict
+                    connection_dict = {}
+
+                self.file_header = CaseInsensitiveDict(response.headers.items())
+                self.warm_up_link = response.url
+
+                # find file size
+                # file without size is downloaded by one connection. So it's not an error.
+                self.file_size = self.headerFileSize(self.file_header)
+                if self.file_size is None:
+                    sendToLog('File size is not available. File is downloaded by one connection.', 'DEBUG')
+            except ConnectionError as error:
+                error_message = 'Connection error'
+                error_message2 = str(error)
+            except asyncio.TimeoutError as error:
+                error_message = 'Timeout error'
+                error_message2 = str(error)
+            except Exception as error:
+                error_message = 'Error'
+                error_message2 = str(error)
+
+            for connection in connection_dict.values():
+                connection.close()
+
+            if error_message:
+                error = error_message + ' - ' + error_message2
+                sendToLog(error, 'ERROR')
+                self.observers.notify('on_error', error)
+                self.file_size = None
+            else:
+                break
+
+        return self.file_header
+
+    # this coroutine does the same work as Download.checkMirrors.
+    # Mirrors are checked without retrying, so unavailable mirrors don't delay download.
+    async def checkMirrorsAsync(self):
+        from requests.structures import CaseInsensitiveDict
+
+        link_list = [self.link]
+        for link in self.mirror_links[self.mirror_links.index(self.link) + 1:]:
+            connection_dict = {}
+            try:
+                if self.probe == 'get':
+                    response = await self.sendRequest('GET', link, connection_dict, {'Range': 'bytes=0-0'})
+                else:
+                    response = await self.sendRequest('HEAD', link, connection_dict)
+                response.close()
+                if response.status >= 400:
+                    raise ConnectionError(str(response.status) + ' ' + response.reason)
+
+                if self.mirrorMatches(link, CaseInsensitiveDict(response.headers.items())):
+                    link_list.append(link)
+            except Exception as error:
+                sendToLog('Mirror error: ' + link + ' - ' + str(error), 'ERROR')
+
+            for connection in connection_dict.values():
+                connection.close()
+
+        self.mirror_list = MirrorList(link_list)
+        if len(link_list) > 1:
+            sendToLog(str(len(link_list)) + ' mirrors are used.')
+
+        return self.checkMetalinkSize()
+
+    # close response of GET probe and its connections, if it's not used.
+    def closeProbeResponse(self):
+        super().closeProbeResponse()
+
+        for connection in self.probe_connection_dict.values():
+            connection.close()
+        self.probe_connection_dict = {}
+
+    # this coroutine waits for a part and returns its number.
+    # It returns None if no part remains for downloading.
+    async def claimPart(self):
+        async with self.part_condition:
+            while self.download_status in ['downloading', 'paused']:
+                part_number = self.part_scheduler.claim(block=False)
+
+                # nothing is pending and nothing can fail and return to heap.
+                if part_number is not None or not self.part_scheduler.hasDownloadingParts():
+                    return part_number
+
+                # wait until a part is released or completed or download status is changed.
+                # see wakeUpWaiters
+                await self.part_condition.wait()
+
+            return None
+
+    # this coroutine downloads one part. It's like threadHandler in Download class.
+    async def downloadPart(self, part_number, task_number, connection_dict):
+        is_break = False
+        download_finished_successfully = False
+        response = None
+        first_read_reserved = False
+        self.takePart(part_number, task_number)
+
+        # the other task of a hedged part may finish the part before this task starts.
+        if self.part_table.end[part_number] != -1 and self.part_table.remaining(part_number) == 0:
+            await self.runInWriter(self.completePart, part_number)
+            self.leavePart(part_number, task_number)
+            return
+
+        # response of GET probe is used for the part that starts from the first byte.
+        # It's received from the main link and its connection is kept by this task.
+        probe_response = self.takeProbeResponse(self.part_table.start[part_number] + self.part_table.downloaded[part_number])
+        if probe_response is not None:
+            for connection_key, connection in self.probe_connection_dict.items():
+                if connection_key in connection_dict:
+                    connection_dict[connection_key].close()
+                connection_dict[connection_key] = connection
+            self.probe_connection_dict = {}
+
+        # choose a mirror for this part. see mirror_list.py
+        if probe_response is not None:
+            mirror = self.mirror_list.choose(self.link)
+        else:
+            mirror = self.mirror_list.choose()
+
+        try:
+            downloaded_part = self.part_table.downloaded[part_number]
+
+            # download from begining!
+            if self.resuming_suppurt is False:
+                self.downloaded_size = self.downloaded_size - downloaded_part
+                self.part_table.downloaded[part_number] = 0
+                downloaded_part = 0
+
+            start = self.part_table.start[part_number] + downloaded_part
+            end = self.part_table.end[part_number]
+
+            # specify the start and end of the part for request header.
+            # end byte number of the part is not part of it.
+            if not self.resuming_suppurt:
+                chunk_headers = {}
+            elif end == -1:
+                chunk_headers = {'Range': 'bytes=%d-' % (start)}
+            else:
+                chunk_headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+
+            if probe_response is not None:
+                response = probe_response
+            else:
+                response = await self.sendRequestWithRetry('GET', mirror.link, connection_dict, chunk_headers)
+
+            # server must send the requested range.
+            if not (response.status == 206 or (response.status == 200 and start == 0)):
+                raise ConnectionError('HTTP error - ' + str(response.status) + ' ' + response.reason)
+
+            # wait for tokens of the first read. see reserveFirstRead
+            first_read_reserved = True
+            speed_limit_delay = self.reserveFirstRead(task_number)
+            if speed_limit_delay:
+                await asyncio.sleep(speed_limit_delay)
+
+            # data is written to the file at offset by output_sink.
+            # chunk_list contains received chunks that are not written yet.
+            offset = start
+            chunk_list = []
+            chunk_list_size = 0
+            last_write_time = time.monotonic()
+            python_request_chunk_size = self.readChunkSize()
+            while True:
+                data = await response.read(python_request_chunk_size)
+
+                if not data:
+                    download_finished_successfully = True
+                    break
+
+                if self.download_status not in ['downloading', 'paused']:
+                    is_break = True
+                    break
+
+                chunk_list.append(data)
+                chunk_list_size += len(data)
+
+                # perhaps user set limitation for download rate.
+                speed_limit_delay = self.speedLimitDelay(len(data), task_number)
+
+                # write the chunks if they reach the end of part or task waits for speed limit or unpausing.
+                # Else write them in batches.
+                part_end = self.part_table.end[part_number]
+                if (part_end != -1 and offset + chunk_list_size >= part_end) or \
+                        speed_limit_delay or self.download_status == 'paused' or \
+                        chunk_list_size >= self.write_batch_size or \
+                        time.monotonic() - last_write_time >= self.write_batch_interval:
+                    # write data and update downloaded size of this part.
+                    written = await self.writeChunks(part_number, offset, chunk_list, task_number)
+                    offset += written
+                    self.mirror_list.addData(mirror, written)
+                    chunk_list = []
+                    chunk_list_size = 0
+                    last_write_time = time.monotonic()
+
+                    # if this part is completed by another task or this task is dropped
+                    # by checkLowestSpeed then exit. The part is given to a task again if it's not complete.
+                    if not self.ownsPart(part_number, task_number):
+                        self.part_table.retry[part_number] -= 1
+                        break
+
+                if speed_limit_delay:
+                    await asyncio.sleep(speed_limit_delay)
+
+                # wait for unpausing. see wakeUpWaiters
+                if self.download_status == 'paused':
+                    async with self.part_condition:
+                        await self.part_condition.wait_for(lambda: self.download_status != 'paused')
+
+                # this part is complete. If the end of part moved backward by splitting,
+                # the rest of the response belongs to another part.
+                if self.part_table.end[part_number] != -1 and self.part_table.remaining(part_number) == 0:
+                    break
+
+            # write the rest of received data.
+            if chunk_list:
+                written = await self.writeChunks(part_number, offset, chunk_list, task_number)
+                self.mirror_list.addData(mirror, written)
+
+        except Exception as e:
+            error_text = ("part_number: " + str(part_number) + " " + str(e))
+            sendToLog(error_text)
+            self.observers.notify('on_error', error_text)
+
+            # connection failed during reading response. Failed requests are counted by sendRequest.
+            if response is not None:
+                self.connection_statistics.addFailure()
+
+            self.mirror_list.addFailure(mirror)
+
+        # If response is read completely, its connection is kept alive for the next part.
+        # Else the connection is closed.
+        if response is not None:
+            response.close()
+
+        if first_read_reserved:
+            self.refundFirstRead(task_number)
+
+        # this task doesn't download the part anymore.
+        self.leavePart(part_number, task_number)
+        self.mirror_list.leave(mirror)
+
+        if self.part_table.end[part_number] == -1:
+            part_is_complete = download_finished_successfully
+            if part_is_complete:
+                self.file_size = self.downloaded_size
+        else:
+            part_is_complete = self.part_table.remaining(part_number) == 0
+
+        if part_is_complete:
+            self.mirror_list.addSuccess(mirror)
+            await self.runInWriter(self.completePart, part_number)
+        elif not (is_break):
+            self.part_scheduler.release(part_number, PartStatus.ERROR)
+        else:
+            self.part_scheduler.release(part_number, PartStatus.STOPPED)
+
+        # wake up tasks that are waiting for new part.
+        async with self.part_condition:
+            self.part_condition.notify_all()
+
+    # every download task runs this coroutine. It's like a download thread in Download class.
+    async def downloadTask(self, task_number):
+        # keep-alive connections of this task
+        connection_dict = {}
+
+        # use a connection that is opened by warmUpConnectionsAsync.
+        if self.warm_connection_list:
+            connection_key, connection = self.warm_connection_list.pop()
+            connection_dict[connection_key] = connection
+
+        try:
+            while self.download_status in ['downloading', 'paused']:
+                # In adaptive mode, tasks that are more than the number of connections wait
+                # until number of connections grows or no part remains for downloading.
+                if task_number >= self.connectionLimit():
+                    if self.part_scheduler.finished_event.is_set():
+                        break
+
+                    async with self.part_condition:
+                        await self.part_condition.wait_for(
+                            lambda: task_number < self.connectionLimit() or self.part_scheduler.finished_event.is_set() or
+                            self.download_status not in ['downloading', 'paused'])
+                    continue
+
+                # ask part_scheduler for a new part.
+                part_number = await self.claimPart()
+
+                # If part_number is None, no part is available for download.
+                if part_number is None:
+                    break
+
+                await self.downloadPart(part_number, task_number, connection_dict)
+        finally:
+            for connection in connection_dict.values():
+                connection.close()
+
+            # This task is finished.
+            self.connection_rate_dict.pop(task_number, None)
+            self.finished_threads = self.finished_threads + 1
+
+    # this coroutine calculates download rate and ETA every second.
+    async def downloadSpeedTask(self):
+        while self.download_status == 'downloading' or self.download_status == 'paused':
+            self.calculateDownloadSpeed()
+            await asyncio.sleep(1)
+
+    # this coroutine saves download information in control file every 1 second.
+    # writeControlFile syncs download file to the disk. So it runs in a thread and doesn't block event loop.
+    async def saveInfoTask(self):
+        loop = asyncio.get_event_loop()
+        while self.download_status == 'downloading' or self.download_status == 'paused':
+            await loop.run_in_executor(None, self.writeControlFile)
+            await asyncio.sleep(1)
+
+    # this coroutine runs download tasks and waits for them.
+    async def runDownloadTasks(self):
+        # check if server supports multithread downloading or not!
+        if self.resuming_suppurt is False:
+            self.number_of_threads = 1
+
+        download_tasks = [asyncio.ensure_future(self.downloadTask(i)) for i in range(0, self.number_of_threads)]
+        helper_tasks = [asyncio.ensure_future(self.downloadSpeedTask()),
+                        asyncio.ensure_future(self.saveInfoTask())]
+
+        # downloaded data is verified by verify thread, so reading download file doesn't block event loop.
+        self.startVerifyThread()
+
+        # progress bar writes on console and sleeps. So it runs in a thread.
+        if self.progress_bar is True:
+            progress_bar_thread = threading.Thread(
+                target=self.progressBar)
+            progress_bar_thread.daemon = True
+            progress_bar_thread.start()
+            self.thread_list.append(progress_bar_thread)
+
+        pending_tasks = set(download_tasks)
+        while pending_tasks:
+            done_tasks, pending_tasks = await asyncio.wait(pending_tasks, timeout=1)
+
+            # Calculate download percent
+            if self.file_size:
+                self.download_percent = int((self.downloaded_size / self.file_size) * 100)
+            else:
+                self.download_percent = 0
+
+            # Calculate number of active connections
+            self.number_of_active_connections = min(len(pending_tasks), self.connectionLimit())
+
+            # change number of connections in adaptive mode.
+            self.adaptConnections()
+
+            # drop slow connections.
+            self.checkLowestSpeed()
+
+            # verify download file after download tasks are finished.
+            # Parts that don't match are downloaded by new tasks.
+            # Download file is read for verifying. So it runs in a thread and doesn't block event loop.
+            if not pending_tasks and self.hasVerifier() and \
+                    await asyncio.get_event_loop().run_in_executor(None, self.verifyDownload):
+                self.finished_threads = 0
+                new_tasks = [asyncio.ensure_future(self.downloadTask(i)) for i in range(0, self.number_of_threads)]
+                download_tasks.extend(new_tasks)
+                pending_tasks = set(new_tasks)
+
+        # download tasks don't raise exceptions. but check them for logging unexpected errors.
+        for task in download_tasks:
+            if task.exception() is not None:
+                sendToLog('download task error: ' + str(task.exception()), 'ERROR')
+
+        for task in helper_tasks:
+            task.cancel()
+        await asyncio.gather(*helper_tasks, return_exceptions=True)
+
+        # finishDownload waits until queued data is written.
+        await self.runInWriter(self.finishDownload)
+
+    # this coroutine does the same work as Download.start
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.part_condition = asyncio.Condition()
+        self.loop = loop
+
+        # proxies are not supported by async_http.
+        if self.ip:
+            sendToLog('AsyncDownload doesn\'t support proxy. Use Download class.', 'ERROR')
+            self.download_status = 'error'
+            self.close()
+            return
+
+        self.createSession()
+        header = await self.requestFileHeader()
+        if header != {} and await self.checkMirrorsAsync():
+            self.download_status = 'creating download file'
+            self.resumingSupport()
+
+            self.getFileName()
+
+            self.getFileTag()
+
+            # open connections of download tasks while download file is created.
+            warm_up_task = asyncio.ensure_future(self.warmUpConnectionsAsync())
+
+            # file allocation may take a long time. So it runs in a thread and doesn't block event loop.
+            enough_free_space = await loop.run_in_executor(None, self.createControlFile)
+            await warm_up_task
+            if self.download_status != 'stopped':
+                self.download_status = 'downloading'
+                if enough_free_space:
+                    self.definePartSizes()
+
+                    # open download file for writing.
+                    self.createOutputSink()
+                    self.write_executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=min(self.number_of_threads, self.writer_threads))
+
+                    # save the first snapshot of parts.
+                    await loop.run_in_executor(None, self.compactControlFile)
+
+                    try:
+                        await self.runDownloadTasks()
+                    finally:
+                        self.write_executor.shutdown()
+                else:
+                    self.download_status = 'error'
+
+        else:
+            self.download_status = 'error'
+
+        # connections belong to event loop. So unused response of GET probe is closed here.
+        self.closeProbeResponse()
+        self.closeWarmConnections()
+
+        # close joins the progress bar thread.
+        await loop.run_in_executor(None, self.close)
+        self.loop = None
+
+    # this method runs download in a new event loop and blocks until download is finished.
+    # asyncio.run is not available in python 3.5 and 3.6.
+    def start(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
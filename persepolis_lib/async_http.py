@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import socket
+import time
+from email.parser import BytesParser
+from http.client import HTTPMessage
+
+
+# maximum length of status line and header lines
+MAX_LINE_LENGTH = 65536
+
+# maximum number of header lines in response
+MAX_HEADERS = 100
+
+
+# AsyncConnectionGate does the same work as ConnectionGate in http_adapter.py for AsyncHTTPConnection.
+# At most max_connecting connections are opened at the same time and at most connect_rate connections
+# are opened every second. connect_rate=0 means no limit.
+# Host names are resolved once and their addresses are kept for the next connections.
+# It must be created in the running event loop.
+class AsyncConnectionGate():
+    def __init__(self, max_connecting=16, connect_rate=0):
+        self.semaphore = asyncio.Semaphore(max(int(max_connecting), 1))
+        self.connect_rate = connect_rate
+        self.next_connect_time = 0
+
+        # futures of getaddrinfo. keys are (host, port)
+        self.address_dict = {}
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        if self.connect_rate:
+            now = time.monotonic()
+            connect_time = max(now, self.next_connect_time)
+            self.next_connect_time = connect_time + (1 / self.connect_rate)
+            if connect_time > now:
+                try:
+                    await asyncio.sleep(connect_time - now)
+                except BaseException:
+                    self.semaphore.release()
+                    raise
+        return self
+
+    async def __aexit__(self, *args):
+        self.semaphore.release()
+
+    # this coroutine returns address of host. Other connections wait for the same getaddrinfo.
+    # If host can't be resolved, host is returned and open_connection reports the error.
+    async def resolve(self, host, port):
+        future = self.address_dict.get((host, port))
+        if future is None:
+            future = asyncio.ensure_future(asyncio.get_event_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM))
+            self.address_dict[(host, port)] = future
+
+        # a cancelled connection doesn't cancel getaddrinfo of the others.
+        try:
+            address_list = await asyncio.shield(future)
+        except OSError:
+            self.forget(host, port)
+            return host
+
+        return address_list[0][4][0]
+
+    # address of host is resolved again for the next connection.
+    def forget(self, host, port):
+        self.address_dict.pop((host, port), None)
+
+
+# AsyncHTTPConnection is a minimal HTTP/1.1 client connection over asyncio streams.
+# It sends one request at a time and keeps the connection alive for the next request
+# if server allows it.
+# scheme can be http or https. ssl_context is used for https connections.
+# If connection_gate is set, connection is opened through it. see AsyncConnectionGate
+class AsyncHTTPConnection():
+    def __init__(self, scheme, host, port, timeout, ssl_context=None, read_limit=65536, connection_gate=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.connection_gate = connection_gate
+
+        # warm_connection is True if connection is opened before sending the first request.
+        self.warm_connection = False
+
+        # size of stream buffer. see asyncio.open_connection
+        self.read_limit = read_limit
+
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        if self.scheme == 'https':
+            ssl_context = self.ssl_context
+            server_hostname = self.host
+        else:
+            ssl_context = None
+            server_hostname = None
+
+        if self.connection_gate is None:
+            await self.openConnection(self.host, ssl_context, server_hostname)
+            return
+
+        async with self.connection_gate:
+            address = await self.connection_gate.resolve(self.host, self.port)
+            try:
+                await self.openConnection(address, ssl_context, server_hostname)
+            except BaseException:
+                # address may be changed.
+                self.connection_gate.forget(self.host, self.port)
+                raise
+
+    async def openConnection(self, address, ssl_context, server_hostname):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(address, self.port, ssl=ssl_context,
+                                    server_hostname=server_hostname, limit=self.read_limit),
+            self.timeout)
+
+    # returns True if connection is open and server didn't close it.
+    def isConnected(self):
+        return self.writer is not None and not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def readLine(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if len(line) > MAX_LINE_LENGTH:
+            raise ConnectionError('Header line is too long')
+        return line
+
+    # send request and read status line and headers of response.
+    # target is path and query of the link.
+    # It returns response and True if request is sent over a new connection.
+    async def request(self, method, target, headers):
+        try:
+            return await self.sendRequest(method, target, headers)
+        except BaseException:
+            # response of this request may be received later.
+            # So this connection can't be used for the next requests.
+            self.close()
+            raise
+
+    async def sendRequest(self, method, target, headers):
+        # the first request of a warm connection is sent over a new connection too.
+        warm_connection = self.warm_connection
+        self.warm_connection = False
+
+        new_connection = False
+        if not self.isConnected():
+            self.close()
+            await self.connect()
+            new_connection = True
+
+        request_lines = [method + ' ' + target + ' HTTP/1.1']
+        for key, value in headers.items():
+            request_lines.append(key + ': ' + str(value))
+        request_bytes = ('\r\n'.join(request_lines) + '\r\n\r\n').encode('latin-1')
+
+        try:
+            self.writer.write(request_bytes)
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            status_line = await self.readLine()
+            if not status_line:
+                raise ConnectionError('Server closed the connection')
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            # server may close a keep-alive connection at any time.
+            # So send request again over a new connection.
+            if new_connection:
+                raise
+            self.close()
+            await self.connect()
+            new_connection = True
+            self.writer.write(request_bytes)
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            status_line = await self.readLine()
+
+        while True:
+            version, status, reason = self.parseStatusLine(status_line)
+            headers = await self.readHeaders()
+
+            # skip informational responses like "100 Continue".
+            if 100 <= status < 200 and status != 101:
+                status_line = await self.readLine()
+                continue
+
+            return AsyncHTTPResponse(self, method, version, status, reason, headers), new_connection or warm_connection
+
+    def parseStatusLine(self, status_line):
+        try:
+            version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise ConnectionError('Invalid status line: ' + repr(status_line))
+
+        if not version.startswith('HTTP/'):
+            raise ConnectionError('Invalid status line: ' + repr(status_line))
+
+        return version, status, reason
+
+    async def readHeaders(self):
+        header_lines = []
+        while True:
+            line = await self.readLine()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            header_lines.append(line)
+            if len(header_lines) > MAX_HEADERS:
+                raise ConnectionError('Too many headers')
+
+        return BytesParser(_class=HTTPMessage).parsebytes(b''.join(header_lines))
+
+
+# AsyncHTTPResponse reads body of the response.
+# Body length is specified by Content-Length header, chunked transfer encoding
+# or closing connection by server.
+class AsyncHTTPResponse():
+    def __init__(self, connection, method, version, status, reason, headers):
+        self.connection = connection
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+        self.chunked = False
+        # length of the body that is not read yet. It's None if length is unspecified.
+        self.length = None
+        # length of the current chunk that is not read yet.
+        self.chunk_left = 0
+
+        if method == 'HEAD' or status in (204, 304):
+            self.length = 0
+        elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            self.chunked = True
+        elif headers.get('Content-Length') is not None:
+            try:
+                self.length = int(headers.get('Content-Length'))
+            except ValueError:
+                raise ConnectionError('Invalid Content-Length header')
+
+        connection_header = headers.get('Connection', '').lower()
+        self.will_close = ('close' in connection_header) or\
+            (version == 'HTTP/1.0' and 'keep-alive' not in connection_header) or\
+            (not self.chunked and self.length is None)
+
+        # finished is True if body is read completely.
+        self.finished = (self.length == 0)
+
+    # http.cookiejar uses this method for reading cookies of response.
+    def info(self):
+        return self.headers
+
+    # read up to amt bytes from body. It returns empty bytes if body is finished.
+    async def read(self, amt):
+        if self.finished:
+            return b''
+
+        try:
+            return await self.readBody(amt)
+        except BaseException:
+            # the rest of the body is unknown. So connection can't be reused.
+            self.connection.close()
+            raise
+
+    async def readBody(self, amt):
+        if self.chunked:
+            return await self.readChunk(amt)
+
+        reader = self.connection.reader
+        timeout = self.connection.timeout
+
+        if self.length is None:
+            # body is finished when server closes the connection.
+            data = await asyncio.wait_for(reader.read(amt), timeout)
+            if not data:
+                self.finished = True
+            return data
+
+        data = await asyncio.wait_for(reader.read(min(amt, self.length)), timeout)
+        if not data:
+            raise ConnectionError('Connection closed before the end of response')
+
+        self.length -= len(data)
+        if self.length == 0:
+            self.finished = True
+
+        return data
+
+    async def readChunk(self, amt):
+        reader = self.connection.reader
+        timeout = self.connection.timeout
+
+        if self.chunk_left == 0:
+            line = await self.connection.readLine()
+            try:
+                self.chunk_left = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise ConnectionError('Invalid chunk size')
+
+            # the last chunk. read trailers.
+            if self.chunk_left == 0:
+                await self.connection.readHeaders()
+                self.finished = True
+                return b''
+
+        data = await asyncio.wait_for(reader.read(min(amt, self.chunk_left)), timeout)
+        if not data:
+            raise ConnectionError('Connection closed before the end of response')
+
+        self.chunk_left -= len(data)
+
+        # every chunk ends with CRLF
+        if self.chunk_left == 0:
+            await asyncio.wait_for(reader.readexactly(2), timeout)
+
+        return data
+
+    # If body is read completely, connection is kept alive for the next request.
+    # Else the connection is closed.
+    def close(self):
+        if not self.finished or self.will_close:
+            self.connection.close()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+
+# BufferPool keeps receive buffers of a download, so buffers are not allocated for every response.
+# Buffers are created when they are needed and at most max_buffers buffers exist.
+# If all buffers are in use, take() waits until a buffer is given back.
+class BufferPool():
+    def __init__(self, buffer_size, max_buffers):
+        self.buffer_size = buffer_size
+        self.max_buffers = max(int(max_buffers), 1)
+        self.free_buffer_list = []
+        self.number_of_buffers = 0
+        self.condition = threading.Condition()
+
+    # this method returns a bytearray of buffer_size bytes.
+    def take(self):
+        with self.condition:
+            while not self.free_buffer_list and self.number_of_buffers >= self.max_buffers:
+                self.condition.wait()
+
+            if self.free_buffer_list:
+                return self.free_buffer_list.pop()
+
+            self.number_of_buffers += 1
+
+        return bytearray(self.buffer_size)
+
+    # buffer is not used anymore.
+    def give(self, buffer):
+        with self.condition:
+            self.free_buffer_list.append(buffer)
+            self.condition.notify()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from persepolis_lib.useful_tools import sendToLog
+
+
+# ConnectionController finds the number of connections for adaptive mode (AIMD).
+# It starts with initial_connections and adds increase_step connections every interval,
+# while download rate grows more than growth_threshold.
+# If server returns 429 or 503 or connections fail, number of connections is multiplied by decrease_factor.
+# If download rate doesn't grow with new connections, number of connections returns to the best number.
+# After decreasing, number of connections is kept for hold_intervals intervals
+# and then more connections are tried again, because network conditions may change.
+# settled_connections is the number of connections that gave the best download rate. It's updated every interval,
+# so it's the number that controller settled on, whether or not number of connections was decreased.
+class ConnectionController():
+    def __init__(self, max_connections, min_connections=1, initial_connections=4, increase_step=2,
+                 decrease_factor=0.5, growth_threshold=0.1, hold_intervals=5):
+        self.max_connections = max(int(max_connections), 1)
+        self.min_connections = min(max(int(min_connections), 1), self.max_connections)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.growth_threshold = growth_threshold
+        self.hold_intervals = hold_intervals
+
+        self.target_connections = min(max(initial_connections, self.min_connections), self.max_connections)
+
+        # number of connections that gave the best download rate and its rate.
+        # baseline_rate is None until the first interval with the current connections is measured.
+        self.best_connections = self.target_connections
+        self.baseline_rate = None
+
+        # number of connections that controller settled on. It's None until the first interval is measured.
+        self.settled_connections = None
+        self.remaining_hold_intervals = 0
+
+    # this method is called every interval with download rate of the interval in bytes per second
+    # and number of errors in the interval. It returns the new number of connections.
+    def update(self, download_rate, number_of_errors):
+        if number_of_errors > 0:
+            # server or network is overloaded. decrease multiplicatively.
+            self.settle(int(self.target_connections * self.decrease_factor))
+
+        elif self.baseline_rate is None:
+            # the first measurement with this number of connections.
+            self.baseline_rate = download_rate
+            self.increase()
+
+        elif download_rate > self.baseline_rate * (1 + self.growth_threshold):
+            # new connections increased download rate.
+            self.baseline_rate = download_rate
+            self.best_connections = self.target_connections
+            self.increase()
+
+        elif self.target_connections > self.best_connections:
+            # download rate is flat. new connections are only overhead.
+            self.settle(max(self.best_connections, int(self.target_connections * self.decrease_factor)))
+
+        else:
+            self.increase()
+
+        self.settled_connections = self.best_connections
+        return self.target_connections
+
+    # download is finished. If no interval was measured, the initial number of connections was used.
+    def finish(self):
+        if self.settled_connections is None:
+            self.settled_connections = self.best_connections
+
+    # add increase_step connections, if hold time is finished.
+    def increase(self):
+        if self.remaining_hold_intervals > 0:
+            self.remaining_hold_intervals -= 1
+        elif self.target_connections < self.max_connections:
+            self.target_connections = min(self.target_connections + self.increase_step, self.max_connections)
+
+    # set number of connections and keep it for hold_intervals intervals.
+    def settle(self, number_of_connections):
+        self.target_connections = min(max(number_of_connections, self.min_connections), self.max_connections)
+        self.best_connections = self.target_connections
+        self.baseline_rate = None
+        self.remaining_hold_intervals = self.hold_intervals
+
+        if self.settled_connections != self.target_connections:
+            sendToLog('Number of connections is set to ' + str(self.target_connections))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import json
+import os
+import struct
+
+
+# journal file starts with magic bytes and journal_id.
+JOURNAL_MAGIC = b'PSPJ'
+JOURNAL_HEADER = struct.Struct('<4s8s')
+
+# every record contains part_number, start, end, downloaded, retry and status of a part
+# and crc32 of these values.
+RECORD = struct.Struct('<Iqqqqb')
+RECORD_CRC = struct.Struct('<I')
+RECORD_SIZE = RECORD.size + RECORD_CRC.size
+
+
+# this function syncs the data of fd to the disk.
+def syncFile(fd):
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+# ControlJournal saves download information in two files:
+# control file (.persepolis): a JSON snapshot of all parts. It's written to a temporary file
+#     and renamed, so it's never half written.
+# journal file (.persepolis.journal): changed parts since the last snapshot are appended to this file
+#     as fixed size binary records. So every checkpoint writes only the changed parts.
+# When journal becomes big, a new snapshot is written and journal is started again (compaction).
+# Control file contains journal_id and journal header contains the same id.
+# A journal with a different id belongs to an older snapshot and it's ignored.
+class ControlJournal():
+    def __init__(self, control_file_path):
+        self.control_file_path = control_file_path
+        self.journal_file_path = control_file_path + '.journal'
+        self.journal_fd = None
+        self.journal_id = None
+        self.number_of_records = 0
+
+    # this method applies records of journal to part_table.
+    # journal_id is the id that is saved in control file.
+    # A record that is cut by crash or a record with wrong crc ends the journal.
+    # It returns number of applied records.
+    def replay(self, part_table, journal_id):
+        if journal_id is None or not os.path.isfile(self.journal_file_path):
+            return 0
+
+        with open(self.journal_file_path, 'rb') as journal_file:
+            journal_data = journal_file.read()
+
+        if len(journal_data) < JOURNAL_HEADER.size:
+            return 0
+
+        magic, header_journal_id = JOURNAL_HEADER.unpack_from(journal_data, 0)
+        if magic != JOURNAL_MAGIC or header_journal_id.hex() != journal_id:
+            return 0
+
+        number_of_records = 0
+        for offset in range(JOURNAL_HEADER.size, len(journal_data) - RECORD_SIZE + 1, RECORD_SIZE):
+            record_bytes = journal_data[offset:offset + RECORD.size]
+            crc, = RECORD_CRC.unpack_from(journal_data, offset + RECORD.size)
+            if binascii.crc32(record_bytes) != crc:
+                break
+
+            part_number, start, end, downloaded, retry, status = RECORD.unpack(record_bytes)
+
+            # new parts are added to the end of part_table by splitting.
+            if part_number == len(part_table):
+                part_table.addPart(start, end, downloaded, status, retry)
+            elif part_number < len(part_table):
+                part_table.start[part_number] = start
+                part_table.end[part_number] = end
+                part_table.downloaded[part_number] = downloaded
+                part_table.retry[part_number] = retry
+                part_table.status[part_number] = status
+            else:
+                break
+
+            number_of_records += 1
+
+        return number_of_records
+
+    # this method writes control_dict to control file and starts a new journal.
+    # journal_id is added to control_dict.
+    def writeSnapshot(self, control_dict):
+        new_journal_id = os.urandom(8)
+        control_dict['journal_id'] = new_journal_id.hex()
+
+        # write snapshot to a temporary file and rename it.
+        # If a crash happens before renaming, the old control file and the old journal are valid.
+        temp_file_path = self.control_file_path + '.tmp'
+        with open(temp_file_path, 'w') as temp_file:
+            json.dump(control_dict, temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file_path, self.control_file_path)
+        self.syncDirectory()
+
+        # If a crash happens here, the old journal is ignored, because its id is not the same as
+        # id of the new snapshot.
+        self.closeJournal()
+        self.journal_fd = os.open(self.journal_file_path,
+                                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        os.write(self.journal_fd, JOURNAL_HEADER.pack(JOURNAL_MAGIC, new_journal_id))
+        syncFile(self.journal_fd)
+
+        self.journal_id = new_journal_id
+        self.number_of_records = 0
+
+    # this method appends records to journal and syncs journal.
+    # every record is (part_number, start, end, downloaded, retry, status).
+    # Data of parts must be synced before calling this method.
+    def append(self, records):
+        if self.journal_fd is None:
+            return
+
+        journal_bytes = bytearray()
+        for record in records:
+            record_bytes = RECORD.pack(*record)
+            journal_bytes += record_bytes
+            journal_bytes += RECORD_CRC.pack(binascii.crc32(record_bytes))
+
+        view = memoryview(journal_bytes)
+        while len(view) > 0:
+            written = os.write(self.journal_fd, view)
+            view = view[written:]
+
+        syncFile(self.journal_fd)
+        self.number_of_records += len(records)
+
+    # journal is compacted when it has more records than 4 times number of parts.
+    def needsCompaction(self, number_of_parts):
+        return self.number_of_records > max(4 * number_of_parts, 1024)
+
+    # sync directory after renaming, so the new name is saved on the disk.
+    # It's not possible on Windows.
+    def syncDirectory(self):
+        directory = os.path.dirname(os.path.abspath(self.control_file_path))
+        try:
+            directory_fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.fsync(directory_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(directory_fd)
+
+    def closeJournal(self):
+        if self.journal_fd is not None:
+            os.close(self.journal_fd)
+            self.journal_fd = None
+
+    # delete journal file. It's called when download is complete.
+    def remove(self):
+        self.closeJournal()
+        if os.path.isfile(self.journal_file_path):
+            os.remove(self.journal_file_path)
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import deque
+from persepolis_lib.persepolis_lib import Download
+from persepolis_lib.rate_limiter import TokenBucket
+from persepolis_lib.useful_tools import sendToLog
+from persepolis_lib.integrity import hashAlgorithmName, parseExpectedHash
+
+
+# DownloadItem keeps information of every download in DownloadManager.
+# status can be waiting, preparing, downloading, paused, stopped, complete or error.
+# Download object is created when download becomes active and it's deleted when download is finished.
+# So waiting and finished downloads need only a few bytes.
+class DownloadItem():
+    def __init__(self, download_id, add_link_dictionary):
+        self.download_id = download_id
+        self.add_link_dictionary = add_link_dictionary
+        self.status = 'waiting'
+        self.download = None
+
+        # number of worker threads that are downloading parts of this download
+        self.active_connections = 0
+
+        # user paused or canceled download. Download is paused or removed when its connections are finished.
+        self.pause_requested = False
+        self.cancel_requested = False
+
+        # the last tellStatus of download, after download is finished.
+        self.last_status = None
+
+
+# DownloadManager downloads many links with a fixed number of threads.
+# max_connections worker threads are shared between all downloads. Every worker claims a part
+# from part_scheduler of an active download, downloads it and then claims the next part.
+# Downloads are selected in round-robin order, so connections are divided between active downloads.
+# No more than max_active_downloads downloads are active at the same time and the others wait in queue.
+# A housekeeping thread activates waiting downloads, saves control files, calculates download speed
+# and closes finished downloads.
+# download_options are passed to Download class for every download. e.g. number_of_threads, timeout, retry, part_size.
+# number_of_threads is the maximum number of connections for every download.
+#
+# usage:
+#     manager = DownloadManager(max_active_downloads=4, max_connections=64)
+#     download_id = manager.add(add_link_dictionary)
+#     manager.join()
+#     manager.close()
+class DownloadManager():
+    def __init__(self, max_active_downloads=4, max_connections=64, **download_options):
+        self.max_active_downloads = max(int(max_active_downloads), 1)
+        self.max_connections = max(int(max_connections), 1)
+
+        # progress bar of every download is not useful in manager.
+        self.download_options = download_options
+        self.download_options['progress_bar'] = False
+        self.download_options['threads_progress_bar'] = False
+
+        # check hash_algorithm before creating downloads. It raises ValueError if algorithm is not supported.
+        if download_options.get('hash_algorithm'):
+            hashAlgorithmName(download_options['hash_algorithm'])
+
+        self.condition = threading.Condition()
+        self.item_dict = {}
+        self.waiting_queue = deque()
+        self.active_list = []
+        self.next_download_id = 1
+        self.next_active_index = 0
+        self.closed = False
+
+        # speed_limiter is shared between all downloads. see limitSpeed method.
+        self.speed_limiter = TokenBucket()
+
+        # connection pools of all downloads. It's created by createDownload.
+        self.pool_manager = None
+
+        self.thread_list = []
+        for i in range(0, self.max_connections):
+            worker_thread = threading.Thread(target=self.worker, kwargs={'worker_number': i})
+            worker_thread.daemon = True
+            worker_thread.start()
+            self.thread_list.append(worker_thread)
+
+        housekeeping_thread = threading.Thread(target=self.housekeeping)
+        housekeeping_thread.daemon = True
+        housekeeping_thread.start()
+        self.thread_list.append(housekeeping_thread)
+
+    # add a download to queue and return its id.
+    # add_link_dictionary is like the dictionary of Download class.
+    # It raises ValueError if expected_hash or metalink file of add_link_dictionary is not valid.
+    def add(self, add_link_dictionary):
+        if add_link_dictionary.get('expected_hash'):
+            parseExpectedHash(add_link_dictionary['expected_hash'])
+
+        if add_link_dictionary.get('metalink'):
+            from persepolis_lib.metalink import readMetalink
+            readMetalink(add_link_dictionary['metalink'])
+
+        with self.condition:
+            download_id = self.next_download_id
+            self.next_download_id += 1
+
+            self.item_dict[download_id] = DownloadItem(download_id, add_link_dictionary)
+            self.waiting_queue.append(download_id)
+            self.condition.notify_all()
+
+        return download_id
+
+    # pause download. Downloaded parts are saved in control file and
+    # resume method continues download from control file.
+    # It returns False if download_id is invalid or download is finished.
+    def pause(self, download_id):
+        with self.condition:
+            item = self.item_dict.get(download_id)
+            if item is None:
+                return False
+
+            if item.status == 'waiting':
+                self.waiting_queue.remove(download_id)
+                item.status = 'paused'
+                self.condition.notify_all()
+                return True
+
+            if item.status in ['preparing', 'downloading']:
+                # A paused Download keeps its connections. So download is stopped and
+                # worker threads are free for other downloads.
+                item.pause_requested = True
+                if item.download is not None:
+                    item.download.stop()
+                self.condition.notify_all()
+                return True
+
+            return False
+
+    # add paused, stopped or failed download to queue again.
+    def resume(self, download_id):
+        with self.condition:
+            item = self.item_dict.get(download_id)
+            if item is None or item.status not in ['paused', 'stopped', 'error']:
+                return False
+
+            item.status = 'waiting'
+            item.pause_requested = False
+            self.waiting_queue.append(download_id)
+            self.condition.notify_all()
+            return True
+
+    # stop download and remove it from manager.
+    # downloaded file and control file are not deleted. So download can be resumed by adding it again.
+    def cancel(self, download_id):
+        with self.condition:
+            item = self.item_dict.get(download_id)
+            if item is None:
+                return False
+
+            if item.status in ['preparing', 'downloading']:
+                # item is removed when its connections are finished.
+                item.cancel_requested = True
+                if item.download is not None:
+                    item.download.stop()
+            else:
+                if item.status == 'waiting':
+                    self.waiting_queue.remove(download_id)
+                del self.item_dict[download_id]
+
+            self.condition.notify_all()
+            return True
+
+    # limit download speed of all downloads.
+    # 0 or None means no limit speed.
+    def limitSpeed(self, bytes_per_second=None):
+        self.speed_limiter.setRate(bytes_per_second)
+
+    # This method returns download status in dictionary format.
+    # It's like Download.tellStatus and it contains download_id too.
+    def tellStatus(self, download_id):
+        with self.condition:
+            item = self.item_dict.get(download_id)
+            if item is None:
+                return None
+
+            if item.status == 'downloading':
+                download_info = item.download.tellStatus()
+            elif item.last_status is not None:
+                download_info = dict(item.last_status)
+            else:
+                download_info = {'link': item.add_link_dictionary['link']}
+
+            download_info['download_id'] = download_id
+            download_info['status'] = item.status
+            return download_info
+
+    # This method returns status of all downloads.
+    def tellAll(self):
+        with self.condition:
+            download_id_list = list(self.item_dict.keys())
+
+        return [self.tellStatus(download_id) for download_id in download_id_list if download_id in self.item_dict]
+
+    # wait until all downloads are finished or paused.
+    # It returns False if timeout expires.
+    def join(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.waiting_queue and not self.active_list, timeout)
+
+    # stop all active downloads and exit threads.
+    # Active downloads become paused and waiting downloads stay in waiting status.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            for item in list(self.active_list):
+                item.pause_requested = True
+                if item.download is not None:
+                    item.download.stop()
+                elif item.status == 'preparing':
+                    # no worker thread started this download.
+                    self.active_list.remove(item)
+                    item.status = 'waiting'
+                    self.waiting_queue.appendleft(item.download_id)
+
+            self.condition.notify_all()
+
+        for thread in self.thread_list:
+            thread.join()
+
+        if self.pool_manager is not None:
+            self.pool_manager.clear()
+
+        sendToLog('DownloadManager is closed!')
+
+    # create Download object for the item.
+    # Parts are downloaded by worker threads, so a download doesn't use more than max_connections connections.
+    # Connections of all downloads are kept in pool_manager, so no more than max_connections connections
+    # of a server are kept open. They are opened when workers claim parts, not while download file is created.
+    # condition must be acquired before calling this method.
+    def createDownload(self, item):
+        if self.pool_manager is None:
+            from persepolis_lib.http_adapter import CountingPoolManager, ConnectionGate, ConnectionStatistics
+            connection_gate = ConnectionGate(self.download_options.get('connect_concurrency', 16),
+                                             self.download_options.get('connect_rate', 0))
+            self.pool_manager = CountingPoolManager(ConnectionStatistics(), connection_gate, maxsize=self.max_connections)
+
+        download_options = dict(self.download_options)
+        download_options['number_of_threads'] = min(download_options.get('number_of_threads', 64), self.max_connections)
+
+        download = Download(item.add_link_dictionary, **download_options)
+        download.speed_limiter = self.speed_limiter
+        download.shared_pool_manager = self.pool_manager
+        download.warm_up = False
+        return download
+
+    # this method returns the next job for worker threads.
+    # A job is (item, None) for preparing download or (item, part_number) for downloading a part.
+    # It returns None if nothing can be done now.
+    # condition must be acquired before calling this method.
+    def nextJob(self):
+        # prepare new downloads first
+        for item in self.active_list:
+            if item.status == 'preparing' and item.download is None:
+                item.download = self.createDownload(item)
+                return item, None
+
+        number_of_active_items = len(self.active_list)
+        for i in range(0, number_of_active_items):
+            index = (self.next_active_index + i) % number_of_active_items
+            item = self.active_list[index]
+            if item.status != 'downloading' or item.active_connections >= item.download.connectionLimit():
+                continue
+
+            if item.download.download_status not in ['downloading', 'paused']:
+                continue
+
+            part_number = item.download.part_scheduler.claim(block=False)
+            if part_number is not None:
+                item.active_connections += 1
+                # next job is taken from next download.
+                self.next_active_index = (index + 1) % number_of_active_items
+                return item, part_number
+
+        return None
+
+    # worker threads run this method.
+    def worker(self, worker_number):
+        while True:
+            with self.condition:
+                job = self.nextJob()
+                while job is None and not self.closed:
+                    # parts become pending when other workers fail or new downloads become active.
+                    # Every change that makes a job notifies condition. So idle workers don't wake up.
+                    # Changes that depend on time are notified by housekeeping.
+                    self.condition.wait()
+                    job = self.nextJob()
+
+                if job is None:
+                    break
+
+            item, part_number = job
+            if part_number is None:
+                self.prepareItem(item)
+            else:
+                try:
+                    item.download.downloadPart(part_number, worker_number)
+                except Exception as e:
+                    sendToLog('DownloadManager worker error: ' + str(e), 'ERROR')
+
+                with self.condition:
+                    item.active_connections -= 1
+                    self.condition.notify_all()
+
+    # get file information and create download file.
+    def prepareItem(self, item):
+        download = item.download
+        try:
+            prepared = download.prepareDownload()
+        except Exception as e:
+            sendToLog('DownloadManager error: ' + str(e), 'ERROR')
+            download.download_status = 'error'
+            prepared = False
+
+        with self.condition:
+            if prepared:
+                # user paused or canceled download during preparing.
+                if item.pause_requested or item.cancel_requested:
+                    download.stop()
+
+                item.status = 'downloading'
+                self.condition.notify_all()
+            else:
+                item.status = 'finishing'
+
+        # downloaded data is verified by verify thread of download.
+        if prepared:
+            download.startVerifyThread()
+
+        if not prepared:
+            self.finishItem(item)
+
+    # move waiting downloads to active_list.
+    # condition must be acquired before calling this method.
+    def activateDownloads(self):
+        while not self.closed and self.waiting_queue and len(self.active_list) < self.max_active_downloads:
+            item = self.item_dict[self.waiting_queue.popleft()]
+            item.status = 'preparing'
+            item.download = None
+            item.last_status = None
+            self.active_list.append(item)
+            self.condition.notify_all()
+
+    # close finished download and save its status.
+    def finishItem(self, item):
+        download = item.download
+
+        # parts that don't match expected_hash are downloaded again by workers.
+        try:
+            if download.part_scheduler is not None and download.verifyDownload():
+                with self.condition:
+                    item.status = 'downloading'
+                    self.condition.notify_all()
+                return
+        except Exception as e:
+            sendToLog('DownloadManager error: ' + str(e), 'ERROR')
+
+        try:
+            if download.part_scheduler is not None:
+                download.finishDownload()
+
+            # close saves the last state of parts for resuming.
+            download.close()
+        except Exception as e:
+            sendToLog('DownloadManager error: ' + str(e), 'ERROR')
+
+        with self.condition:
+            self.active_list.remove(item)
+            item.last_status = download.tellStatus()
+            item.download = None
+
+            if item.cancel_requested:
+                self.item_dict.pop(item.download_id, None)
+            elif item.pause_requested and download.download_status == 'stopped':
+                item.status = 'paused'
+            else:
+                item.status = download.download_status
+
+            # start the next download in queue.
+            self.activateDownloads()
+            self.condition.notify_all()
+
+    # housekeeping thread runs this method.
+    # workers notify condition when a part is finished. So finished downloads are closed immediately,
+    # but control files are saved and speed is calculated every second.
+    # If no download is active, it waits until a download is added or manager is closed.
+    def housekeeping(self):
+        last_save_time = 0
+        while True:
+            finished_items = []
+            downloading_items = []
+            with self.condition:
+                if self.closed and not self.active_list:
+                    break
+
+                self.activateDownloads()
+
+                for item in list(self.active_list):
+                    if item.status != 'downloading':
+                        continue
+
+                    download = item.download
+                    download.number_of_active_connections = item.active_connections
+                    if download.file_size:
+                        download.download_percent = int((download.downloaded_size / download.file_size) * 100)
+
+                    # download is finished if no connection is active and no part remains for downloading.
+                    if item.active_connections == 0 and \
+                            (download.download_status not in ['downloading', 'paused'] or download.part_scheduler.isFinished()):
+                        item.status = 'finishing'
+                        finished_items.append(item)
+                    else:
+                        downloading_items.append(item)
+
+            for item in finished_items:
+                self.finishItem(item)
+
+            if time.monotonic() - last_save_time >= 1:
+                last_save_time = time.monotonic()
+                for item in downloading_items:
+                    download = item.download
+                    if download is None:
+                        continue
+                    try:
+                        download.calculateDownloadSpeed()
+                        download.adaptConnections()
+                        download.checkLowestSpeed()
+                        download.writeControlFile()
+                    except Exception as e:
+                        sendToLog('DownloadManager error: ' + str(e), 'ERROR')
+
+                # adaptConnections may raise number of connections and parts of a slow download
+                # may be hedged after a while. So waiting workers check parts again.
+                if downloading_items:
+                    with self.condition:
+                        self.condition.notify_all()
+
+            with self.condition:
+                if finished_items:
+                    continue
+
+                if self.active_list or self.waiting_queue or self.closed:
+                    self.condition.wait(max(1 - (time.monotonic() - last_save_time), 0.05))
+                else:
+                    self.condition.wait()
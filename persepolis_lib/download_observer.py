@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from persepolis_lib.useful_tools import sendToLog
+
+
+# DownloadObserver is the interface of download observers.
+# Subclass it and override the methods that you need, then add it to download by Download.addObserver.
+# Methods are called from download threads, so they must return quickly.
+# Observers don't need to be subclass of DownloadObserver. Methods that an observer doesn't have are not called.
+class DownloadObserver():
+    # called when a part is downloaded completely.
+    def on_part_complete(self, part_number):
+        pass
+
+    # called when data is received. downloaded_size is total downloaded size in bytes.
+    def on_progress(self, downloaded_size):
+        pass
+
+    # called when download status is changed. e.g. downloading, paused, complete, error, stopped
+    def on_state_change(self, status):
+        pass
+
+    # called when an error happens. Download may continue after errors of parts, because parts are retried.
+    def on_error(self, error_message):
+        pass
+
+
+# ObserverList sends events to observers of a download.
+# on_progress calls of every observer are coalesced, so an observer is not called more than
+# once in its progress_interval seconds.
+class ObserverList():
+    def __init__(self):
+        self.lock = threading.Lock()
+        # every item is [observer, progress_interval, time of the last on_progress call]
+        self.observer_list = []
+
+    def __len__(self):
+        return len(self.observer_list)
+
+    def add(self, observer, progress_interval=0.5):
+        with self.lock:
+            self.observer_list.append([observer, progress_interval, 0])
+
+    def remove(self, observer):
+        with self.lock:
+            self.observer_list = [item for item in self.observer_list if item[0] is not observer]
+
+    # call method_name of all observers.
+    # Errors of observers are logged and don't stop download.
+    def notify(self, method_name, *args):
+        for observer, progress_interval, last_progress_time in list(self.observer_list):
+            self.callObserver(observer, method_name, *args)
+
+    # call on_progress of observers whose progress_interval is passed.
+    # If force is True, all observers are called.
+    def notifyProgress(self, downloaded_size, force=False):
+        now = time.monotonic()
+        called_observer_list = []
+        with self.lock:
+            for item in self.observer_list:
+                if force or (now - item[2]) >= item[1]:
+                    item[2] = now
+                    called_observer_list.append(item[0])
+
+        for observer in called_observer_list:
+            self.callObserver(observer, 'on_progress', downloaded_size)
+
+    def callObserver(self, observer, method_name, *args):
+        method = getattr(observer, method_name, None)
+        if method is None:
+            return
+
+        try:
+            method(*args)
+        except Exception as e:
+            sendToLog('Observer error in ' + method_name + ': ' + str(e), 'ERROR')
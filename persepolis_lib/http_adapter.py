@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import ssl
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.poolmanager import PoolManager
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.connection import allowed_gai_family
+from urllib3.util.wait import wait_for_read
+
+
+# ConnectionStatistics counts requests that are sent over new connections
+# and requests that are sent over reused keep-alive connections.
+# It counts 429 and 503 responses and failed requests too. They show that server or network is overloaded.
+class ConnectionStatistics():
+    # server returns these status codes when it limits requests.
+    throttle_status_list = [429, 503]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.throttled_responses = 0
+        self.failed_requests = 0
+
+    def add(self, new_connection):
+        with self.lock:
+            if new_connection:
+                self.new_connections += 1
+            else:
+                self.reused_connections += 1
+
+    def addResponse(self, status):
+        if status in self.throttle_status_list:
+            with self.lock:
+                self.throttled_responses += 1
+
+    # connection is reset or timed out.
+    def addFailure(self):
+        with self.lock:
+            self.failed_requests += 1
+
+    # number of throttled responses and failed requests
+    def numberOfErrors(self):
+        return self.throttled_responses + self.failed_requests
+
+
+# ConnectionGate limits opening of new connections.
+# At most max_connecting connections are opened at the same time and at most connect_rate connections
+# are opened every second. connect_rate=0 means no limit. Opening includes TCP and TLS handshakes.
+# So download threads can start together without flooding server with handshakes.
+# Host names are resolved once and their addresses are kept for the next connections.
+class ConnectionGate():
+    def __init__(self, max_connecting=16, connect_rate=0):
+        self.semaphore = threading.BoundedSemaphore(max(int(max_connecting), 1))
+        self.connect_rate = connect_rate
+        self.next_connect_time = 0
+        self.lock = threading.Lock()
+
+        # addresses of hosts. keys are (host, port)
+        self.address_dict = {}
+        self.dns_lock = threading.Lock()
+
+    # this method reserves time for opening a new connection and returns seconds to wait until that time.
+    def reserveDelay(self):
+        if not self.connect_rate:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            connect_time = max(now, self.next_connect_time)
+            self.next_connect_time = connect_time + (1 / self.connect_rate)
+            return connect_time - now
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        delay = self.reserveDelay()
+        if delay > 0:
+            time.sleep(delay)
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+    # this method returns address of host. Other threads wait until host is resolved.
+    # If host can't be resolved, host is returned and urllib3 reports the error.
+    def resolve(self, host, port):
+        with self.dns_lock:
+            address = self.address_dict.get((host, port))
+            if address is None:
+                try:
+                    address = socket.getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM)[0][4][0]
+                except OSError:
+                    return host
+                self.address_dict[(host, port)] = address
+
+            return address
+
+    # address of host is resolved again for the next connection.
+    def forget(self, host, port):
+        with self.dns_lock:
+            self.address_dict.pop((host, port), None)
+
+
+# statistics of the adapter that sends the current request of thread. see PersepolisAdapter.send
+# Connection pools can be shared between adapters, so requests are counted by statistics of their adapter.
+request_context = threading.local()
+
+
+# This connection is opened through connection_gate and it uses the resolved address of host.
+# Only _new_conn uses the address. host is used for TLS server name and Host header.
+class GatedConnectionMixin():
+    connection_gate = None
+
+    # warm_connection is True if connection is opened before sending the first request.
+    # see Download.warmUpConnections
+    warm_connection = False
+
+    def connect(self):
+        if self.connection_gate is None:
+            return super().connect()
+
+        with self.connection_gate:
+            return super().connect()
+
+    def _new_conn(self):
+        if self.connection_gate is None:
+            return super()._new_conn()
+
+        host = self._dns_host
+        self._dns_host = self.connection_gate.resolve(host, self.port)
+        try:
+            return super()._new_conn()
+        except Exception:
+            # address may be changed.
+            self.connection_gate.forget(host, self.port)
+            raise
+        finally:
+            self._dns_host = host
+
+
+class GatedHTTPConnection(GatedConnectionMixin, HTTPConnection):
+    pass
+
+
+class GatedHTTPSConnection(GatedConnectionMixin, HTTPSConnection):
+    # urllib3 closes a pooled connection if its socket is readable.
+    # TLS 1.3 server sends session tickets after handshake, so socket of a warm connection is readable
+    # before the first request. Tickets are read by ssl module and connection is kept.
+    @property
+    def is_connected(self):
+        if self.sock is None:
+            return False
+
+        if not wait_for_read(self.sock, timeout=0.0):
+            return True
+
+        timeout = self.sock.gettimeout()
+        try:
+            self.sock.settimeout(0)
+            self.sock.recv(1)
+        except ssl.SSLWantReadError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
+        # server closed the connection or it sent unexpected data.
+        return False
+
+
+# A connection without socket must be connected before sending request.
+# So the request is sent over a new connection.
+# Requests that are retried by urllib3 pass through this method too. So all errors are counted.
+class CountingPoolMixin():
+    connection_statistics = None
+    connection_gate = None
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        conn.connection_gate = self.connection_gate
+        return conn
+
+    def _make_request(self, conn, *args, **kwargs):
+        connection_statistics = getattr(request_context, 'connection_statistics', None) or self.connection_statistics
+        if connection_statistics is None:
+            return super()._make_request(conn, *args, **kwargs)
+
+        # the first request of a warm connection is sent over a new connection too.
+        connection_statistics.add(getattr(conn, 'sock', None) is None or getattr(conn, 'warm_connection', False))
+        conn.warm_connection = False
+        try:
+            response = super()._make_request(conn, *args, **kwargs)
+        except Exception:
+            connection_statistics.addFailure()
+            raise
+
+        connection_statistics.addResponse(response.status)
+        return response
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = GatedHTTPConnection
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = GatedHTTPSConnection
+
+
+# this PoolManager creates connection pools that count new and reused connections.
+# Connections of these pools are opened through connection_gate.
+class CountingPoolManager(PoolManager):
+    def __init__(self, connection_statistics, connection_gate, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connection_statistics = connection_statistics
+        self.connection_gate = connection_gate
+        self.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool,
+                                       'https': CountingHTTPSConnectionPool}
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.connection_statistics = self.connection_statistics
+        pool.connection_gate = self.connection_gate
+        return pool
+
+
+# PersepolisAdapter is a requests HTTPAdapter that keeps statistics of connections.
+# Connections through proxies are not counted and they are not opened through connection_gate.
+# If pool_manager is given, connections are kept in it instead of a new CountingPoolManager.
+# So adapters of many downloads can share their connections. e.g. see DownloadManager.createDownload
+# Shared pool_manager is not closed by close().
+class PersepolisAdapter(HTTPAdapter):
+    def __init__(self, *args, connection_gate=None, pool_manager=None, **kwargs):
+        self.connection_statistics = ConnectionStatistics()
+        self.connection_gate = connection_gate
+        self.shared_pool_manager = pool_manager
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        # save these values for pickling
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+
+        if self.shared_pool_manager is not None:
+            self.poolmanager = self.shared_pool_manager
+            return
+
+        self.poolmanager = CountingPoolManager(self.connection_statistics, self.connection_gate, num_pools=connections,
+                                               maxsize=maxsize, block=block, **pool_kwargs)
+
+    def send(self, request, *args, **kwargs):
+        request_context.connection_statistics = self.connection_statistics
+        try:
+            return super().send(request, *args, **kwargs)
+        finally:
+            request_context.connection_statistics = None
+
+    def close(self):
+        if self.shared_pool_manager is None:
+            return super().close()
+
+        for proxy in self.proxy_manager.values():
+            proxy.clear()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import binascii
+import hashlib
+import threading
+
+# names of hash algorithms in Digest header (RFC 3230) and their names in hashlib.
+hash_algorithm_dict = {'sha': 'sha1',
+                       'sha-1': 'sha1',
+                       'sha-224': 'sha224',
+                       'sha-256': 'sha256',
+                       'sha-384': 'sha384',
+                       'sha-512': 'sha512',
+                       'sha3-256': 'sha3_256',
+                       'sha3-512': 'sha3_512'}
+
+
+# this function returns hashlib name of algorithm. e.g. SHA-256 -> sha256
+# It raises ValueError if algorithm is not supported.
+def hashAlgorithmName(algorithm):
+    name = algorithm.strip().lower()
+    name = hash_algorithm_dict.get(name, name)
+    if name not in hashlib.algorithms_available:
+        raise ValueError('Hash algorithm is not supported: ' + algorithm)
+    return name
+
+
+# this function converts expected hash to (hashlib name of algorithm, hex digest).
+# expected_hash can be 'sha-256=<hex digest>', 'sha256:<hex digest>' or value of Digest header
+# e.g. 'SHA-256=<base64 digest>'. If Digest header contains some digests, the first supported one is used.
+# It raises ValueError if expected_hash is not valid.
+def parseExpectedHash(expected_hash):
+    error = None
+    for item in expected_hash.split(','):
+        item = item.strip()
+        separators = [index for index in (item.find('='), item.find(':')) if index != -1]
+        if not separators:
+            error = 'Expected hash must be in algorithm=digest format: ' + item
+            continue
+
+        index = min(separators)
+        try:
+            algorithm = hashAlgorithmName(item[:index])
+        except ValueError as e:
+            error = str(e)
+            continue
+
+        value = item[index + 1:].strip()
+        digest_size = hashlib.new(algorithm).digest_size
+
+        # digest is in hex or base64 format.
+        try:
+            if len(value) == digest_size * 2:
+                digest = binascii.unhexlify(value)
+            else:
+                digest = base64.b64decode(value, validate=True)
+        except (binascii.Error, ValueError):
+            digest = b''
+
+        if len(digest) != digest_size:
+            error = 'Expected hash is not a valid ' + algorithm + ' digest: ' + value
+            continue
+
+        return algorithm, binascii.hexlify(digest).decode()
+
+    raise ValueError(error or 'Expected hash is empty.')
+
+
+# PartHasher calculates digest of a part while the part is downloading.
+# Bytes are added in order from the start of part, so size is the number of hashed bytes of part.
+# Connections of a hedged part update the same part. So updates must be done under lock.
+class PartHasher():
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hash = hashlib.new(self.algorithm)
+        self.size = 0
+
+    def update(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+# FileVerifier calculates digest of the whole file in order of bytes and compares it with expected digest.
+# Digest of file can't be calculated from digests of parts, so bytes must be hashed from the start of file.
+# position is the number of hashed bytes from the start of file.
+# Data that is received at position is hashed immediately by feed method.
+# Other data is hashed later by hashFile method, which reads it from download file.
+class FileVerifier():
+    def __init__(self, algorithm, expected_digest):
+        self.algorithm = algorithm
+        self.expected_digest = expected_digest
+        self.hash = hashlib.new(algorithm)
+        self.position = 0
+        self.lock = threading.Lock()
+
+    # hash data that is written at offset, if it continues the hashed bytes.
+    def feed(self, offset, data):
+        # data after position is hashed later. So lock is not needed for it.
+        if offset > self.position:
+            return
+
+        with self.lock:
+            if offset <= self.position < offset + len(data):
+                self.hash.update(memoryview(data)[self.position - offset:])
+                self.position = offset + len(data)
+
+    # hash bytes from position to end. read_function(offset, size) reads bytes of download file.
+    def hashFile(self, read_function, end, block_size=1024**2):
+        while True:
+            with self.lock:
+                if self.position >= end:
+                    return
+
+                data = read_function(self.position, min(block_size, end - self.position))
+                if not data:
+                    return
+
+                self.hash.update(data)
+                self.position += len(data)
+
+    # returns True if hashed bytes match expected digest.
+    def isValid(self):
+        with self.lock:
+            return self.hash.hexdigest() == self.expected_digest
+
+
+# PieceVerifier checks pieces of download file by their expected digests. e.g. pieces of Metalink file.
+# Piece i contains bytes from i * piece_length to (i + 1) * piece_length of file.
+# Pieces are read from download file. So a piece that is corrupted on the network doesn't match its digest,
+# and only the broken pieces are downloaded again.
+class PieceVerifier():
+    def __init__(self, algorithm, piece_length, digest_list):
+        self.algorithm = algorithm
+        self.piece_length = piece_length
+        self.digest_list = digest_list
+
+        # numbers of the pieces that match their digests.
+        self.verified_pieces = set()
+
+        # number of failed checks of every piece. keys are piece numbers.
+        self.failure_dict = {}
+
+    def __len__(self):
+        return len(self.digest_list)
+
+    # this method returns (start, end) of piece. end is not part of piece.
+    def pieceRange(self, piece_number, file_size):
+        start = piece_number * self.piece_length
+        return start, min(start + self.piece_length, file_size)
+
+    # this method returns numbers of the pieces that are not verified and
+    # are inside the ranges. range_list contains (start, end) of ranges in order of start.
+    def uncheckedPieces(self, range_list, file_size):
+        piece_list = []
+        for start, end in range_list:
+            # first piece that starts in the range
+            piece_number = -(-start // self.piece_length)
+            while piece_number < len(self.digest_list):
+                piece_start, piece_end = self.pieceRange(piece_number, file_size)
+                if piece_end > end:
+                    break
+                if piece_number not in self.verified_pieces:
+                    piece_list.append(piece_number)
+                piece_number += 1
+
+        return piece_list
+
+    # this method returns True if piece matches its digest.
+    # read_function(offset, size) reads bytes of download file.
+    def checkPiece(self, piece_number, read_function, file_size, block_size=1024**2):
+        piece_hash = hashlib.new(self.algorithm)
+        start, end = self.pieceRange(piece_number, file_size)
+        while start < end:
+            data = read_function(start, min(block_size, end - start))
+            if not data:
+                break
+            piece_hash.update(data)
+            start += len(data)
+
+        if start == end and piece_hash.hexdigest() == self.digest_list[piece_number]:
+            self.verified_pieces.add(piece_number)
+            return True
+
+        self.failure_dict[piece_number] = self.failure_dict.get(piece_number, 0) + 1
+        return False
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import xml.etree.ElementTree as ElementTree
+from persepolis_lib.integrity import parseExpectedHash
+from persepolis_lib.useful_tools import sendToLog
+
+# namespace of Metalink v4 (RFC 5854)
+metalink_namespace = '{urn:ietf:params:xml:ns:metalink}'
+
+# stronger hash is used if metalink contains some hashes.
+hash_preference_list = ['sha-512', 'sha-384', 'sha-256', 'sha-224', 'sha-1', 'md5']
+
+
+# this function reads a Metalink v4 file and returns a dictionary that contains
+# file_name, file_size, links in order of priority, expected_hash and pieces of the first file.
+# pieces is a dictionary that contains algorithm, length of pieces and hex digests of pieces.
+# file_size, expected_hash and pieces are None if metalink doesn't contain them.
+# It raises ValueError if file is not a valid metalink.
+def readMetalink(metalink_path):
+    try:
+        root = ElementTree.parse(metalink_path).getroot()
+    except ElementTree.ParseError as e:
+        raise ValueError('Metalink error: ' + str(e))
+
+    if root.tag != metalink_namespace + 'metalink':
+        raise ValueError('File is not a Metalink v4 file: ' + metalink_path)
+
+    file_list = root.findall(metalink_namespace + 'file')
+    if not file_list:
+        raise ValueError('Metalink doesn\'t contain any file: ' + metalink_path)
+
+    # Download class downloads one file.
+    if len(file_list) > 1:
+        sendToLog('Metalink contains ' + str(len(file_list)) + ' files. Only the first file is downloaded.', 'ERROR')
+
+    file_element = file_list[0]
+
+    # name of file can't contain directories.
+    file_name = os.path.basename(file_element.get('name', '')) or None
+
+    size_element = file_element.find(metalink_namespace + 'size')
+    if size_element is not None:
+        file_size = int(size_element.text.strip())
+    else:
+        file_size = None
+
+    # links without priority are used after the others. 1 is the highest priority.
+    link_list = []
+    for index, url_element in enumerate(file_element.findall(metalink_namespace + 'url')):
+        if url_element.text and url_element.text.strip():
+            priority = int(url_element.get('priority', 999999))
+            link_list.append((priority, index, url_element.text.strip()))
+
+    if not link_list:
+        raise ValueError('Metalink doesn\'t contain any link: ' + metalink_path)
+
+    hash_dict = {}
+    for hash_element in file_element.findall(metalink_namespace + 'hash'):
+        hash_type = hash_element.get('type', '').strip().lower()
+        if hash_element.text:
+            hash_dict[hash_type] = hash_element.text.strip()
+
+    # hashes that are not supported or not valid are ignored.
+    expected_hash = None
+    for hash_type in hash_preference_list:
+        if hash_type in hash_dict:
+            try:
+                parseExpectedHash(hash_type + '=' + hash_dict[hash_type])
+            except ValueError:
+                continue
+            expected_hash = hash_type + '=' + hash_dict[hash_type]
+            break
+
+    return {'file_name': file_name,
+            'file_size': file_size,
+            'links': [link for priority, index, link in sorted(link_list)],
+            'expected_hash': expected_hash,
+            'pieces': readPieces(file_element)}
+
+
+# this function returns digests of pieces of file element.
+# e.g. <pieces length="1048576" type="sha-256"><hash>...</hash><hash>...</hash></pieces>
+# It returns None if metalink doesn't contain valid pieces.
+def readPieces(file_element):
+    pieces_dict = {}
+    for pieces_element in file_element.findall(metalink_namespace + 'pieces'):
+        hash_type = pieces_element.get('type', '').strip().lower()
+        try:
+            piece_length = int(pieces_element.get('length', ''))
+        except ValueError:
+            continue
+
+        digest_list = [(hash_element.text or '').strip()
+                       for hash_element in pieces_element.findall(metalink_namespace + 'hash')]
+        if piece_length > 0 and digest_list:
+            pieces_dict[hash_type] = (piece_length, digest_list)
+
+    # pieces with a hash that is not supported or not valid are ignored.
+    for hash_type in hash_preference_list:
+        if hash_type not in pieces_dict:
+            continue
+
+        piece_length, digest_list = pieces_dict[hash_type]
+        try:
+            hex_digest_list = [parseExpectedHash(hash_type + '=' + digest)[1] for digest in digest_list]
+        except ValueError:
+            continue
+
+        return {'algorithm': parseExpectedHash(hash_type + '=' + digest_list[0])[0],
+                'length': piece_length,
+                'hashes': hex_digest_list}
+
+    return None
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from persepolis_lib.rate_estimator import RateEstimator
+from persepolis_lib.useful_tools import sendToLog
+
+
+# Mirror keeps download rate, number of connections and failures of a mirror link.
+class Mirror():
+    def __init__(self, link):
+        self.link = link
+        self.rate_estimator = RateEstimator()
+        self.connections = 0
+
+        # number of failures after the last successful part.
+        self.failures = 0
+        self.disabled = False
+
+
+# MirrorList chooses a mirror for every part that is downloaded.
+# Mirrors without connections are chosen first, so rate of every mirror is measured.
+# Otherwise the mirror with the highest rate per connection is chosen.
+# If a mirror limits rate of every client, its rate per connection decreases by adding connections.
+# So connections of every mirror become proportional to its download rate and rates of mirrors add up.
+# Mirrors that fail max_failures times in a row are not used anymore, but the last mirror is always used.
+class MirrorList():
+    def __init__(self, links, max_failures=3):
+        self.mirror_list = [Mirror(link) for link in links]
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mirror_list)
+
+    # this method returns a mirror for downloading a part.
+    # If link is given, mirror of the link is returned. e.g. for the response of GET probe.
+    # leave must be called when the part is finished.
+    def choose(self, link=None):
+        with self.lock:
+            for mirror in self.mirror_list:
+                if mirror.link == link:
+                    mirror.connections += 1
+                    return mirror
+
+            enabled_mirrors = [mirror for mirror in self.mirror_list if not mirror.disabled]
+
+            best_mirror = None
+            best_score = None
+            for mirror in enabled_mirrors:
+                if mirror.connections == 0:
+                    score = (1, -mirror.failures, 0)
+                else:
+                    score = (0, 0, mirror.rate_estimator.getRate() / mirror.connections)
+
+                if best_score is None or score > best_score:
+                    best_mirror = mirror
+                    best_score = score
+
+            best_mirror.connections += 1
+            return best_mirror
+
+    # the connection doesn't download from mirror anymore.
+    def leave(self, mirror):
+        with self.lock:
+            mirror.connections -= 1
+
+    # size bytes are received from mirror.
+    def addData(self, mirror, size):
+        mirror.rate_estimator.add(size)
+
+    # a part is downloaded from mirror successfully.
+    def addSuccess(self, mirror):
+        mirror.failures = 0
+
+    # downloading from mirror failed.
+    def addFailure(self, mirror):
+        with self.lock:
+            mirror.failures += 1
+            if mirror.disabled or mirror.failures < self.max_failures:
+                return
+
+            # the last mirror is not dropped.
+            if len([item for item in self.mirror_list if not item.disabled]) > 1:
+                mirror.disabled = True
+                sendToLog('Mirror is dropped after ' + str(mirror.failures) + ' failures: ' + mirror.link, 'ERROR')
+
+    # this method returns download rate of every mirror in bytes per second.
+    # Rates of dropped mirrors are not returned.
+    def rates(self):
+        return {mirror.link: int(mirror.rate_estimator.getRate())
+                for mirror in self.mirror_list if not mirror.disabled}
@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import mmap
+import os
+import threading
+from persepolis_lib.useful_tools import sendToLog
+
+
+# OutputSink writes received data to the download file.
+# The file is opened once for every download and all threads share its file descriptor.
+# Data is written with os.pwrite at the given offset, so threads don't share a file cursor
+# and don't need to seek before writing.
+# If cache_policy is 'dontneed' or 'direct', written ranges are removed from page cache by posix_fadvise
+# after they are flushed to the disk. So a big download doesn't push other data out of memory.
+class OutputSink():
+    def __init__(self, file_path, cache_policy='default'):
+        self.file_path = file_path
+        self.fd = None
+
+        # os.pwrite is not available on Windows.
+        # lseek and write must be done under lock on Windows.
+        self.has_pwrite = hasattr(os, 'pwrite')
+        self.lock = threading.Lock()
+
+        # os.posix_fadvise is not available on Windows and macOS.
+        self.drop_cache = cache_policy in ['dontneed', 'direct'] and hasattr(os, 'posix_fadvise')
+
+        # list of (offset, end) of the ranges that are written after the last sync.
+        self.written_range_list = []
+        self.written_range_lock = threading.Lock()
+
+    def open(self):
+        self.fd = os.open(self.file_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+
+    # write data at offset. data can be bytes, bytearray or memoryview.
+    def write(self, offset, data):
+        view = memoryview(data)
+        size = len(view)
+
+        # os.pwrite and os.write may write less than len(data).
+        while len(view) > 0:
+            if self.has_pwrite:
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                with self.lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    written = os.write(self.fd, view)
+
+            offset += written
+            view = view[written:]
+
+        if self.drop_cache and size:
+            with self.written_range_lock:
+                self.written_range_list.append((offset - size, offset))
+
+    # read size bytes at offset. It's used for hashing downloaded data.
+    # It returns less bytes at the end of file.
+    def read(self, offset, size):
+        if self.has_pwrite:
+            data = os.pread(self.fd, size, offset)
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                data = os.read(self.fd, size)
+
+        # read data is not needed in page cache after hashing.
+        if self.drop_cache and data:
+            os.posix_fadvise(self.fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+
+        return data
+
+    # wait until data of the previous write calls is written to download file.
+    # Data is written before write returns. see QueuedOutputSink
+    def flush(self):
+        pass
+
+    # flush written data to the disk.
+    def sync(self):
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(self.fd)
+        else:
+            os.fsync(self.fd)
+
+        if self.drop_cache:
+            self.dropCache()
+
+    # remove the ranges that are written before the last sync from page cache.
+    # Adjacent ranges are merged, so one posix_fadvise call is used for every contiguous range.
+    # Pages that are written partially are not removed by the system.
+    def dropCache(self):
+        with self.written_range_lock:
+            written_range_list = sorted(self.written_range_list)
+            self.written_range_list = []
+
+        range_start = None
+        range_end = None
+        for start, end in written_range_list:
+            if range_end is not None and start <= range_end:
+                range_end = max(range_end, end)
+                continue
+
+            if range_end is not None:
+                os.posix_fadvise(self.fd, range_start, range_end - range_start, os.POSIX_FADV_DONTNEED)
+            range_start = start
+            range_end = end
+
+        if range_end is not None:
+            os.posix_fadvise(self.fd, range_start, range_end - range_start, os.POSIX_FADV_DONTNEED)
+
+    def close(self):
+        if self.fd is not None:
+            # data that is written after the last checkpoint is flushed, so it can be removed from page cache.
+            if self.drop_cache and self.written_range_list:
+                try:
+                    self.sync()
+                except OSError as error:
+                    sendToLog('Download file is not synced. ' + str(error), 'ERROR')
+
+            os.close(self.fd)
+            self.fd = None
+
+
+# MmapOutputSink maps the preallocated download file into memory and copies received data into the mapping.
+# So writing a chunk doesn't need a system call. Dirty ranges are tracked in blocks of block_size bytes
+# and sync flushes them with msync. It's called before writing control file, so the control file
+# describes only data that is on the disk.
+# If file can't be mapped, e.g. on 32-bit systems or for very large files, pwrite is used like OutputSink.
+class MmapOutputSink(OutputSink):
+    def __init__(self, file_path, file_size):
+        super().__init__(file_path)
+        self.file_size = file_size
+        self.mapping = None
+
+        # block_size is a multiple of page size, because msync needs page aligned offsets.
+        self.block_size = 1024**2
+        self.dirty_blocks = set()
+        self.dirty_lock = threading.Lock()
+
+    def open(self):
+        super().open()
+        try:
+            if not self.isAllocated():
+                raise ValueError('Disk space of download file is not allocated.')
+            self.mapping = mmap.mmap(self.fd, self.file_size, access=mmap.ACCESS_WRITE)
+        except (OSError, ValueError, OverflowError) as error:
+            self.mapping = None
+            sendToLog('Download file is not memory mapped. pwrite is used. ' + str(error))
+
+    # returns True if disk space of the whole file is allocated.
+    # If disk becomes full, writing into the mapping of a sparse file kills the process with SIGBUS.
+    # So sparse files are written by pwrite.
+    def isAllocated(self):
+        file_stat = os.fstat(self.fd)
+        if self.file_size <= 0 or file_stat.st_size < self.file_size:
+            return False
+
+        # st_blocks is not available on Windows.
+        if not hasattr(file_stat, 'st_blocks'):
+            return True
+
+        return file_stat.st_blocks * 512 >= self.file_size
+
+    def write(self, offset, data):
+        size = len(data)
+        if self.mapping is None or offset + size > self.file_size:
+            return super().write(offset, data)
+
+        if size == 0:
+            return
+
+        self.mapping[offset:offset + size] = data
+
+        with self.dirty_lock:
+            self.dirty_blocks.update(range(offset // self.block_size, ((offset + size - 1) // self.block_size) + 1))
+
+    def read(self, offset, size):
+        if self.mapping is None:
+            return super().read(offset, size)
+
+        return self.mapping[offset:min(offset + size, self.file_size)]
+
+    # flush dirty blocks to the disk. Contiguous blocks are flushed by one msync.
+    def sync(self):
+        if self.mapping is None:
+            return super().sync()
+
+        with self.dirty_lock:
+            dirty_blocks = sorted(self.dirty_blocks)
+            self.dirty_blocks.clear()
+
+        index = 0
+        while index < len(dirty_blocks):
+            first_block = dirty_blocks[index]
+            while index + 1 < len(dirty_blocks) and dirty_blocks[index + 1] == dirty_blocks[index] + 1:
+                index += 1
+
+            start = first_block * self.block_size
+            end = min((dirty_blocks[index] + 1) * self.block_size, self.file_size)
+            self.mapping.flush(start, end - start)
+            index += 1
+
+    # dirty pages of the mapping are written to the disk by the system after closing it, like data of pwrite.
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+        super().close()
+
+
+# QueuedOutputSink writes data to download file in writer threads, so a slow disk doesn't stop receiving data.
+# write() puts data in a queue and returns. If more than max_queue_size bytes are waiting,
+# write() waits until writer threads write some of them. So receiving slows down when disk falls behind.
+# Writer threads take all waiting data, sort it by offset and write adjacent ranges by one os.pwritev call.
+# So chunks of parallel connections become large sequential writes.
+# Every chunk has a sequence number, so flush() waits only for the chunks that are queued before calling it.
+# If writing fails, error_function is called with the error and sync raises it.
+class QueuedOutputSink(OutputSink):
+    def __init__(self, file_path, error_function=None, max_queue_size=32 * 1024**2, writer_threads=1,
+                 cache_policy='default'):
+        super().__init__(file_path, cache_policy=cache_policy)
+        self.error_function = error_function
+        self.max_queue_size = max_queue_size
+        self.number_of_writer_threads = max(int(writer_threads), 1)
+
+        # list of (sequence number, offset, data)
+        self.item_list = []
+        self.queued_size = 0
+        self.next_sequence = 0
+
+        # sequence number of the first chunk of every batch that writer threads are writing.
+        self.writing_sequences = []
+
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer_thread_list = []
+
+        # maximum number of buffers of pwritev and maximum size of every write.
+        self.has_pwritev = hasattr(os, 'pwritev')
+        try:
+            self.iov_max = os.sysconf('SC_IOV_MAX')
+        except (AttributeError, ValueError, OSError):
+            self.iov_max = 1024
+        if self.iov_max <= 0:
+            self.iov_max = 1024
+        self.max_write_size = 16 * 1024**2
+
+    def open(self):
+        super().open()
+        for i in range(0, self.number_of_writer_threads):
+            writer_thread = threading.Thread(target=self.writerThread)
+            writer_thread.daemon = True
+            writer_thread.start()
+            self.writer_thread_list.append(writer_thread)
+
+    # data is copied if it's not bytes, because receive buffer is reused after this. see receiveData
+    def write(self, offset, data):
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        if not data:
+            return
+
+        with self.condition:
+            if self.error is not None:
+                raise self.error
+
+            while self.queued_size >= self.max_queue_size and self.error is None and not self.closed:
+                self.condition.wait()
+
+            self.item_list.append((self.next_sequence, offset, data))
+            self.next_sequence += 1
+            self.queued_size += len(data)
+            self.condition.notify_all()
+
+    # this method returns sequence number of the first chunk that is not written yet.
+    # condition must be acquired before calling this method.
+    def firstUnwrittenSequence(self):
+        sequences = list(self.writing_sequences)
+        if self.item_list:
+            sequences.append(self.item_list[0][0])
+        if sequences:
+            return min(sequences)
+        return self.next_sequence
+
+    def flush(self):
+        with self.condition:
+            last_sequence = self.next_sequence - 1
+            while self.firstUnwrittenSequence() <= last_sequence:
+                self.condition.wait()
+
+    # queued data is written and then flushed to the disk.
+    # It raises the error of writer threads, so control file doesn't save data that is not written.
+    def sync(self):
+        self.flush()
+        if self.error is not None:
+            raise self.error
+        super().sync()
+
+    def read(self, offset, size):
+        self.flush()
+        return super().read(offset, size)
+
+    def writerThread(self):
+        while True:
+            with self.condition:
+                while not self.item_list and not self.closed:
+                    self.condition.wait()
+
+                if not self.item_list:
+                    return
+
+                batch = self.item_list
+                self.item_list = []
+                first_sequence = batch[0][0]
+                self.writing_sequences.append(first_sequence)
+
+            # data is not written after an error. Download is stopped by error_function.
+            if self.error is None:
+                try:
+                    self.writeBatch(batch)
+                except OSError as error:
+                    with self.condition:
+                        self.error = error
+                    if self.error_function is not None:
+                        self.error_function(error)
+
+            with self.condition:
+                self.writing_sequences.remove(first_sequence)
+                self.queued_size -= sum(len(data) for sequence, offset, data in batch)
+                self.condition.notify_all()
+
+    # this method sorts chunks by offset and writes adjacent chunks together.
+    # Overlapping chunks of a hedged part are written separately.
+    def writeBatch(self, batch):
+        batch.sort(key=lambda item: (item[1], item[0]))
+
+        group_offset = None
+        group_end = None
+        group_list = []
+        group_size = 0
+        for sequence, offset, data in batch:
+            if group_list and offset == group_end and len(group_list) < self.iov_max and \
+                    group_size + len(data) <= self.max_write_size:
+                group_list.append(data)
+                group_end += len(data)
+                group_size += len(data)
+                continue
+
+            if group_list:
+                self.writeGroup(group_offset, group_list, group_size)
+
+            group_offset = offset
+            group_end = offset + len(data)
+            group_list = [data]
+            group_size = len(data)
+
+        if group_list:
+            self.writeGroup(group_offset, group_list, group_size)
+
+    # write adjacent chunks at offset.
+    def writeGroup(self, offset, data_list, size):
+        if len(data_list) == 1:
+            super().write(offset, data_list[0])
+            return
+
+        # os.pwritev is not available on Windows and old macOS.
+        if not self.has_pwritev:
+            super().write(offset, b''.join(data_list))
+            return
+
+        written = os.pwritev(self.fd, data_list, offset)
+
+        # pwritev may write less than size.
+        if written < size:
+            super().write(offset + written, memoryview(b''.join(data_list))[written:])
+
+        if self.drop_cache:
+            with self.written_range_lock:
+                self.written_range_list.append((offset, offset + written))
+
+    # queued data is written before closing download file.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        for writer_thread in self.writer_thread_list:
+            writer_thread.join()
+        self.writer_thread_list = []
+
+        super().close()
+
+
+# DirectStream keeps data of one connection until a whole aligned block is received.
+# position is the file offset of the next byte of the connection.
+# buffer contains length bytes that must be written at buffer_start. It's None if stream has no buffer.
+class DirectStream():
+    def __init__(self, position):
+        self.position = position
+        self.buffer = None
+        self.buffer_start = position
+        self.length = 0
+        self.lock = threading.Lock()
+
+
+# DirectOutputSink writes download file with O_DIRECT, so written data doesn't pass through page cache.
+# O_DIRECT needs aligned offsets, sizes and memory. So data of every connection is copied into
+# a page aligned buffer and the buffer is written when it's full.
+# Bytes before the first aligned offset of a connection and bytes at the end of buffer
+# that don't fill a block are written by the normal file descriptor and removed from page cache after sync.
+# So a block is never written by both file descriptors, unless two connections download the same range.
+# Buffers are written at every sync, so the control file describes only data that is on the disk.
+# If file system doesn't support O_DIRECT, data is written like OutputSink with 'dontneed' cache policy.
+class DirectOutputSink(OutputSink):
+    def __init__(self, file_path, buffer_size=1024**2):
+        super().__init__(file_path, cache_policy='direct')
+        self.direct_fd = None
+
+        # use_direct becomes False if O_DIRECT can't be used.
+        # direct_fd is not closed before close(), because other threads may be writing with it.
+        self.use_direct = False
+
+        # mmap.PAGESIZE is a multiple of logical block size of disks.
+        self.alignment = mmap.PAGESIZE
+        self.buffer_size = max(buffer_size // self.alignment, 1) * self.alignment
+
+        # dictionary of streams by their position. So every write continues the stream that ends at its offset.
+        self.stream_dict = {}
+        self.stream_set = set()
+        self.free_buffer_list = []
+        self.stream_lock = threading.Lock()
+
+    def open(self):
+        super().open()
+
+        # O_DIRECT is not available on Windows and macOS.
+        if not hasattr(os, 'O_DIRECT'):
+            sendToLog('O_DIRECT is not supported. Written data is removed from page cache after sync.')
+            return
+
+        try:
+            self.direct_fd = os.open(self.file_path, os.O_WRONLY | os.O_DIRECT)
+            self.use_direct = True
+        except OSError as error:
+            sendToLog('Download file is not opened with O_DIRECT. ' + str(error))
+
+    # mmap returns page aligned memory. Buffers of removed streams are reused.
+    def takeBuffer(self):
+        with self.stream_lock:
+            if self.free_buffer_list:
+                return self.free_buffer_list.pop()
+        return mmap.mmap(-1, self.buffer_size)
+
+    def write(self, offset, data):
+        if not self.use_direct:
+            return super().write(offset, data)
+
+        with self.stream_lock:
+            stream = self.stream_dict.pop(offset, None)
+
+        if stream is None:
+            stream = DirectStream(offset)
+
+        with stream.lock:
+            self.appendData(stream, memoryview(data))
+
+        with self.stream_lock:
+            self.stream_dict[stream.position] = stream
+            self.stream_set.add(stream)
+
+    # stream.lock must be acquired before calling this method.
+    def appendData(self, stream, view):
+        while len(view) > 0:
+            if stream.length == 0:
+                # bytes before the next aligned offset are written by the normal file descriptor.
+                head_size = (-stream.position) % self.alignment
+                if head_size:
+                    head_size = min(head_size, len(view))
+                    super().write(stream.position, view[:head_size])
+                    stream.position += head_size
+                    view = view[head_size:]
+                    continue
+
+                stream.buffer_start = stream.position
+                if stream.buffer is None:
+                    stream.buffer = self.takeBuffer()
+
+            size = min(self.buffer_size - stream.length, len(view))
+            stream.buffer[stream.length:stream.length + size] = view[:size]
+            stream.length += size
+            stream.position += size
+            view = view[size:]
+
+            if stream.length == self.buffer_size:
+                self.writeBuffer(stream)
+
+    # write data of stream buffer. Aligned blocks are written with O_DIRECT and the rest normally.
+    # stream.lock must be acquired before calling this method.
+    def writeBuffer(self, stream):
+        buffer_view = memoryview(stream.buffer)
+        direct_size = (stream.length // self.alignment) * self.alignment
+
+        written = 0
+        while written < direct_size and self.use_direct:
+            try:
+                size = os.pwrite(self.direct_fd, buffer_view[written:direct_size], stream.buffer_start + written)
+            except OSError as error:
+                # Some file systems accept O_DIRECT in open but need bigger alignment for writing.
+                if error.errno != errno.EINVAL:
+                    raise
+                sendToLog('O_DIRECT write failed. Download file is written normally. ' + str(error))
+                self.use_direct = False
+                break
+
+            if size % self.alignment:
+                # the rest isn't aligned anymore.
+                written += size
+                break
+            written += size
+
+        if written < stream.length:
+            super().write(stream.buffer_start + written, buffer_view[written:stream.length])
+
+        stream.buffer_start = stream.position
+        stream.length = 0
+
+    # write buffers of all streams. Streams are removed after writing and their buffers are reused.
+    # A stream is removed under its lock, so data that is added to it after this is not lost.
+    def writeStreams(self):
+        with self.stream_lock:
+            stream_list = list(self.stream_set)
+
+        for stream in stream_list:
+            with stream.lock:
+                if stream.length:
+                    self.writeBuffer(stream)
+
+                with self.stream_lock:
+                    self.stream_set.discard(stream)
+                    if self.stream_dict.get(stream.position) is stream:
+                        del self.stream_dict[stream.position]
+                    if stream.buffer is not None:
+                        self.free_buffer_list.append(stream.buffer)
+
+                stream.buffer = None
+
+    def read(self, offset, size):
+        self.writeStreams()
+        return super().read(offset, size)
+
+    def sync(self):
+        self.writeStreams()
+        super().sync()
+
+    def close(self):
+        if self.fd is not None:
+            self.writeStreams()
+
+        super().close()
+
+        if self.direct_fd is not None:
+            os.close(self.direct_fd)
+            self.direct_fd = None
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import threading
+from persepolis_lib.part_table import PartStatus
+
+
+# PartScheduler gives parts to download threads.
+# Pending part numbers are kept in a heap, so the lowest pending part is given first
+# and claiming a part costs O(log n).
+# All changes are made under a threading.Condition, so one part never goes to two threads.
+# If no part is pending, claim() splits the downloading part with the biggest remaining range
+# and gives the upper half to the caller (work stealing).
+# If no part can be splitted and end_game is True, claim() gives the downloading part that finishes last
+# to the caller too (hedged request). Both connections download the rest of the part
+# and the first connection that finishes it wins.
+# If no part can be splitted but some parts are still downloading, claim() waits,
+# because a downloading part may fail and become pending again.
+class PartScheduler():
+    def __init__(self, part_table, retry, min_split_size=None, end_game=False, rate_function=None,
+                 split_function=None):
+        # part_table is shared with Download object. see part_table.py
+        self.part_table = part_table
+        self.retry = retry
+
+        # parts smaller than min_split_size * 2 are not splitted.
+        # If min_split_size is None, parts are never splitted and end game is not used.
+        self.min_split_size = min_split_size
+
+        # rate_function returns download rate of part in bytes per second.
+        # It's used for finding the slowest part in end game.
+        self.end_game = end_game
+        self.rate_function = rate_function
+
+        # split_function is called with the number and the new end of the splitted part,
+        # before the new part is given to the caller. It returns the new end or None if the part must not be splitted.
+        # The new end can be after the given end, if the connection of the part has received those bytes.
+        self.split_function = split_function
+
+        # parts with less remaining bytes are not downloaded by a second connection.
+        self.min_hedge_size = 64 * 1024
+
+        # numbers of the parts that are downloading by two connections.
+        self.hedged_parts = set()
+
+        self.condition = threading.Condition()
+        self.pending_heap = []
+        # numbers of the parts with 'downloading' status
+        self.downloading_parts = set()
+        self.number_of_completed_parts = 0
+        self.stopped = False
+
+        # numbers of the parts that are changed since the last checkpoint. see takeDirtyParts
+        self.dirty_parts = set()
+
+        # finished_event is set when no part is pending or downloading, or scheduler is stopped.
+        # So download is finished the moment the last part is complete.
+        self.finished_event = threading.Event()
+
+        for i in range(0, len(self.part_table)):
+            if self.part_table.status[i] == PartStatus.COMPLETE:
+                self.number_of_completed_parts += 1
+            else:
+                self.pushPart(i)
+
+        self.checkFinished()
+
+    # add part to pending heap if retry limit is not reached.
+    # condition must be acquired before calling this method.
+    def pushPart(self, part_number):
+        if self.part_table.retry[part_number] <= self.retry:
+            self.part_table.status[part_number] = PartStatus.PENDING
+            heapq.heappush(self.pending_heap, part_number)
+
+    # this method returns number of a pending part and sets 'downloading' status for it.
+    # It returns None, if download is stopped or no part remains for downloading.
+    # If block is False, it returns None immediately if no part is pending.
+    def claim(self, block=True):
+        with self.condition:
+            while not self.stopped:
+                if self.pending_heap:
+                    part_number = heapq.heappop(self.pending_heap)
+
+                    # set 'downloding' status for this part
+                    self.part_table.status[part_number] = PartStatus.DOWNLOADING
+                    # add 1 to retry number for this part
+                    self.part_table.retry[part_number] += 1
+
+                    # number of retries can't be less than 0
+                    if self.part_table.retry[part_number] < 0:
+                        self.part_table.retry[part_number] = 0
+
+                    self.downloading_parts.add(part_number)
+                    self.dirty_parts.add(part_number)
+                    return part_number
+
+                # nothing is pending. So split a downloading part.
+                part_number = self.splitPart()
+                if part_number is not None:
+                    self.downloading_parts.add(part_number)
+                    return part_number
+
+                # no part can be splitted. So download the slowest part by a second connection.
+                part_number = self.hedgePart()
+                if part_number is not None:
+                    return part_number
+
+                # nothing is pending and nothing can fail and return to heap.
+                if not self.downloading_parts or not block:
+                    return None
+
+                # wait until a part is released or completed.
+                self.condition.wait()
+
+            return None
+
+    # this method splits the downloading part with the biggest remaining range at its midpoint.
+    # The end of that part moves to the midpoint and the upper half becomes a new part.
+    # It returns number of the new part or None.
+    # condition must be acquired before calling this method.
+    def splitPart(self):
+        if self.min_split_size is None:
+            return None
+
+        biggest_part = None
+        biggest_remaining = 0
+        for part_number in self.downloading_parts:
+            remaining = self.part_table.remaining(part_number)
+            if remaining > biggest_remaining:
+                biggest_part = part_number
+                biggest_remaining = remaining
+
+        if biggest_part is None or biggest_remaining < (2 * self.min_split_size):
+            return None
+
+        middle = self.part_table.start[biggest_part] + self.part_table.downloaded[biggest_part] + (biggest_remaining // 2)
+
+        if self.split_function is not None:
+            middle = self.split_function(biggest_part, middle)
+            if middle is None:
+                return None
+
+        # new part starts from middle and it's downloading by the caller.
+        # Retry number is 0, because it's the first try.
+        new_part_number = self.part_table.addPart(middle, self.part_table.end[biggest_part],
+                                                  status=PartStatus.DOWNLOADING, retry=0)
+
+        # Now reduce end of the splitted part.
+        self.part_table.end[biggest_part] = middle
+
+        # both parts are changed by splitting.
+        self.dirty_parts.add(biggest_part)
+        self.dirty_parts.add(new_part_number)
+
+        return new_part_number
+
+    # this method returns the downloading part that finishes last and saves that it's hedged.
+    # Finish time is calculated from remaining bytes and rate of part.
+    # A part is not downloaded by more than two connections.
+    # condition must be acquired before calling this method.
+    def hedgePart(self):
+        if not self.end_game or self.min_split_size is None:
+            return None
+
+        slowest_part = None
+        slowest_finish_time = -1
+        for part_number in self.downloading_parts:
+            if part_number in self.hedged_parts or self.part_table.end[part_number] == -1:
+                continue
+
+            remaining = self.part_table.remaining(part_number)
+            if remaining < self.min_hedge_size:
+                continue
+
+            rate = 0
+            if self.rate_function is not None:
+                rate = self.rate_function(part_number)
+
+            # A part without rate is stalled. So it finishes last.
+            if rate > 0:
+                finish_time = remaining / rate
+            else:
+                finish_time = float('inf')
+
+            if finish_time > slowest_finish_time:
+                slowest_part = part_number
+                slowest_finish_time = finish_time
+
+        if slowest_part is not None:
+            self.hedged_parts.add(slowest_part)
+
+        return slowest_part
+
+    # download thread calls this method after writing size bytes of part at offset.
+    # Downloaded bytes of part are from the start of part to the farthest written byte.
+    # So bytes that are written again by the second connection of a hedged part are not counted.
+    # The part may be splitted during writing, so the size is limited to the end of part.
+    # It returns number of the new downloaded bytes.
+    def updatePart(self, part_number, offset, size):
+        with self.condition:
+            downloaded = offset + size - self.part_table.start[part_number]
+            if self.part_table.end[part_number] != -1:
+                downloaded = min(downloaded, self.part_table.partSize(part_number))
+
+            update_size = max(downloaded - self.part_table.downloaded[part_number], 0)
+            if update_size:
+                self.part_table.downloaded[part_number] += update_size
+                self.dirty_parts.add(part_number)
+            return update_size
+
+    # this method returns a copy of part_table.
+    # All parts are saved with the snapshot, so no part is dirty after this.
+    def snapshot(self):
+        with self.condition:
+            self.dirty_parts.clear()
+            return self.part_table.copy()
+
+    # this method returns information of the parts that are changed since the last call
+    # as a list of (part_number, start, end, downloaded, retry, status) in order of part numbers.
+    def takeDirtyParts(self):
+        with self.condition:
+            records = [(part_number,
+                        self.part_table.start[part_number],
+                        self.part_table.end[part_number],
+                        self.part_table.downloaded[part_number],
+                        self.part_table.retry[part_number],
+                        self.part_table.status[part_number]) for part_number in sorted(self.dirty_parts)]
+            self.dirty_parts.clear()
+            return records
+
+    # download thread calls this method when part downloaded completely.
+    # It returns False if the part is completed by another connection before.
+    def complete(self, part_number):
+        with self.condition:
+            if self.part_table.status[part_number] == PartStatus.COMPLETE:
+                return False
+
+            self.part_table.status[part_number] = PartStatus.COMPLETE
+            self.downloading_parts.discard(part_number)
+            self.hedged_parts.discard(part_number)
+            self.dirty_parts.add(part_number)
+            self.number_of_completed_parts += 1
+            self.checkFinished()
+            self.condition.notify_all()
+            return True
+
+    # download thread calls this method when downloading of part is not finished.
+    # status can be PartStatus.ERROR or PartStatus.STOPPED.
+    # Parts with ERROR status will be given to threads again if retry limit is not reached.
+    # If another connection downloads the part (hedged part), the part stays downloading.
+    def release(self, part_number, status=PartStatus.ERROR):
+        with self.condition:
+            if self.part_table.status[part_number] == PartStatus.COMPLETE:
+                return
+
+            if part_number in self.hedged_parts:
+                self.hedged_parts.discard(part_number)
+                self.condition.notify_all()
+                return
+
+            self.part_table.status[part_number] = status
+            self.downloading_parts.discard(part_number)
+            self.dirty_parts.add(part_number)
+            if status != PartStatus.STOPPED:
+                self.pushPart(part_number)
+            self.checkFinished()
+            self.condition.notify_all()
+
+    # this method downloads complete parts again from their start.
+    # It's used when download file doesn't match expected hash.
+    def reopen(self, part_numbers):
+        with self.condition:
+            for part_number in part_numbers:
+                if self.part_table.status[part_number] == PartStatus.COMPLETE:
+                    self.number_of_completed_parts -= 1
+
+                self.part_table.downloaded[part_number] = 0
+                self.part_table.retry[part_number] = -1
+                self.dirty_parts.add(part_number)
+                self.pushPart(part_number)
+
+            if self.pending_heap:
+                self.finished_event.clear()
+            self.condition.notify_all()
+
+    # this method downloads bytes from start to end again. e.g. a piece that doesn't match its digest.
+    # Complete parts that overlap the range are splitted at the bounds of range.
+    # Bytes outside the range stay complete and parts inside the range are downloaded again.
+    # Parts that are not complete are not changed.
+    # It returns numbers of the parts that are changed.
+    def reopenRange(self, start, end):
+        with self.condition:
+            changed_parts = []
+            reopened_parts = []
+            for part_number in range(0, len(self.part_table)):
+                part_start = self.part_table.start[part_number]
+                part_end = self.part_table.end[part_number]
+                if self.part_table.status[part_number] != PartStatus.COMPLETE or part_end <= start or part_start >= end:
+                    continue
+
+                changed_parts.append(part_number)
+
+                # bytes before start stay in this part and the rest of the part becomes a new part.
+                if part_start < start:
+                    self.part_table.end[part_number] = start
+                    self.part_table.downloaded[part_number] = start - part_start
+                    self.dirty_parts.add(part_number)
+
+                    part_number = self.part_table.addPart(start, part_end, downloaded=part_end - start,
+                                                          status=PartStatus.COMPLETE, retry=0)
+                    self.number_of_completed_parts += 1
+                    changed_parts.append(part_number)
+                    part_start = start
+
+                # bytes after end become a new complete part.
+                if part_end > end:
+                    self.part_table.end[part_number] = end
+                    self.part_table.downloaded[part_number] = end - part_start
+
+                    new_part_number = self.part_table.addPart(end, part_end, downloaded=part_end - end,
+                                                              status=PartStatus.COMPLETE, retry=0)
+                    self.dirty_parts.add(new_part_number)
+                    self.number_of_completed_parts += 1
+                    changed_parts.append(new_part_number)
+
+                reopened_parts.append(part_number)
+
+            self.reopen(reopened_parts)
+            return changed_parts
+
+    # this method returns (start, end) of contiguous ranges of complete parts in order of start.
+    def completeRanges(self):
+        with self.condition:
+            range_list = []
+            for start, end, part_number in sorted((self.part_table.start[part_number],
+                                                   self.part_table.end[part_number],
+                                                   part_number) for part_number in range(0, len(self.part_table))):
+                if self.part_table.status[part_number] != PartStatus.COMPLETE:
+                    continue
+
+                if range_list and range_list[-1][1] == start:
+                    range_list[-1] = (range_list[-1][0], end)
+                else:
+                    range_list.append((start, end))
+
+            return range_list
+
+    # this method returns (start, end of downloaded bytes, end, part_number) of all parts in order of start.
+    def downloadedRanges(self):
+        with self.condition:
+            return sorted((self.part_table.start[part_number],
+                           self.part_table.start[part_number] + self.part_table.downloaded[part_number],
+                           self.part_table.end[part_number],
+                           part_number) for part_number in range(0, len(self.part_table)))
+
+    # wake up all waiting threads and don't give any part after this.
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.finished_event.set()
+            self.condition.notify_all()
+
+    # set finished_event if no part is pending or downloading.
+    # condition must be acquired before calling this method.
+    def checkFinished(self):
+        if not self.pending_heap and not self.downloading_parts:
+            self.finished_event.set()
+
+    # returns True if some parts are downloading now.
+    # A downloading part may fail and become pending again.
+    def hasDownloadingParts(self):
+        with self.condition:
+            return len(self.downloading_parts) > 0
+
+    # returns True if no part is pending or downloading.
+    # So download is complete or retry limit is reached for all uncomplete parts.
+    def isFinished(self):
+        with self.condition:
+            return not self.pending_heap and not self.downloading_parts
+
+    # returns True if all parts downloaded completely.
+    def isComplete(self):
+        return self.number_of_completed_parts == len(self.part_table)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from enum import IntEnum
+import base64
+import sys
+
+
+# download status of every part
+class PartStatus(IntEnum):
+    PENDING = 0
+    DOWNLOADING = 1
+    COMPLETE = 2
+    ERROR = 3
+    STOPPED = 4
+
+
+# PartTable contains information of download parts.
+# Every column is an array, so thousands of parts need only a few bytes per part.
+# start: start byte number of the part.
+# end: end byte number of the part. It's not part of this part and it's start byte number of the next part.
+#      end is -1 if file size is unspecified.
+# downloaded: downloaded size of the part.
+# retry: number of retrying for the part. It's -1 for new parts, because part_scheduler adds 1 to it in the first claim.
+# status: PartStatus value of the part.
+class PartTable():
+    columns = ['start', 'end', 'downloaded', 'retry', 'status']
+
+    def __init__(self):
+        self.start = array('q')
+        self.end = array('q')
+        self.downloaded = array('q')
+        self.retry = array('q')
+        self.status = array('b')
+
+    def __len__(self):
+        return len(self.start)
+
+    # add new part to the table and return its number.
+    def addPart(self, start, end, downloaded=0, status=PartStatus.PENDING, retry=-1):
+        self.start.append(start)
+        self.end.append(end)
+        self.downloaded.append(downloaded)
+        self.retry.append(retry)
+        self.status.append(status)
+        return len(self.start) - 1
+
+    # size of part. It's None if file size is unspecified.
+    def partSize(self, part_number):
+        if self.end[part_number] == -1:
+            return None
+        return self.end[part_number] - self.start[part_number]
+
+    # size of the part that is not downloaded yet.
+    def remaining(self, part_number):
+        return self.end[part_number] - self.start[part_number] - self.downloaded[part_number]
+
+    def totalDownloaded(self):
+        return sum(self.downloaded)
+
+    def copy(self):
+        table = PartTable()
+        for column in self.columns:
+            setattr(table, column, array(getattr(self, column).typecode, getattr(self, column)))
+        return table
+
+    # convert table to a dictionary for saving in control file.
+    # Every column is saved as base64 string of its little-endian bytes.
+    def toDict(self):
+        table_dict = {}
+        for column in self.columns:
+            column_array = getattr(self, column)
+            if sys.byteorder != 'little':
+                column_array = array(column_array.typecode, column_array)
+                column_array.byteswap()
+            table_dict[column] = base64.b64encode(column_array.tobytes()).decode('ascii')
+        return table_dict
+
+    # create table from the dictionary that is created by toDict.
+    @classmethod
+    def fromDict(cls, table_dict):
+        table = cls()
+        for column in cls.columns:
+            column_array = getattr(table, column)
+            column_array.frombytes(base64.b64decode(table_dict[column]))
+            if sys.byteorder != 'little':
+                column_array.byteswap()
+        return table
+
+    # create table from download_infromation_list of older control files.
+    # Every item is [start, downloaded size, status, retry] or [start, downloaded size, status, retry, end].
+    # end of the parts without end byte number is start of the next part.
+    @classmethod
+    def fromList(cls, download_infromation_list, number_of_parts, file_size):
+        table = cls()
+        for i in range(0, number_of_parts):
+            part = download_infromation_list[i]
+            if len(part) > 4:
+                end = part[4]
+            elif i < (number_of_parts - 1):
+                end = download_infromation_list[i + 1][0]
+            else:
+                end = file_size
+
+            if end is None:
+                end = -1
+
+            if part[2] == 'complete':
+                status = PartStatus.COMPLETE
+            else:
+                status = PartStatus.PENDING
+
+            table.addPart(part[0], end, part[1], status, part[3])
+        return table
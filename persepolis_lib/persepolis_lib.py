@@ -14,24 +14,35 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import requests
 import time
-import random
 import threading
 import os
 import errno
-from persepolis_lib.useful_tools import convertTime, humanReadableSize, convertSize, sendToLog, convertHeaderToDictionary, readCookieJar, getFileNameFromLink, freeSpace, returnNewFileName
+from persepolis_lib.useful_tools import convertTime, humanReadableSize, convertSize, sendToLog, convertHeaderToDictionary, readCookieJar, getFileNameFromLink, freeSpace, returnNewFileName, allocateFile, parseContentRange
+from persepolis_lib.part_scheduler import PartScheduler
+from persepolis_lib.part_table import PartTable, PartStatus
+from persepolis_lib.output_sink import OutputSink, MmapOutputSink, QueuedOutputSink, DirectOutputSink
+from persepolis_lib.buffer_pool import BufferPool
+from persepolis_lib.rate_limiter import TokenBucket
+from persepolis_lib.control_journal import ControlJournal
+from persepolis_lib.download_observer import ObserverList
+from persepolis_lib.rate_estimator import RateEstimator
+from persepolis_lib.connection_controller import ConnectionController
+from persepolis_lib.integrity import PartHasher, FileVerifier, PieceVerifier, hashAlgorithmName, parseExpectedHash
+from persepolis_lib.mirror_list import MirrorList
 import sys
 import json
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
 
 class Download():
     version = '1.1.2'
 
     def __init__(self, add_link_dictionary, number_of_threads=64,
-                 python_request_chunk_size=100, timeout=10, retry=5, retry_wait=5, progress_bar=False, threads_progress_bar=False):
+                 python_request_chunk_size=100, timeout=10, retry=5, retry_wait=5, progress_bar=False, threads_progress_bar=False,
+                 file_allocation='fallocate', part_size=None, adaptive_connections=False,
+                 end_game=False, lowest_speed_limit=0, lowest_speed_time=10, hash_algorithm=None, probe='head',
+                 connect_concurrency=16, connect_rate=0, receive_mode='iter_content',
+                 write_mode='pwrite', cache_policy='default'):
         self.python_request_chunk_size = python_request_chunk_size
         self.progress_bar = progress_bar
         self.threads_progress_bar = threads_progress_bar
@@ -41,6 +52,25 @@ class Download():
         self.resume = False
         self.download_speed_str = "0"
 
+        # observers are notified about progress, parts and status of download. see addObserver method.
+        self.observers = ObserverList()
+
+        # stop_event is set when download is complete, stopped or failed.
+        # Helper threads wait on it, so they exit immediately after download is finished.
+        self.stop_event = threading.Event()
+
+        # finished_event is set when download is finished and closed.
+        # Call finished_event.wait() instead of polling tellStatus.
+        self.finished_event = threading.Event()
+
+        # resume_event is cleared while download is paused. Paused threads wait on it.
+        # connection_condition is notified when download status or number of connections is changed
+        # or download is finished. Threads that are more than the number of connections wait on it.
+        # see wakeUpWaiters
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+        self.connection_condition = threading.Condition()
+
         # download_status can be in waiting, downloading, stop, error, paused, creating download file
         self.download_status = 'waiting'
         self.file_name = '***'
@@ -48,6 +78,77 @@ class Download():
 
         self.link = add_link_dictionary['link']
         self.name = add_link_dictionary['out']
+        self.expected_hash = add_link_dictionary.get('expected_hash')
+
+        # pieces contains algorithm, length of pieces and hex digests of pieces of file.
+        # e.g. {'algorithm': 'sha256', 'length': 1048576, 'hashes': [...]}
+        self.pieces = add_link_dictionary.get('pieces')
+
+        # If metalink is set, links, file name, file size, expected hash and pieces are read from Metalink file.
+        # see metalink.py
+        self.metalink_file_size = None
+        if add_link_dictionary.get('metalink'):
+            from persepolis_lib.metalink import readMetalink
+            metalink_dict = readMetalink(add_link_dictionary['metalink'])
+            self.link = metalink_dict['links']
+            self.metalink_file_size = metalink_dict['file_size']
+            if not self.name:
+                self.name = metalink_dict['file_name']
+            if not self.expected_hash:
+                self.expected_hash = metalink_dict['expected_hash']
+            if not self.pieces:
+                self.pieces = metalink_dict['pieces']
+
+        # link can be a list of mirror links of the same file.
+        # The first link that responds is the main link and the other mirrors are checked by checkMirrors.
+        if isinstance(self.link, str):
+            self.mirror_links = [self.link]
+        else:
+            self.mirror_links = list(self.link)
+            self.link = self.mirror_links[0]
+
+        # mirror_list chooses a mirror for every part. see mirror_list.py
+        self.mirror_list = None
+
+        # probe can be 'head' or 'get'.
+        # 'head' sends a HEAD request for getting file information.
+        # 'get' sends a GET request with 'Range: bytes=0-' instead and reads file size from Content-Range.
+        # Its response is used for downloading part 0, so no extra request is sent. see takeProbeResponse
+        self.probe = probe
+        self.probe_response = None
+        self.probe_status = None
+        self.probe_lock = threading.Lock()
+
+        # final link of the main link after redirects. Connections of download threads are opened to it
+        # while download file is created, if warm_up is True. see warmUpConnections
+        self.warm_up_link = None
+        self.warm_up = True
+
+        # threads that are started by warmUpConnections and parts_ready_event that is set when parts are defined.
+        self.warm_up_thread_list = []
+        self.parts_ready_event = threading.Event()
+
+        # At most connect_concurrency connections are opened at the same time
+        # and at most connect_rate connections are opened every second. 0 means no limit.
+        # see ConnectionGate in http_adapter.py
+        self.connect_concurrency = connect_concurrency
+        self.connect_rate = connect_rate
+        self.connection_gate = None
+
+        # receive_mode can be 'iter_content' or 'readinto'. see receiveData
+        # 'readinto' reads response into buffers of buffer_pool, so a bytes object is not created for every chunk.
+        # Size of every read grows with download rate of connection up to receive_buffer_size.
+        self.receive_mode = receive_mode
+        self.receive_buffer_size = 1024**2
+        self.receive_interval = 0.05
+        self.buffer_pool = None
+
+        # write_mode can be 'pwrite', 'mmap' or 'queue'. see createOutputSink
+        self.write_mode = write_mode
+        self.write_queue_size = 32 * 1024**2
+
+        # cache_policy can be 'default', 'dontneed' or 'direct'. see createOutputSink
+        self.cache_policy = cache_policy
         self.download_path = add_link_dictionary['download_path']
         self.ip = add_link_dictionary['ip']
         self.port = add_link_dictionary['port']
@@ -61,15 +162,75 @@ class Download():
         self.referer = add_link_dictionary['referer']
         self.proxy_type = add_link_dictionary['proxy_type']
         self.check_certificate = add_link_dictionary['check_certificate']
+
+        # If expected_hash is set, download file is verified by it. e.g. 'sha-256=<hex digest>'
+        # see parseExpectedHash in integrity.py
+        # Every part is hashed while downloading and digests of complete parts are saved in control file.
+        # If hash_algorithm is set, parts are hashed by it, even if expected_hash is not set.
+        self.expected_digest = None
+        if self.expected_hash:
+            self.hash_algorithm, self.expected_digest = parseExpectedHash(self.expected_hash)
+        elif hash_algorithm:
+            self.hash_algorithm = hashAlgorithmName(hash_algorithm)
+        else:
+            self.hash_algorithm = None
+
+        # hashers of downloading parts. keys are part numbers. It's None if parts are not hashed.
+        self.part_hasher_dict = None
+
+        # digests of complete parts. keys are part numbers.
+        self.part_digest_dict = {}
+
+        # file_verifier hashes the whole file for comparing with expected_hash. see integrity.py
+        self.file_verifier = None
+
+        # piece_verifier checks pieces of download file by digests of pieces. see integrity.py
+        self.piece_verifier = None
+
+        # hash_verified is None until download file is verified.
+        self.hash_verified = None
+        self.verify_attempts = 0
+
+        # data that is not hashed while downloading and complete pieces are read from download file
+        # by verify thread. verify_read_size is the maximum bytes that are read every second.
+        self.verify_read_size = 64 * 1024**2
+        # verify thread and verifyDownload don't check download file at the same time.
+        self.verify_lock = threading.Lock()
         self.number_of_parts = 0
         self.timeout = timeout
         self.retry = retry
         self.retry_wait = retry_wait
-        self.lock = False
         self.sleep_for_speed_limiting = 0
+
+        # speed_limiter is shared between all connections of download. see limitSpeed method.
+        self.speed_limiter = TokenBucket()
+
+        # tokens that are reserved for the first read of connections. keys are thread numbers.
+        # see reserveFirstRead
+        self.reserved_tokens = {}
         self.not_converted_download_speed = 0
         self.download_percent = 0
 
+        # rate_estimator calculates smoothed download rate. see rate_estimator.py
+        self.rate_estimator = RateEstimator()
+
+        # rate estimators of connections. keys are thread numbers.
+        self.connection_rate_dict = {}
+
+        # rate estimators of downloading parts. keys are part numbers.
+        self.part_rate_dict = {}
+
+        # estimated seconds until the end of download. It's None if it's unknown.
+        self.eta_second = None
+
+        # part_size in MiB. If it's None, file is divided into 64 parts.
+        # Parts are not smaller than 1 MiB.
+        self.part_size = part_size
+
+        # file_allocation can be fallocate, sparse or zero.
+        # see allocateFile function in useful_tools.
+        self.file_allocation = file_allocation
+
         # number_of_threads can't be more that 64
         if number_of_threads <= 64:
             self.number_of_threads = int(number_of_threads)
@@ -78,21 +239,134 @@ class Download():
 
         self.number_of_active_connections = self.number_of_threads
 
+        # If adaptive_connections is True, download starts with a few connections and
+        # connection_controller adds connections while download rate grows.
+        # number_of_threads is the maximum number of connections. see connection_controller.py
+        self.adaptive_connections = adaptive_connections
+        self.connection_controller = None
+
+        # connection_controller is updated every adaptive_interval seconds.
+        self.adaptive_interval = 2
+        self.last_adaptive_time = 0
+        self.last_adaptive_size = 0
+        self.last_number_of_errors = 0
+
         self.thread_list = []
+        self.download_thread_list = []
 
         # this dictionary contains information about each part is downloaded by which thread.
         self.part_thread_dict = {}
 
+        # If end_game is True, threads that have nothing to download, download the rest of
+        # the slowest parts too and the first thread that finishes the part wins.
+        # hedge_thread_dict contains the second thread of these parts.
+        self.end_game = end_game
+        self.hedge_thread_dict = {}
+
+        # connections that download slower than lowest_speed_limit (bytes per second) for lowest_speed_time seconds
+        # are dropped and their parts are downloaded by new connections. 0 means no limit.
+        self.lowest_speed_limit = lowest_speed_limit
+        self.lowest_speed_time = lowest_speed_time
+
+        # keys are thread numbers and values are (number of downloading part, time of starting the part).
+        self.connection_part_dict = {}
+
+        # time that download rate of connection became lower than lowest_speed_limit.
+        self.slow_connection_dict = {}
+
+        # part_scheduler gives parts to download threads. see part_scheduler.py
+        self.part_scheduler = None
+
+        # output_sink writes received data to download file. see output_sink.py
+        self.output_sink = None
+
+        # control_journal saves changed parts in journal file. see control_journal.py
+        self.control_journal = None
+
+        # requests session is created by createSession.
+        self.requests_session = None
+
+        # http_adapter is mounted to requests session by createSession. see http_adapter.py
+        self.http_adapter = None
+
+        # If shared_pool_manager is set, connections are kept in it and they are opened through its connection_gate.
+        # DownloadManager shares one pool manager between its downloads.
+        self.shared_pool_manager = None
+
+        # connection_statistics counts new and reused connections. see http_adapter.py
+        self.connection_statistics = None
+
+        # If a thread has nothing to download, part_scheduler splits the biggest downloading part.
+        # Parts are not splitted into pieces that are smaller than min_split_size.
+        self.min_split_size = 1024**2
+
+    # download_status is a property, so observers are notified when status is changed.
+    @property
+    def download_status(self):
+        return self._download_status
+
+    @download_status.setter
+    def download_status(self, status):
+        previous_status = getattr(self, '_download_status', None)
+        self._download_status = status
+
+        if status in ['complete', 'error', 'stopped']:
+            self.stop_event.set()
+
+        if status != previous_status:
+            self.observers.notify('on_state_change', status)
+
+        self.wakeUpWaiters()
+
+    # this method wakes up threads or tasks that wait for changing of download status
+    # or number of connections or the end of download.
+    # It's called by download_status setter and it may be called from any thread.
+    def wakeUpWaiters(self):
+        if self.download_status == 'paused':
+            self.resume_event.clear()
+        else:
+            self.resume_event.set()
+
+        with self.connection_condition:
+            self.connection_condition.notify_all()
+
+    # add an observer for download events. see download_observer.py
+    # on_progress of observer is not called more than once in progress_interval seconds.
+    # progress_interval=0 means on_progress is called for every received chunk.
+    def addObserver(self, observer, progress_interval=0.5):
+        self.observers.add(observer, progress_interval)
+
+    def removeObserver(self, observer):
+        self.observers.remove(observer)
+
     # return persepolis_lib version
     @classmethod
     def __Version__(cls):
         return cls.version
 
     # create requests session
+    # requests and urllib3 are imported here, so importing persepolis_lib is fast and doesn't need them.
     def createSession(self):
+        import requests
+        from persepolis_lib.http_adapter import PersepolisAdapter, ConnectionGate
+
         # define a requests session
         self.requests_session = requests.Session()
 
+        # Every thread needs one connection. So connection pool size is equal to number of threads.
+        # Connections are kept alive and every thread reuses them for next parts.
+        # Retry strategy is set by setRetry method.
+        # New connections are opened through connection_gate and host is resolved once.
+        if self.shared_pool_manager is not None:
+            self.connection_gate = self.shared_pool_manager.connection_gate
+        else:
+            self.connection_gate = ConnectionGate(self.connect_concurrency, self.connect_rate)
+        self.http_adapter = PersepolisAdapter(pool_maxsize=self.number_of_threads, connection_gate=self.connection_gate,
+                                              pool_manager=self.shared_pool_manager)
+        self.requests_session.mount('http://', self.http_adapter)
+        self.requests_session.mount('https://', self.http_adapter)
+        self.connection_statistics = self.http_adapter.connection_statistics
+
         # check if user set proxy
         if self.ip:
             ip_port = '://' + str(self.ip) + ":" + str(self.port)
@@ -139,41 +413,243 @@ class Download():
 
     # get file size
     # if file size is not available, then download link is invalid
+    # If download has some mirrors, the next mirror is tried.
     def getFileSize(self):
-        error_message = None
-        error_message2 = None
+        import requests
+
+        for link in self.mirror_links:
+            self.link = link
+            error_message = None
+            error_message2 = None
+
+            # response of the previous mirror is not used.
+            self.closeProbeResponse()
+            try:
+                # get headers
+                self.file_header = {}
+                if self.probe == 'get':
+                    response = self.requests_session.get(
+                        self.link, headers={'Range': 'bytes=0-'}, allow_redirects=True, stream=True,
+                        timeout=self.timeout, verify=self.check_certificate)
+                    if response.status_code >= 400:
+                        response.close()
+                        response.raise_for_status()
+
+                    self.probe_response = response
+                    self.probe_status = response.status_code
+                else:
+                    response = self.requests_session.head(self.link, allow_redirects=True, timeout=self.timeout, verify=self.check_certificate)
+                self.file_header = response.headers
+                self.warm_up_link = response.url
+
+                # find file size
+                # file without size is downloaded by one connection. So it's not an error.
+                self.file_size = self.headerFileSize(self.file_header)
+                if self.file_size is None:
+                    sendToLog('File size is not available. File is downloaded by one connection.', 'DEBUG')
+            except requests.exceptions.HTTPError as error:
+                error_message = 'HTTP error'
+                error_message2 = str(error)
+            except requests.exceptions.ConnectionError as error:
+                error_message = 'Connection error'
+                error_message2 = str(error)
+            except requests.exceptions.Timeout as error:
+                error_message = 'Timeout error'
+                error_message2 = str(error)
+            except requests.exceptions.RequestException as error:
+                error_message = 'Request error'
+                error_message2 = str(error)
+            except Exception as error:
+                error_message = 'Error'
+                error_message2 = str(error)
+
+            if error_message:
+                error = error_message + ' - ' + error_message2
+                sendToLog(error, 'ERROR')
+                self.observers.notify('on_error', error)
+                self.file_size = None
+            else:
+                break
+
+        return self.file_header
+
+    # this method returns file size from Content-Range or content-length header.
+    # It returns None if size is unknown.
+    # Response of GET probe contains file size in Content-Range, even if it doesn't have content-length.
+    def headerFileSize(self, header):
+        content_range = parseContentRange(header.get('Content-Range'))
+        if content_range is not None:
+            return content_range[2]
+
+        if header.get('content-length') is None:
+            return None
+        return int(header['content-length'])
+
+    # this method returns response of GET probe, if start is the first byte of file.
+    # Response of GET probe is used only once.
+    # It returns None if response is not available.
+    def takeProbeResponse(self, start):
+        if start != 0:
+            return None
+
+        with self.probe_lock:
+            response = self.probe_response
+            self.probe_response = None
+
+        return response
+
+    # close response of GET probe, if it's not used.
+    def closeProbeResponse(self):
+        response = self.takeProbeResponse(0)
+        if response is not None:
+            response.close()
+
+    # this method returns the number of connections that are opened while download file is created.
+    # Only connections of the first parts are opened and at most connect_concurrency connections
+    # are opened together. Connections of DownloadManager are opened when its workers claim parts,
+    # so warm-up never exceeds max_connections of manager. see download_manager.py
+    def warmUpCount(self):
+        if not self.resuming_suppurt or not self.file_size:
+            count = 1
+        else:
+            # see definePartSizes
+            count = min(self.number_of_threads, max(self.file_size // self.min_split_size, 1))
+
+            # adaptive mode starts with a few connections. see connection_controller.py
+            if self.adaptive_connections:
+                count = ConnectionController(count).target_connections
+
+        count = min(count, max(int(self.connect_concurrency), 1))
+
+        # connection of GET probe is used for part 0.
+        if self.probe_response is not None:
+            count = count - 1
+
+        return count
+
+    # this method starts the first download threads while download file is created.
+    # Every thread opens its connection and waits until parts are defined. see prepareDownload
+    # So the first parts don't wait for TCP and TLS handshakes and no extra thread is started.
+    # The other threads are started by startDownloadThreads.
+    def warmUpConnections(self):
+        if self.warm_up_link is None:
+            return
+
+        self.finished_threads = 0
+        for i in range(0, self.warmUpCount()):
+            t = threading.Thread(
+                target=self.threadHandler,
+                kwargs={'thread_number': i}, daemon=True)
+            t.start()
+
+            # add this thread to thread_list
+            self.thread_list.append(t)
+            self.warm_up_thread_list.append(t)
+
+    # this method opens a connection of warm_up_link and keeps it until parts are defined.
+    # Then the connection is returned to connection pool and download thread uses it for its first part.
+    # Connections are opened through connection_gate.
+    def warmUpConnection(self):
+        from requests import Request
+
         try:
-            # get headers
-            self.file_header = {}
-            response = self.requests_session.head(self.link, allow_redirects=True, timeout=5, verify=self.check_certificate)
-            self.file_header = response.headers
-
-            # find file size
-            self.file_size = int(self.file_header['content-length'])
-        except requests.exceptions.HTTPError as error:
-            error_message = 'HTTP error'
-            error_message2 = str(error)
-        except requests.exceptions.ConnectionError as error:
-            error_message = 'Connection error'
-            error_message2 = str(error)
-        except requests.exceptions.Timeout as error:
-            error_message = 'Timeout error'
-            error_message2 = str(error)
-        except requests.exceptions.RequestException as error:
-            error_message = 'Request error'
-            error_message2 = str(error)
+            # find connection pool of warm_up_link like requests session does.
+            settings = self.requests_session.merge_environment_settings(
+                self.warm_up_link, {}, None, self.check_certificate, None)
+            request = Request('GET', self.warm_up_link).prepare()
+
+            # get_connection_with_tls_context is added in requests 2.32.
+            # Older versions find pool by get_connection and set its certificate settings by cert_verify.
+            if hasattr(self.http_adapter, 'get_connection_with_tls_context'):
+                pool = self.http_adapter.get_connection_with_tls_context(
+                    request, settings['verify'], settings['proxies'], settings['cert'])
+            else:
+                pool = self.http_adapter.get_connection(request.url, settings['proxies'])
+                self.http_adapter.cert_verify(pool, request.url, settings['verify'], settings['cert'])
+
+            # connections are taken from pool and returned to it by methods of urllib3 connection pool.
+            # If they are not available, download thread opens its connection later.
+            if not (hasattr(pool, '_get_conn') and hasattr(pool, '_put_conn')):
+                return
+
+            connection = pool._get_conn()
         except Exception as error:
-            error_message = 'Error'
-            error_message2 = str(error)
+            sendToLog('Connection warm-up error: ' + str(error), 'ERROR')
+            return
 
-        if error_message:
-            error = error_message + ' - ' + error_message2
-            sendToLog(error, 'ERROR')
-            self.file_size = None
+        # connection of HEAD request is open already.
+        # Connection is kept until parts are defined, so every thread opens a different connection.
+        try:
+            if connection.sock is None:
+                self.openConnection(connection)
+            self.parts_ready_event.wait()
+        finally:
+            pool._put_conn(connection)
 
-        return self.file_header
+    def openConnection(self, connection):
+        try:
+            connection.connect()
+            connection.warm_connection = True
+        except Exception as error:
+            connection.close()
+            sendToLog('Connection warm-up error: ' + str(error), 'ERROR')
+
+    # this method checks the other mirrors and creates mirror_list.
+    # Mirrors are checked before setting retry strategy, so unavailable mirrors don't delay download.
+    # It returns False if file size is different from size in metalink.
+    def checkMirrors(self):
+        link_list = [self.link]
+        for link in self.mirror_links[self.mirror_links.index(self.link) + 1:]:
+            try:
+                if self.probe == 'get':
+                    response = self.requests_session.get(
+                        link, headers={'Range': 'bytes=0-0'}, allow_redirects=True, stream=True,
+                        timeout=self.timeout, verify=self.check_certificate)
+                else:
+                    response = self.requests_session.head(link, allow_redirects=True, timeout=self.timeout, verify=self.check_certificate)
+                response.close()
+                response.raise_for_status()
+            except Exception as error:
+                sendToLog('Mirror error: ' + link + ' - ' + str(error), 'ERROR')
+                continue
+
+            if self.mirrorMatches(link, response.headers):
+                link_list.append(link)
+
+        self.mirror_list = MirrorList(link_list)
+        if len(link_list) > 1:
+            sendToLog(str(len(link_list)) + ' mirrors are used.')
+
+        return self.checkMetalinkSize()
+
+    # this method returns True if mirror reports the same size and ETag as the main link and it supports resuming.
+    def mirrorMatches(self, link, header):
+        error = None
+        etag = self.file_header.get('ETag')
+        if self.headerFileSize(header) != self.file_size:
+            error = 'a different size'
+        elif etag and header.get('ETag') and header['ETag'] != etag:
+            error = 'a different ETag'
+        elif header.get('Accept-Ranges') != 'bytes' and header.get('Content-Range') is None:
+            error = 'no resuming support'
+
+        if error:
+            sendToLog('Mirror is not used, because it reports ' + error + ': ' + link, 'ERROR')
+            return False
+        return True
+
+    # this method returns False if file size is different from size in metalink.
+    def checkMetalinkSize(self):
+        if self.metalink_file_size is not None and self.file_size != self.metalink_file_size:
+            error = 'File size is different from size in metalink.'
+            sendToLog(error, 'ERROR')
+            self.observers.notify('on_error', error)
+            return False
+        return True
 
     def setRetry(self):
+        from urllib3.util.retry import Retry
+
         # set retry numbers.
         # backoff_factor will help to apply delays between attempts to avoid failing again
         retry_strategy = Retry(
@@ -182,9 +658,8 @@ class Download():
             status_forcelist=[429, 500, 502, 503, 504],
             allowed_methods=["HEAD", "GET", "OPTIONS"]
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.requests_session.mount('http://', adapter)
-        self.requests_session.mount('https://', adapter)
+        # connection pool is kept, so the connection of the first request is reused by threads.
+        self.http_adapter.max_retries = retry_strategy
 
     # get file name if available
     # if file name is not available, then set a file name
@@ -222,7 +697,11 @@ class Download():
     # Check if server supports multi threading and resuming or not
     def resumingSupport(self):
         self.resuming_suppurt = False
-        if 'Accept-Ranges' in self.file_header.keys():
+        # server sent the range of GET probe.
+        if self.probe_status == 206:
+            sendToLog('Server supports multi thread downloading and resuming download!')
+            self.resuming_suppurt = True
+        elif 'Accept-Ranges' in self.file_header.keys():
             if self.file_header['Accept-Ranges'] == 'bytes':
                 sendToLog('Server supports multi thread downloading and resuming download!')
                 self.resuming_suppurt = True
@@ -332,7 +811,8 @@ class Download():
 
                     # control file is corrupted.
                     except Exception as e:
-                        print(str(e))
+                        sendToLog('Control file error: ' + str(e), 'ERROR')
+                        self.printMessage(str(e))
                         self.resume = False
 
         if self.resuming_suppurt is False:
@@ -366,7 +846,8 @@ class Download():
                 with open(self.control_json_file_path, 'x') as f:
                     f.write("")
             except Exception as e:
-                print(str(e))
+                sendToLog('Control file error: ' + str(e), 'ERROR')
+                self.printMessage(str(e))
                 self.resume = False
 
         if self.resume and not (download_file_existance):
@@ -391,29 +872,22 @@ class Download():
                     # compare free disk space and file_size
                     if free_space >= self.file_size:
                         size, unit = humanReadableSize(self.file_size)
-                        print('Please wait! ' + self.download_status + '. File size: ' + str(size) + str(unit))
-                        # sets the size of each chunk to 1MiB
-                        CHUNK_SIZE = (1024 ** 2)
-                        # creates a byte string of zeroes with a size of 1MiB.
-                        # These bytes will be used for writing to the file later.
-                        zero_chunk = b'\0' * CHUNK_SIZE
-                        # This variable indicates how many bytes still need to be written.
-                        remaining = self.file_size
-
-                        # continue the loop until writing ends.
-                        while remaining > 0 and self.download_status != 'stopped':
-                            # determines how much data should be written in this iteration.
-                            # This value can be equal to CHUNK_SIZE,
-                            # but if remaining is less than CHUNK_SIZE, only the remaining amount will be written.
-                            to_write = min(CHUNK_SIZE, remaining)
-
-                            # writes the zero data up to the calculated amount (to_write) to the file.
-                            fp.write(zero_chunk[:to_write])
-                            # updates the remaining amount to indicate how much of the file still needs to be written.
-                            remaining -= to_write
-
-                        if self.download_status != 'stopped':
-                            print('Empty file has been created!')
+                        self.printMessage('Please wait! ' + self.download_status + '. File size: ' + str(size) + str(unit))
+
+                        # allocate disk space for download file.
+                        # allocation is canceled if user stops download.
+                        try:
+                            allocated = allocateFile(fp, self.file_size, self.file_allocation,
+                                                     is_canceled=lambda: self.download_status == 'stopped')
+                        except OSError as e:
+                            self.printMessage('persepolis couldn\'t allocate download file:\n' + str(e))
+                            sendToLog('File allocation error: ' + str(e), 'ERROR')
+                            self.observers.notify('on_error', 'File allocation error: ' + str(e))
+                            fp.close()
+                            return False
+
+                        if allocated and self.download_status != 'stopped':
+                            self.printMessage('Empty file has been created!')
                             fp.close()
                             return True
                         else:
@@ -422,7 +896,8 @@ class Download():
                             os.remove(self.file_path)
                             return False
                     else:
-                        print('Insufficient disk space!')
+                        sendToLog('Insufficient disk space!', 'ERROR')
+                        self.printMessage('Insufficient disk space!')
                         fp.close()
                         return False
                 else:
@@ -435,100 +910,305 @@ class Download():
             return True
 
     def definePartSizes(self):
-        # download_infromation_list contains 64 lists.
-        # Every list contains:
-        # [start byte number for this part, downloaded size, download status for this part, number of retryingfor this part]
-        # Status can be stopped, pending, downloading, error, complete
-        # All part statuses start with a lowercase letter.
-        # Retry number is -1, because askForNewPart method add 1 to it in the first call.
+        # part_table contains start, end, downloaded size, retry number and status of every part.
+        # see part_table.py
+        # Number of parts doesn't depend on number of threads.
+        # If a thread finishes its work, part_scheduler splits a downloading part and adds new part to part_table.
+        self.control_journal = ControlJournal(self.control_json_file_path)
+        data_dict = {}
         if self.resume:
             # read control file
             with open(self.control_json_file_path, "r") as f:
                 data_dict = json.load(f)
 
-            # read number of threads
-            self.download_infromation_list = data_dict['download_infromation_list']
+            if 'part_table' in data_dict:
+                self.part_table = PartTable.fromDict(data_dict['part_table'])
+            else:
+                # control file is created by older versions.
+                self.part_table = PartTable.fromList(data_dict['download_infromation_list'], data_dict['number_of_parts'], self.file_size)
 
-            # read number_of_parts
-            self.number_of_parts = data_dict['number_of_parts']
+            # apply the changes that are saved in journal after the last snapshot.
+            self.control_journal.replay(self.part_table, data_dict.get('journal_id'))
 
             # set pending status for uncomplete parts
-            for i in range(0, 64):
-                if self.download_infromation_list[i][2] != 'complete':
-                    self.download_infromation_list[i] = [self.download_infromation_list[i][0], self.download_infromation_list[i][1], 'pending', -1]
+            for i in range(0, len(self.part_table)):
+                if self.part_table.status[i] != PartStatus.COMPLETE:
+                    self.part_table.status[i] = PartStatus.PENDING
+                    self.part_table.retry[i] = -1
 
-                # Calculate downloded size
-                self.downloaded_size = self.downloaded_size + self.download_infromation_list[i][1]
+            # Calculate downloded size
+            self.downloaded_size = self.part_table.totalDownloaded()
         else:
-            if self.file_size:
-                part_size = int(self.file_size // 64)
-                # create new list.
-                self.download_infromation_list = [[]] * 64
-
-                # if part_size greater than 1 MiB
-                if part_size >= 1024**2:
-                    self.number_of_parts = 64
-                    for i in range(0, 64):
-                        self.download_infromation_list[i] = [i * part_size, 0, 'pending', -1]
+            self.part_table = PartTable()
 
+            # If server doesn't support resuming, the file is downloaded in one part.
+            if self.file_size and self.resuming_suppurt:
+                # file is divided into 64 parts if user didn't set part_size.
+                if self.part_size:
+                    part_size = int(self.part_size * 1024**2)
                 else:
-                    # Calculate how many parts of one MiB we need.
-                    self.number_of_parts = int((self.file_size - 1) // (1024**2)) + 1
-                    self.number_of_threads = self.number_of_parts
-                    for i in range(0, self.number_of_parts):
-                        self.download_infromation_list[i] = [i * 1024 * 1024, 0, 'pending', -1]
-
-                    # Set the starting byte number of the remaining parts equal to the size of the file.
-                    # The size of the file is equal to the last byte of the file.
-                    # The status of these parts is complete. Because we have nothing to download.
-                    for i in range(self.number_of_parts, 64):
-                        self.download_infromation_list[i] = [self.file_size - 1, 0, 'complete', -1]
+                    part_size = int(self.file_size // 64)
+
+                # parts are not smaller than 1 MiB
+                part_size = max(part_size, 1024**2)
+
+                number_of_parts = max(self.file_size // part_size, 1)
+                for i in range(0, number_of_parts):
+                    self.part_table.addPart(i * part_size, (i + 1) * part_size)
+
+                # last part ends at the end of the file.
+                self.part_table.end[number_of_parts - 1] = self.file_size
+
+            elif self.file_size:
+                self.part_table.addPart(0, self.file_size)
             else:
-                # create new list.
-                self.download_infromation_list = [[]] * 64
-
-                self.number_of_parts = 1
-                self.number_of_threads = 1
-                self.download_infromation_list[0] = [0, 0, 'pending', -1]
-                # Set the starting byte number of the remaining parts equal to the size of the file.
-                # The size of the file is equal to the last byte of the file.
-                # The status of these parts is complete. Because we have nothing to download.
-                for i in range(self.number_of_parts, 64):
-                    self.download_infromation_list[i] = [0, 0, 'complete', -1]
-
-        for i in range(0, self.number_of_parts):
-            self.part_thread_dict[i] = None
-
-    # this method calculates download rate and ETA every second
-    # and alculates sleep between data reception for limiting download rate.
-    def downloadSpeed(self):
-        # Calculate the difference between downloaded volume and elapsed time
-        # and divide them to get the download speed.
-        last_download_value = self.downloaded_size
-        end_time = time.perf_counter()
-        # this loop repeated every 5 second.
-        while self.download_status == 'downloading' or self.download_status == 'paused':
-            diffrence_time = time.perf_counter() - end_time
-            diffrence_size = self.downloaded_size - last_download_value
-            diffrence_size_converted, speed_unit = humanReadableSize(
-                diffrence_size, 'speed')
-            download_speed = round(diffrence_size_converted / diffrence_time,
-                                   2)
-            self.download_speed_str = (str(download_speed) + " " + speed_unit + "/s")
-            not_converted_download_speed = diffrence_size / diffrence_time
-            try:
-                # estimated time the download will be completed.
-                eta_second = (self.file_size - self.downloaded_size) /\
-                    not_converted_download_speed
-            except Exception:
-                eta_second = 0
+                # end of part is unspecified.
+                self.part_table.addPart(0, -1)
+
+        self.number_of_parts = len(self.part_table)
 
-            self.eta = convertTime(eta_second)
+        # parts are splitted only if server supports resuming and file_size is specified.
+        if self.file_size and self.resuming_suppurt:
+            min_split_size = self.min_split_size
 
-            end_time = time.perf_counter()
-            last_download_value = self.downloaded_size
+            # more threads than parts are useful only if parts can be splitted.
+            self.number_of_threads = min(self.number_of_threads, max(self.number_of_parts, self.file_size // self.min_split_size))
+        else:
+            min_split_size = None
+            self.number_of_threads = 1
+
+        self.part_scheduler = PartScheduler(self.part_table, self.retry, min_split_size,
+                                            end_game=self.end_game, rate_function=self.partRate,
+                                            split_function=self.splitEnd)
+
+        self.createConnectionController()
+
+        self.createHashers(data_dict)
+
+        # response of GET probe is used for part 0. It's not useful if part 0 is downloaded before.
+        if self.part_table.downloaded[0] != 0 or self.part_table.status[0] == PartStatus.COMPLETE:
+            self.closeProbeResponse()
+
+    # this method prepares hashing of parts, file_verifier and piece_verifier.
+    # Digests of complete parts are loaded from control file, if they are calculated by the same algorithm.
+    def createHashers(self, data_dict):
+        self.createPieceVerifier()
+
+        if self.hash_algorithm is None:
+            return
+
+        self.part_hasher_dict = {}
+        self.part_digest_dict = {}
+        if self.expected_digest is not None:
+            self.file_verifier = FileVerifier(self.hash_algorithm, self.expected_digest)
+
+        if data_dict.get('hash_algorithm') == self.hash_algorithm:
+            for part_number, digest in data_dict.get('part_digests', {}).items():
+                part_number = int(part_number)
+                if part_number < len(self.part_table) and self.part_table.status[part_number] == PartStatus.COMPLETE:
+                    self.part_digest_dict[part_number] = digest
+
+    # this method creates piece_verifier, if digests of pieces are available.
+    # Pieces are ignored if they don't match file size.
+    def createPieceVerifier(self):
+        if not self.pieces or not self.file_size:
+            return
+
+        piece_length = self.pieces['length']
+        if len(self.pieces['hashes']) != -(-self.file_size // piece_length):
+            sendToLog('Number of pieces doesn\'t match file size. Pieces are not checked.', 'ERROR')
+            return
+
+        self.piece_verifier = PieceVerifier(hashAlgorithmName(self.pieces['algorithm']), piece_length,
+                                            self.pieces['hashes'])
+
+    # this method creates connection_controller in adaptive mode.
+    # Server that doesn't support resuming is downloaded by one connection.
+    def createConnectionController(self):
+        if self.adaptive_connections and self.resuming_suppurt and self.number_of_threads > 1:
+            self.connection_controller = ConnectionController(self.number_of_threads)
+            self.last_adaptive_time = time.monotonic()
+            self.last_adaptive_size = self.downloaded_size
+            self.last_number_of_errors = self.connection_statistics.numberOfErrors()
+
+    # this method returns the number of connections that can download parts now.
+    def connectionLimit(self):
+        if self.connection_controller is None:
+            return self.number_of_threads
+        return self.connection_controller.target_connections
+
+    # this method gives download rate and errors of the last interval to connection_controller.
+    # It's called every second.
+    def adaptConnections(self):
+        if self.connection_controller is None:
+            return
+
+        now = time.monotonic()
+        elapsed_time = now - self.last_adaptive_time
+        if elapsed_time < self.adaptive_interval:
+            return
+
+        number_of_errors = self.connection_statistics.numberOfErrors()
+
+        # rate of paused download is not useful.
+        if self.download_status == 'downloading':
+            download_rate = (self.downloaded_size - self.last_adaptive_size) / elapsed_time
+            self.connection_controller.update(download_rate, number_of_errors - self.last_number_of_errors)
+
+        self.last_adaptive_time = now
+        self.last_adaptive_size = self.downloaded_size
+        self.last_number_of_errors = number_of_errors
+
+        # wake up threads that wait for more connections.
+        self.wakeUpWaiters()
+
+    # this method calculates download rate and ETA every second.
+    def downloadSpeed(self):
+        while self.download_status == 'downloading' or self.download_status == 'paused':
+            self.calculateDownloadSpeed()
+
+            # wait 1 second or until download is finished.
+            self.stop_event.wait(1)
+
+    # this method updates download speed and ETA from smoothed download rate.
+    def calculateDownloadSpeed(self):
+        self.not_converted_download_speed = self.rate_estimator.getRate()
+        download_speed, speed_unit = humanReadableSize(
+            self.not_converted_download_speed, 'speed')
+        self.download_speed_str = (str(round(download_speed, 2)) + " " + speed_unit + "/s")
+
+        # estimated time the download will be completed.
+        self.eta_second = self.estimateTimeLeft(self.not_converted_download_speed)
+        if self.eta_second is None:
+            self.eta = convertTime(0)
+        else:
+            self.eta = convertTime(self.eta_second)
+
+    # this method returns estimated seconds until the end of download or None.
+    # Remaining bytes are shared between all connections by splitting parts.
+    # So remaining size is divided by download rate.
+    # But a part that is too small for splitting is downloaded by its connection only,
+    # so download is not finished before remaining bytes of that part are downloaded at rate of that part.
+    def estimateTimeLeft(self, download_rate):
+        if not self.file_size or download_rate <= 0 or self.part_scheduler is None:
+            return None
+
+        eta_second = max(self.file_size - self.downloaded_size, 0) / download_rate
+
+        min_split_size = self.part_scheduler.min_split_size
+        for part_number, part_rate in list(self.part_rate_dict.items()):
+            if self.part_table.end[part_number] == -1:
+                continue
+
+            remaining = self.part_table.remaining(part_number)
+            if min_split_size is not None and remaining >= (2 * min_split_size):
+                continue
+
+            rate = part_rate.getRate()
+            if rate > 0:
+                eta_second = max(eta_second, remaining / rate)
+
+        return eta_second
+
+    # this method returns download rate of every connection in bytes per second.
+    def connectionRates(self):
+        return {thread_number: int(connection_rate.getRate())
+                for thread_number, connection_rate in list(self.connection_rate_dict.items())}
+
+    # this method returns download rate of every downloading part in bytes per second.
+    def partRates(self):
+        return {part_number: int(part_rate.getRate())
+                for part_number, part_rate in list(self.part_rate_dict.items())}
+
+    # this method returns download rate of the part in bytes per second.
+    def partRate(self, part_number):
+        part_rate = self.part_rate_dict.get(part_number)
+        if part_rate is None:
+            return 0
+        return part_rate.getRate()
+
+    # this method is called by part_scheduler when a downloading part is splitted at end.
+    # It returns the new end of the part or None if the part must not be splitted.
+    # Download threads limit every write to the end of part, so the part is splitted at end.
+    def splitEnd(self, part_number, end):
+        return end
+
+    # this method is called when a thread starts downloading a part.
+    # If another thread downloads this part too (hedged part), the thread is saved in hedge_thread_dict.
+    # Rate estimator of the part is shared between its threads and
+    # rate estimator of the thread is kept for its next parts.
+    def takePart(self, part_number, thread_number):
+        if self.part_thread_dict.get(part_number) not in [None, thread_number]:
+            self.hedge_thread_dict[part_number] = thread_number
+        else:
+            self.part_thread_dict[part_number] = thread_number
 
-            time.sleep(5)
+        if part_number not in self.part_rate_dict:
+            self.part_rate_dict[part_number] = RateEstimator()
+
+        if thread_number not in self.connection_rate_dict:
+            self.connection_rate_dict[thread_number] = RateEstimator()
+
+        self.connection_part_dict[thread_number] = (part_number, time.monotonic())
+        self.slow_connection_dict.pop(thread_number, None)
+
+    # this method returns False if the part is completed by another thread or
+    # the thread is dropped by checkLowestSpeed. Then the thread must stop downloading the part.
+    def ownsPart(self, part_number, thread_number):
+        return self.part_thread_dict.get(part_number) == thread_number or \
+            self.hedge_thread_dict.get(part_number) == thread_number
+
+    # this method is called when a thread stops downloading a part.
+    def leavePart(self, part_number, thread_number):
+        if self.part_thread_dict.get(part_number) == thread_number:
+            self.part_thread_dict[part_number] = None
+        if self.hedge_thread_dict.get(part_number) == thread_number:
+            del self.hedge_thread_dict[part_number]
+
+        if self.connection_part_dict.get(thread_number, (None,))[0] == part_number:
+            del self.connection_part_dict[thread_number]
+
+        # rate estimator of part is deleted when no thread downloads it.
+        if self.part_thread_dict.get(part_number) is None and part_number not in self.hedge_thread_dict:
+            self.part_rate_dict.pop(part_number, None)
+
+    # this method drops threads that download slower than lowest_speed_limit for lowest_speed_time seconds.
+    # Dropped thread stops downloading its part after its current read and the part is given to a thread again.
+    # It's called every second.
+    def checkLowestSpeed(self):
+        if not self.lowest_speed_limit:
+            return
+
+        # rate of paused download is not useful.
+        if self.download_status != 'downloading':
+            self.slow_connection_dict.clear()
+            return
+
+        now = time.monotonic()
+        for thread_number, (part_number, start_time) in list(self.connection_part_dict.items()):
+            connection_rate = self.connection_rate_dict.get(thread_number)
+            if connection_rate is None or connection_rate.getRate() >= self.lowest_speed_limit:
+                self.slow_connection_dict.pop(thread_number, None)
+                continue
+
+            slow_since = self.slow_connection_dict.setdefault(thread_number, now)
+
+            # new connection is not dropped before lowest_speed_time.
+            if now - max(slow_since, start_time) < self.lowest_speed_time:
+                continue
+
+            sendToLog('connection ' + str(thread_number) + ' is dropped, because its download rate is too low.')
+            self.slow_connection_dict.pop(thread_number, None)
+            if self.part_thread_dict.get(part_number) == thread_number:
+                self.part_thread_dict[part_number] = None
+            if self.hedge_thread_dict.get(part_number) == thread_number:
+                del self.hedge_thread_dict[part_number]
+
+    # this method writes text on console, if progress bar is shown.
+    # Download is used as a library without progress bar, so messages are sent to log and observers.
+    def printMessage(self, text):
+        if self.progress_bar is True:
+            print(text)
 
     # this method shows progress bar
     def progressBar(self):
@@ -537,9 +1217,12 @@ class Download():
         else:
             k = 0
             size = 'None'
+            unit = ''
         percent = 0
+        converted_downloaded_size = 0
         while (self.download_status == 'downloading' or self.download_status == 'paused'):
-            time.sleep(0.5)
+            # wait 0.5 second or until download is finished.
+            self.stop_event.wait(0.5)
             if self.file_size:
                 percent = (self.downloaded_size / self.file_size) * 100
                 converted_downloaded_size = convertSize(self.downloaded_size, unit)
@@ -558,15 +1241,16 @@ class Download():
                 bar[k] = '*'
                 bar = ''.join(bar)
 
-            # find downloded size of every part
+            # find downloded size of every downloading part
             downloaded_size_list_str = ""
             if self.threads_progress_bar is True:
-                for i in range(0, 64):
+                downloading_parts = [i for i in range(0, len(self.part_table)) if self.part_table.status[i] == PartStatus.DOWNLOADING]
+                for j, i in enumerate(downloading_parts):
                     part_size_converted, unit_part_size = humanReadableSize(
-                        self.download_infromation_list[i][1])
+                        self.part_table.downloaded[i])
                     downloaded_size_list_str = (
                         downloaded_size_list_str + "part " + str(i + 1) + ": " + str(part_size_converted) + unit_part_size + "|")
-                    if i in list(range(3, 64, 4)):
+                    if j % 4 == 3:
                         downloaded_size_list_str = downloaded_size_list_str + '\n'
                 downloaded_size_list_str = downloaded_size_list_str + "\n"
                 number_of_lines = downloaded_size_list_str.count("\n")
@@ -653,8 +1337,7 @@ class Download():
     def runProgressBar(self):
         # run  a thread for calculating download speed.
         calculate_speed_thread = threading.Thread(
-            target=self.downloadSpeed)
-        calculate_speed_thread.setDaemon(True)
+            target=self.downloadSpeed, daemon=True)
         calculate_speed_thread.start()
 
         # add thus thread to thread_list
@@ -663,338 +1346,724 @@ class Download():
         if self.progress_bar is True:
             # run a thread for showing progress bar
             progress_bar_thread = threading.Thread(
-                target=self.progressBar)
-            progress_bar_thread.setDaemon(True)
+                target=self.progressBar, daemon=True)
             progress_bar_thread.start()
 
-        # add thus thread to thread_list
-        self.thread_list.append(progress_bar_thread)
-
-    # threadHandler asks new part for download from this method.
-    def askForNewPart(self):
-        self.lock = True
-        for i in range(0, self.number_of_parts):
-            # Check that this part is not being downloaded or it is not complete.
-            # Check that the number of retries of this part has not reached the set limit.
-            if (self.download_infromation_list[i][2] != 'complete') and (self.download_infromation_list[i][2] != 'downloading') and\
-                    (self.download_infromation_list[i][3] <= self.retry):
-
-                # set 'downloding' status for this part
-                self.download_infromation_list[i][2] = 'downloading'
-                # add 1 to retry number for this part
-                self.download_infromation_list[i][3] += 1
-
-                # number of retries can't be less than 0
-                if self.download_infromation_list[i][3] < 0:
-                    self.download_infromation_list[i][3] = 0
-                self.lock = False
-                return i
-
-        self.lock = False
-        return None
+            # add thus thread to thread_list
+            self.thread_list.append(progress_bar_thread)
+
+    # this method writes data of the part to download file at offset
+    # and adds its length to downloaded size of the part and downloaded_size.
+    # part_scheduler may split the part and move its end backward.
+    # So data after the end of part is not written.
+    # thread_number is the thread that received data. It's used for calculating rate of its connection.
+    # It returns length of written data.
+    def storeData(self, part_number, offset, data, thread_number=None):
+        part_end = self.part_table.end[part_number]
+        if part_end != -1 and len(data) > (part_end - offset):
+            data = data[:max(part_end - offset, 0)]
+
+        self.output_sink.write(offset, data)
+
+        # save downloaded size of this part.
+        # part_scheduler checks the end of part again, because part may be splitted during writing.
+        if self.part_hasher_dict is None:
+            update_size = self.part_scheduler.updatePart(part_number, offset, len(data))
+        else:
+            update_size = self.updateAndHashPart(part_number, offset, data)
+
+        self.addProgress(part_number, update_size, len(data), thread_number)
+
+        return len(data)
+
+    # this method updates downloaded size and rates after size bytes of part are received by thread.
+    # update_size is number of the new downloaded bytes of part.
+    def addProgress(self, part_number, update_size, size, thread_number=None):
+        # this variable saves amount of total downloaded size
+        # update downloaded_size
+        self.downloaded_size = (self.downloaded_size + update_size)
+
+        # update download rate of download, the part and its connection.
+        # Rate of connection contains bytes that are downloaded by the other thread of a hedged part too.
+        self.rate_estimator.add(update_size)
+        part_rate = self.part_rate_dict.get(part_number)
+        if part_rate is not None:
+            part_rate.add(update_size)
+        connection_rate = self.connection_rate_dict.get(thread_number)
+        if connection_rate is not None:
+            connection_rate.add(size)
+
+        if self.observers:
+            self.observers.notifyProgress(self.downloaded_size)
+
+    # this method updates downloaded size of the part and hashes the new bytes of the part.
+    # Threads of a hedged part write the same bytes, but only bytes after the hashed bytes are hashed.
+    # Lock of part hasher keeps the order of updates of the part. Other parts are not blocked.
+    # It returns number of the new downloaded bytes.
+    def updateAndHashPart(self, part_number, offset, data):
+        # the other thread of a hedged part completed it.
+        if self.part_table.status[part_number] == PartStatus.COMPLETE:
+            return self.part_scheduler.updatePart(part_number, offset, len(data))
+
+        part_hasher = self.part_hasher_dict.get(part_number)
+        if part_hasher is None:
+            part_hasher = self.part_hasher_dict.setdefault(part_number, PartHasher(self.hash_algorithm))
+
+        with part_hasher.lock:
+            # bytes that are not hashed in this session are read from download file.
+            # e.g. after resuming or when part is downloaded from the beginning again.
+            if part_hasher.size != self.part_table.downloaded[part_number]:
+                self.hashPartFromFile(part_number, part_hasher)
+
+            update_size = self.part_scheduler.updatePart(part_number, offset, len(data))
+            if update_size:
+                # new bytes end at the end of downloaded bytes of part.
+                data_end = self.part_table.start[part_number] + self.part_table.downloaded[part_number] - offset
+                new_data = memoryview(data)[data_end - update_size:data_end]
+                part_hasher.update(new_data)
+
+                if self.file_verifier is not None:
+                    self.file_verifier.feed(offset + data_end - update_size, new_data)
+
+        return update_size
+
+    # this method hashes downloaded bytes of the part by reading download file.
+    def hashPartFromFile(self, part_number, part_hasher):
+        start = self.part_table.start[part_number]
+        part_hasher.reset()
+        for data in self.readFileRange(start, start + self.part_table.downloaded[part_number]):
+            part_hasher.update(data)
+
+    # this method reads download file from start to end in blocks.
+    def readFileRange(self, start, end, block_size=1024**2):
+        while start < end:
+            data = self.output_sink.read(start, min(block_size, end - start))
+            if not data:
+                break
+            start += len(data)
+            yield data
+
+    # this method saves digest of a complete part.
+    def savePartDigest(self, part_number):
+        part_hasher = self.part_hasher_dict.pop(part_number, None)
+        if part_hasher is None:
+            part_hasher = PartHasher(self.hash_algorithm)
+
+        with part_hasher.lock:
+            if part_hasher.size != self.part_table.downloaded[part_number]:
+                self.hashPartFromFile(part_number, part_hasher)
+            self.part_digest_dict[part_number] = part_hasher.hexdigest()
+
+    # this method hashes downloaded data after position of file_verifier by reading download file.
+    # Data is hashed until the first byte that is not downloaded yet.
+    # limit is the maximum number of bytes that are read. None means no limit.
+    def hashDownloadedData(self, limit=None):
+        position = self.file_verifier.position
+        end = position
+        for start, downloaded_end, part_end, part_number in self.part_scheduler.downloadedRanges():
+            if start > end:
+                break
+            end = max(end, downloaded_end)
+            if downloaded_end != part_end:
+                break
+
+        if limit is not None:
+            end = min(end, position + limit)
+
+        self.file_verifier.hashFile(self.output_sink.read, end)
+
+    # this method checks pieces that are downloaded completely and are not checked yet.
+    # Parts of the pieces that don't match their digests are downloaded again.
+    # If a piece doesn't match after retry attempts, download file is not valid and download is stopped.
+    # limit is the maximum number of bytes that are read. None means no limit.
+    # It returns True if some parts must be downloaded again.
+    # verify_lock must be acquired before calling this method.
+    def checkPieces(self, limit=None):
+        read_size = 0
+        reopened = False
+        for piece_number in self.piece_verifier.uncheckedPieces(self.part_scheduler.completeRanges(), self.file_size):
+            if (limit is not None and read_size >= limit) or self.hash_verified is False:
+                break
+
+            start, end = self.piece_verifier.pieceRange(piece_number, self.file_size)
+            read_size += end - start
+            if self.piece_verifier.checkPiece(piece_number, self.output_sink.read, self.file_size):
+                continue
+
+            if self.piece_verifier.failure_dict[piece_number] > self.retry:
+                self.hash_verified = False
+                error = 'Piece ' + str(piece_number) + ' doesn\'t match expected hash.'
+                sendToLog(error, 'ERROR')
+                self.observers.notify('on_error', error)
+                self.part_scheduler.stop()
+                break
+
+            sendToLog('piece ' + str(piece_number) + ' doesn\'t match expected hash and it\'s downloaded again.')
+            for part_number in self.part_scheduler.reopenRange(start, end):
+                self.part_digest_dict.pop(part_number, None)
+            self.downloaded_size -= end - start
+            reopened = True
+
+            # download file is hashed again from the start of the piece.
+            if self.file_verifier is not None and self.file_verifier.position > start:
+                self.file_verifier = FileVerifier(self.hash_algorithm, self.expected_digest)
+
+        return reopened
+
+    # this method hashes data that is not hashed while downloading and checks complete pieces.
+    # limit is the maximum number of bytes that are read. None means no limit.
+    def verifyDownloadedData(self, limit=None):
+        with self.verify_lock:
+            if self.hash_verified is not None:
+                return
+
+            if self.file_verifier is not None:
+                self.hashDownloadedData(limit)
+
+            if self.piece_verifier is not None:
+                self.checkPieces(limit)
+
+    # this method reads downloaded data every second for verifying, so verifying download file
+    # doesn't take long at the end. It runs in verify thread, so reading download file doesn't delay checkpoints.
+    def verifyHandler(self):
+        while self.download_status in ['downloading', 'paused']:
+            self.verifyDownloadedData(self.verify_read_size)
+
+            # wait 1 second or until download is finished.
+            self.stop_event.wait(1)
+
+    # this method starts verify thread, if download file is verified.
+    def startVerifyThread(self):
+        if self.file_verifier is None and self.piece_verifier is None:
+            return
+
+        verify_thread = threading.Thread(target=self.verifyHandler, daemon=True)
+        verify_thread.start()
+        self.thread_list.append(verify_thread)
+
+    # this method returns True if download file is verified by expected_hash or pieces.
+    def hasVerifier(self):
+        return self.file_verifier is not None or self.piece_verifier is not None
+
+    # this method verifies download file by pieces and expected_hash when all parts are complete.
+    # Parts of the pieces that don't match their digests are downloaded again.
+    # If file doesn't match expected_hash, complete parts are hashed again from download file and
+    # parts that don't match their digests are downloaded again.
+    # If all parts match their digests, parts without digests are downloaded again.
+    # It returns True if some parts must be downloaded again.
+    def verifyDownload(self):
+        with self.verify_lock:
+            if not self.hasVerifier() or self.hash_verified is not None or \
+                    self.download_status not in ['downloading', 'paused']:
+                return False
+
+            # parts of broken pieces that are reopened by verify thread after download threads are finished.
+            if not self.part_scheduler.isComplete():
+                return not self.part_scheduler.isFinished()
+
+            if self.piece_verifier is not None:
+                if self.checkPieces():
+                    return True
+                if self.hash_verified is False:
+                    return False
+
+            if self.file_verifier is None:
+                self.hash_verified = True
+                sendToLog('All pieces of download file match expected hashes.')
+                return False
+
+            return self.verifyFile()
+
+    # this method verifies download file by expected_hash.
+    # It returns True if some parts must be downloaded again.
+    # verify_lock must be acquired before calling this method.
+    def verifyFile(self):
+        self.hashDownloadedData()
+        if self.file_verifier.position == self.downloaded_size and self.file_verifier.isValid():
+            self.hash_verified = True
+            sendToLog('Download file matches expected hash.')
+            return False
+
+        self.hash_verified = False
+        error = 'Download file doesn\'t match expected hash.'
+        sendToLog(error, 'ERROR')
+        self.observers.notify('on_error', error)
+
+        if self.verify_attempts >= self.retry:
+            return False
+        self.verify_attempts += 1
+
+        mismatched_parts = []
+        unknown_parts = []
+        for part_number in range(0, len(self.part_table)):
+            part_hasher = PartHasher(self.hash_algorithm)
+            self.hashPartFromFile(part_number, part_hasher)
+            digest = self.part_digest_dict.get(part_number)
+            if digest is None:
+                unknown_parts.append(part_number)
+            elif digest != part_hasher.hexdigest():
+                mismatched_parts.append(part_number)
+
+        if not mismatched_parts:
+            mismatched_parts = unknown_parts
+
+        if not mismatched_parts:
+            return False
+
+        sendToLog('parts ' + ', '.join(str(part_number) for part_number in mismatched_parts) + ' are downloaded again.')
+        for part_number in mismatched_parts:
+            self.part_digest_dict.pop(part_number, None)
+            self.downloaded_size -= self.part_table.downloaded[part_number]
+        self.part_scheduler.reopen(mismatched_parts)
+
+        # download file is hashed again from the start.
+        self.file_verifier = FileVerifier(self.hash_algorithm, self.expected_digest)
+        self.hash_verified = None
+        return True
+
+    # this method marks the part as complete and notifies observers.
+    # The other thread of a hedged part stops downloading it, because it doesn't own the part anymore.
+    def completePart(self, part_number):
+        self.part_thread_dict[part_number] = None
+        self.hedge_thread_dict.pop(part_number, None)
+        if self.part_scheduler.complete(part_number):
+            if self.part_hasher_dict is not None:
+                self.savePartDigest(part_number)
+
+            sendToLog('part ' + str(part_number) + ' is complete!')
+            self.observers.notify('on_part_complete', part_number)
 
     # The below code is used for each chunk of file handled
     # by each thread for downloading the content from specified
     # location to storage
     def threadHandler(self, thread_number):
+        # threads that are started by warmUpConnections open their connection and wait until parts are defined.
+        if not self.parts_ready_event.is_set():
+            self.warmUpConnection()
+            self.parts_ready_event.wait()
+
         while self.download_status in ['downloading', 'paused']:
-            is_break = False
-            # Wait for the lock to be released.
-            while self.lock is True:
-                # Random sleep prevents two threads from downloading the same part at the same time.
-                # sleep random time
-                time.sleep(random.uniform(0, 0.5))
-            part_number = self.askForNewPart()
+            # In adaptive mode, threads that are more than the number of connections wait
+            # until number of connections grows or no part remains for downloading.
+            if thread_number >= self.connectionLimit():
+                if self.part_scheduler.finished_event.is_set():
+                    break
+
+                with self.connection_condition:
+                    self.connection_condition.wait_for(
+                        lambda: thread_number < self.connectionLimit() or self.part_scheduler.finished_event.is_set() or
+                        self.download_status not in ['downloading', 'paused'])
+                continue
+
+            # ask part_scheduler for a new part.
+            # It waits if no part is pending but other parts are still downloading.
+            part_number = self.part_scheduler.claim()
 
             # If part_number is None, no part is available for download. So exit the loop.
             if part_number is None:
-                is_break = True
                 break
 
-            self.part_thread_dict[part_number] = thread_number
+            self.downloadPart(part_number, thread_number)
 
-            try:
-                if self.file_size:
-                    # Calculate part size
-                    # If it's not the last part:
-                    if part_number != (self.number_of_parts - 1):
-                        part_size = self.download_infromation_list[part_number + 1][0] - self.download_infromation_list[part_number][0]
+        # This thread is finished.
+        self.connection_rate_dict.pop(thread_number, None)
+        self.finished_threads = self.finished_threads + 1
 
-                    else:
-                        # for last part
-                        part_size = self.file_size - 1 - self.download_infromation_list[part_number][0]
+    # this method downloads a part that is claimed from part_scheduler.
+    # thread_number is number of the thread that downloads this part.
+    def downloadPart(self, part_number, thread_number):
+        is_break = False
+        downloaded_part = None
+        part_size = None
+        download_finished_successfully = False
+        response = None
+
+        self.takePart(part_number, thread_number)
+
+        # the other thread of a hedged part may finish the part before this thread starts.
+        if self.part_table.end[part_number] != -1 and self.part_table.remaining(part_number) == 0:
+            self.completePart(part_number)
+            self.leavePart(part_number, thread_number)
+            return
+
+        # response of GET probe is used for the part that starts from the first byte.
+        # It's received from the main link. see takeProbeResponse
+        probe_response = self.takeProbeResponse(self.part_table.start[part_number] + self.part_table.downloaded[part_number])
+
+        # choose a mirror for this part. see mirror_list.py
+        if probe_response is not None:
+            mirror = self.mirror_list.choose(self.link)
+        else:
+            mirror = self.mirror_list.choose()
 
-                    # get start byte number of this part and add it to downloaded size. download resume from this byte number
-                    downloaded_part = self.download_infromation_list[part_number][1]
+        try:
+            if self.file_size:
+                # Calculate part size
+                part_size = self.part_table.partSize(part_number)
+
+                # get start byte number of this part and add it to downloaded size. download resume from this byte number
+                downloaded_part = self.part_table.downloaded[part_number]
+
+                start = self.part_table.start[part_number] + downloaded_part
+
+                # end byte number of the part is not part of it.
+                end = self.part_table.end[part_number] - 1
+
+                # download from begining!
+                if self.resuming_suppurt is False:
+                    start = 0
+                    self.downloaded_size = self.downloaded_size - downloaded_part
+                    self.part_table.downloaded[part_number] = 0
+                    downloaded_part = 0
+
+                # specify the start and end of the part for request header.
+                chunk_headers = {'Range': 'bytes=%d-%d' % (start, end)}
+
+                # request the specified part and get into variable
+                # When stream=True is set on the request, this avoids
+                # reading the content at once into memory for large responses
+                # Range header is sent with this request only. session headers are shared between threads.
+                if probe_response is not None:
+                    # response of GET probe contains the rest of file.
+                    response = probe_response
+                    end = self.file_size - 1
+                else:
+                    response = self.requests_session.get(
+                        mirror.link, headers=chunk_headers, allow_redirects=True, stream=True,
+                        timeout=self.timeout, verify=self.check_certificate)
+
+                # server must send the requested range.
+                if not (response.status_code == 206 or (response.status_code == 200 and start == 0)):
+                    raise ConnectionError('HTTP error - ' + str(response.status_code) + ' ' + response.reason)
+
+                # data is written to the file at offset by output_sink.
+                # output_sink shares one file descriptor between all threads.
+                offset = start
+
+                # data is a chunk of response. see receiveData
+                for data in self.receiveData(response, thread_number):
+                    if self.download_status in ['downloading', 'paused']:
+                        # write data and update downloaded size of this part.
+                        written = self.storeData(part_number, offset, data, thread_number)
+                        offset += written
+                        self.mirror_list.addData(mirror, written)
+
+                        # part_scheduler may split this part and move its end backward.
+                        part_size = self.part_table.partSize(part_number)
+
+                        # update downloaded_part
+                        downloaded_part = self.part_table.downloaded[part_number]
+
+                        # if this part is completed by another thread or this thread is dropped
+                        # by checkLowestSpeed then exit. The part is given to a thread again if it's not complete.
+                        if not self.ownsPart(part_number, thread_number):
+                            # This loop does not end due to an error in the request.
+                            # Therefore, no number should be added to the number of retries.
+                            self.part_table.retry[part_number] -= 1
+                            break
 
-                    start = self.download_infromation_list[part_number][0] + downloaded_part
+                        # perhaps user set limitation for download rate.
+                        # see limitSpeed method.
+                        speed_limit_delay = self.speedLimitDelay(len(data), thread_number)
+                        if speed_limit_delay:
+                            time.sleep(speed_limit_delay)
+
+                        # wait for unpausing. see wakeUpWaiters
+                        while self.download_status == 'paused':
+                            self.resume_event.wait()
+
+                        # this part is complete. If the end of part moved backward by splitting,
+                        # the rest of the response belongs to another part. So close the response.
+                        # Else the response is finished too and its connection returns to the pool
+                        # after the loop, so the next part can reuse it.
+                        if downloaded_part == part_size and self.part_table.end[part_number] != (end + 1):
+                            break
 
-                    # end of part is equal to start of the next part
-                    if part_number != (self.number_of_parts - 1):
-                        end = self.download_infromation_list[part_number + 1][0] - 1
                     else:
-                        end = self.file_size - 1
+                        is_break = True
+                        break
+            # If file_size is unspecified.
+            else:
+                # get start byte number of this part and add it to downloaded size. download resume from this byte number
+                start = self.part_table.downloaded[part_number]
+                downloaded_part = start
+
+                # download from begining!
+                if self.resuming_suppurt is False:
+                    start = 0
+                    self.downloaded_size = self.downloaded_size - downloaded_part
+                    self.part_table.downloaded[part_number] = 0
+                    downloaded_part = 0
+
+                # specify the start and end of the part for request header.
+                chunk_headers = {'Range': 'bytes=%d-' % (start)}
+
+                # request the specified part and get into variable
+                # When stream=True is set on the request, this avoids
+                # reading the content at once into memory for large responses
+                # Range header is sent with this request only. session headers are shared between threads.
+                if probe_response is not None:
+                    response = probe_response
+                else:
+                    response = self.requests_session.get(
+                        mirror.link, headers=chunk_headers, allow_redirects=True, stream=True,
+                        timeout=self.timeout, verify=self.check_certificate)
 
-                    # download from begining!
-                    if self.resuming_suppurt is False:
-                        start = 0
+                # server must send the requested range.
+                if not (response.status_code == 206 or (response.status_code == 200 and start == 0)):
+                    raise ConnectionError('HTTP error - ' + str(response.status_code) + ' ' + response.reason)
 
-                    # specify the start and end of the part for request header.
-                    chunk_headers = {'Range': 'bytes=%d-%d' % (start, end)}
+                # data is written to the file at offset by output_sink.
+                # output_sink shares one file descriptor between all threads.
+                offset = start
 
-                    # request the specified part and get into variable
-                    # When stream=True is set on the request, this avoids
-                    # reading the content at once into memory for large responses
-                    self.requests_session.headers.update(chunk_headers)
-                    response = self.requests_session.get(
-                        self.link, allow_redirects=True, stream=True,
-                        timeout=self.timeout, verify=self.check_certificate)
+                # data is a chunk of response. see receiveData
+                for data in self.receiveData(response, thread_number):
+                    if self.download_status in ['downloading', 'paused']:
+                        # write data and update downloaded size of this part.
+                        written = self.storeData(part_number, offset, data, thread_number)
+                        offset += written
+                        self.mirror_list.addData(mirror, written)
 
-                    # open the file and write the content of the html page
-                    # into file.
-                    # r+b mode is open the binary file in read or write mode.
-                    with open(self.file_path, "r+b") as fp:
-
-                        # The seek() method sets the current file position in a file stream.
-                        fp.seek(start)
-
-                        # The Python File tell() method is used to find the current position of
-                        # the file cursor (or pointer) within the file.
-                        fp.tell()
-
-                        # why we use iter_content
-                        # Iterates over the response data. When stream=True is set on
-                        # the request, this avoids reading the content at once into
-                        # memory for large responses. The chunk size is the number
-                        # of bytes it should read into memory. This is not necessarily
-                        # the length of each item returned as decoding can take place.
-                        # so we divide our chunk to smaller chunks. default is 100 Kib
-                        python_request_chunk_size = (1024 * self.python_request_chunk_size)
-                        for data in response.iter_content(
-                                chunk_size=python_request_chunk_size):
-                            if self.download_status in ['downloading', 'paused']:
-                                fp.write(data)
-
-                                # if this part is downloaded by another thread then exit thread
-                                if self.part_thread_dict[part_number] != thread_number:
-                                    # This loop does not end due to an error in the request.
-                                    # Therefore, no number should be added to the number of retries.
-                                    self.download_infromation_list[part_number][3] -= 1
-                                    is_break = True
-                                    break
-
-                                # maybe the last chunk is less than default chunk size
-                                if (part_size - downloaded_part) >= python_request_chunk_size:
-                                    update_size = python_request_chunk_size
-                                    # if update_size is not equal with actual data length,
-                                    # then redownload this chunk.
-                                    # exit this "for loop" for redownloading this chunk.
-                                    if update_size != len(data):
-                                        # This loop does not end due to an error in the request.
-                                        # Therefore, no number should be added to the number of retries.
-                                        self.download_infromation_list[part_number][3] -= 1
-                                        break
-                                else:
-                                    # so the last small chunk is equal to :
-                                    update_size = (part_size - downloaded_part)
-                                    # some times last chunks are smaller
-                                    if len(data) < update_size:
-                                        update_size = len(data)
-
-                                # update downloaded_part
-                                downloaded_part = (downloaded_part + update_size)
-                                # save value to downloaded_size_list
-                                self.download_infromation_list[part_number][1] = downloaded_part
-
-                                # this variable saves amount of total downloaded size
-                                # update downloaded_size
-                                self.downloaded_size = (self.downloaded_size + update_size)
-                                # perhaps user set limitation for download rate.
-                                # downloadrate limitation
-                                # "Speed limit" is whole number. The more it is, the more sleep time is given to the data
-                                # receiving loop, which reduces the download speed.
-                                time.sleep(self.sleep_for_speed_limiting)
-
-                                if self.download_status == 'paused':
-                                    # wait for unpausing
-                                    while self.download_status == 'paused':
-                                        time.sleep(0.2)
+                        # update downloaded_part
+                        downloaded_part = self.part_table.downloaded[part_number]
 
-                            else:
-                                self.download_infromation_list[part_number][2] = 'stopped'
-                                is_break = True
-                                break
-                # If file_size is unspecified.
-                else:
-                    download_finished_successfully = False
+                        # perhaps user set limitation for download rate.
+                        # see limitSpeed method.
+                        speed_limit_delay = self.speedLimitDelay(len(data), thread_number)
+                        if speed_limit_delay:
+                            time.sleep(speed_limit_delay)
 
-                    # get start byte number of this part and add it to downloaded size. download resume from this byte number
-                    start = self.download_infromation_list[part_number][1]
-                    downloaded_part = start
+                        # wait for unpausing. see wakeUpWaiters
+                        while self.download_status == 'paused':
+                            self.resume_event.wait()
 
-                    # download from begining!
-                    if self.resuming_suppurt is False:
-                        start = 0
+                    else:
+                        is_break = True
+                        break
+                download_finished_successfully = True
 
-                    # specify the start and end of the part for request header.
-                    chunk_headers = {'Range': 'bytes=%d-' % (start)}
+        except Exception as e:
+            error_text = ("part_number: " + str(part_number) + " " + str(e))
+            sendToLog(error_text)
+            self.observers.notify('on_error', error_text)
 
-                    # request the specified part and get into variable
-                    # When stream=True is set on the request, this avoids
-                    # reading the content at once into memory for large responses
-                    self.requests_session.headers.update(chunk_headers)
-                    response = self.requests_session.get(
-                        self.link, allow_redirects=True, stream=True,
-                        timeout=self.timeout, verify=self.check_certificate)
+            # connection failed during reading response. Failed requests are counted by http_adapter.
+            if response is not None and self.connection_statistics is not None:
+                self.connection_statistics.addFailure()
 
-                    # open the file and write the content of the html page
-                    # into file.
-                    # r+b mode is open the binary file in read or write mode.
-                    with open(self.file_path, "r+b") as fp:
-
-                        # The seek() method sets the current file position in a file stream.
-                        fp.seek(start)
-
-                        # The Python File tell() method is used to find the current position of
-                        # the file cursor (or pointer) within the file.
-                        fp.tell()
-
-                        # why we use iter_content
-                        # Iterates over the response data. When stream=True is set on
-                        # the request, this avoids reading the content at once into
-                        # memory for large responses. The chunk size is the number
-                        # of bytes it should read into memory. This is not necessarily
-                        # the length of each item returned as decoding can take place.
-                        # so we divide our chunk to smaller chunks. default is 100 Kib
-                        python_request_chunk_size = (1024 * self.python_request_chunk_size)
-                        for data in response.iter_content(
-                                chunk_size=python_request_chunk_size):
-                            if self.download_status in ['downloading', 'paused']:
-                                fp.write(data)
-                                update_size = len(data)
-
-                                # update downloaded_part
-                                downloaded_part = (downloaded_part + update_size)
-                                # save value to downloaded_size_list
-                                self.download_infromation_list[part_number][1] = downloaded_part
-
-                                # this variable saves amount of total downloaded size
-                                # update downloaded_size
-                                self.downloaded_size = (self.downloaded_size + update_size)
-                                # perhaps user set limitation for download rate.
-                                # downloadrate limitation
-                                # "Speed limit" is whole number. The more it is, the more sleep time is given to the data
-                                # receiving loop, which reduces the download speed.
-                                time.sleep(self.sleep_for_speed_limiting)
-
-                                if self.download_status == 'paused':
-                                    # wait for unpausing
-                                    while self.download_status == 'paused':
-                                        time.sleep(0.2)
+            self.mirror_list.addFailure(mirror)
 
-                            else:
-                                self.download_infromation_list[part_number][2] = 'stopped'
-                                is_break = True
-                                break
-                    download_finished_successfully = True
+        # If response is read completely, its connection is already returned to the pool for reusing.
+        # Else the connection is closed.
+        if response is not None:
+            response.close()
 
-            except Exception as e:
-                self.download_infromation_list[part_number][2] = 'error'
-                error_text = ("part_number: " + str(part_number) + " " + str(e))
-                sendToLog(error_text)
+        # this thread doesn't download the part anymore.
+        # It must be called before releasing the part, because another thread may take the part after releasing.
+        self.leavePart(part_number, thread_number)
+        self.mirror_list.leave(mirror)
 
-            # so it's complete successfully.
-            if self.file_size:
-                if (downloaded_part == part_size):
-                    sendToLog('part ' + str(part_number) + ' is complete!')
-                    self.download_infromation_list[part_number][2] = 'complete'
-                    self.part_thread_dict[part_number] = None
-                elif not (is_break):
-                    self.download_infromation_list[part_number][2] = 'error'
-                    self.part_thread_dict[part_number] = None
+        # so it's complete successfully.
+        if self.file_size:
+            if part_size is not None:
+                part_size = self.part_table.partSize(part_number)
+
+            if (downloaded_part == part_size):
+                self.mirror_list.addSuccess(mirror)
+                self.completePart(part_number)
+            elif not (is_break):
+                self.part_scheduler.release(part_number, PartStatus.ERROR)
             else:
-                if download_finished_successfully:
-                    self.file_size = self.downloaded_size
-                    self.download_infromation_list[part_number][2] = 'complete'
-                    self.part_thread_dict[part_number] = None
-                elif not (is_break):
-                    self.download_infromation_list[part_number][2] = 'error'
-                    self.part_thread_dict[part_number] = None
-
-        # This thread is finished.
-        self.finished_threads = self.finished_threads + 1
+                self.part_scheduler.release(part_number, PartStatus.STOPPED)
+        else:
+            if download_finished_successfully:
+                self.file_size = self.downloaded_size
+                self.mirror_list.addSuccess(mirror)
+                self.completePart(part_number)
+            elif not (is_break):
+                self.part_scheduler.release(part_number, PartStatus.ERROR)
+            else:
+                self.part_scheduler.release(part_number, PartStatus.STOPPED)
 
-    # this method save download information in json format every 1 second
+    # this method saves download information every 1 second
     def saveInfo(self):
         while self.download_status == 'downloading' or self.download_status == 'paused':
-            control_dict = {
-                'ETag': self.etag,
-                'file_name': self.file_name,
-                'file_size': self.file_size,
-                'number_of_parts': self.number_of_parts,
-                'download_infromation_list': self.download_infromation_list}
+            self.writeControlFile()
+
+            # wait 1 second or until download is finished.
+            self.stop_event.wait(1)
+
+    # this method saves the changed parts in journal (checkpoint).
+    # Records are taken before syncing download file, so every record describes data that is on the disk.
+    # If journal is big, the whole part_table is saved in control file instead.
+    def writeControlFile(self):
+        if self.control_journal.needsCompaction(len(self.part_table)):
+            self.compactControlFile()
+            return
+
+        records = self.part_scheduler.takeDirtyParts()
+        if records:
+            self.output_sink.sync()
+            self.control_journal.append(records)
+
+    # this method writes the whole part_table in control file and starts a new journal.
+    def compactControlFile(self):
+        # parts may be splitted during writing control file.
+        # So get a copy of part_table from part_scheduler.
+        part_table = self.part_scheduler.snapshot()
+        control_dict = {
+            'ETag': self.etag,
+            'file_name': self.file_name,
+            'file_size': self.file_size,
+            'number_of_parts': len(part_table),
+            'part_table': part_table.toDict()}
+
+        # digests of complete parts. see createHashers
+        if self.part_hasher_dict is not None:
+            control_dict['hash_algorithm'] = self.hash_algorithm
+            control_dict['part_digests'] = {str(part_number): digest
+                                            for part_number, digest in dict(self.part_digest_dict).items()}
+
+        self.output_sink.sync()
+        self.control_journal.writeSnapshot(control_dict)
+
+    # this method opens download file for writing.
+    # In 'mmap' write mode, data is copied into memory mapping of download file. see output_sink.py
+    # File size must be known for mapping the file.
+    # In 'queue' write mode, data is written by a writer thread and adjacent chunks are written together.
+    # At most write_queue_size bytes wait in the queue. After that, download threads wait for the writer thread.
+    # In 'dontneed' cache policy, written data is removed from page cache after it's synced to the disk.
+    # In 'direct' cache policy, data is written with O_DIRECT in 'pwrite' write mode.
+    # 'queue' write mode uses 'dontneed' instead of 'direct' and 'mmap' write mode ignores cache_policy.
+    def createOutputSink(self):
+        if self.write_mode == 'mmap' and self.file_size:
+            self.output_sink = MmapOutputSink(self.file_path, self.file_size)
+        elif self.write_mode == 'queue':
+            self.output_sink = QueuedOutputSink(self.file_path, error_function=self.writeError,
+                                                max_queue_size=self.write_queue_size,
+                                                cache_policy=self.cache_policy)
+        elif self.cache_policy == 'direct':
+            self.output_sink = DirectOutputSink(self.file_path)
+        else:
+            self.output_sink = OutputSink(self.file_path, cache_policy=self.cache_policy)
+        self.output_sink.open()
 
-            # write control_dict in json file
-            with open(self.control_json_file_path, "w") as outfile:
-                json.dump(control_dict, outfile, indent=2)
+    # writer thread of output_sink calls this method if data can't be written to download file.
+    # Download is stopped with error status. Control file is not written after this,
+    # so data that is not written is downloaded again after resuming.
+    def writeError(self, error):
+        error_text = 'Download file error: ' + str(error)
+        sendToLog(error_text, 'ERROR')
+        self.observers.notify('on_error', error_text)
 
-            time.sleep(1)
+        self.download_status = 'error'
+        if self.part_scheduler is not None:
+            self.part_scheduler.stop()
 
     # this method runs download threads
     def runDownloadThreads(self):
         # check if server supports multithread downloading or not!
         if self.resuming_suppurt is False:
-            self.thread_number = 1
+            self.number_of_threads = 1
 
-        for i in range(0, self.number_of_threads):
+        self.startDownloadThreads()
 
-            # sleep between starting new thread.
-            # it solves "Connection refused" error.
-            time.sleep(0.1)
+        # run verify thread for checking downloaded data.
+        self.startVerifyThread()
 
+        # run saveInfo thread for updating control file
+        save_control_thread = threading.Thread(
+            target=self.saveInfo, daemon=True)
+        save_control_thread.start()
+
+        # add this thread to thread_list
+        self.thread_list.append(save_control_thread)
+
+    # this method starts threads that download parts.
+    # Threads that are started by warmUpConnections are not started again.
+    def startDownloadThreads(self):
+        self.download_thread_list = self.warm_up_thread_list
+        self.warm_up_thread_list = []
+        if not self.download_thread_list:
+            self.finished_threads = 0
+
+        # threads are started together. New connections are limited by connection_gate.
+        for i in range(len(self.download_thread_list), self.number_of_threads):
             # create threads
             t = threading.Thread(
                 target=self.threadHandler,
-                kwargs={'thread_number': i})
-            t.setDaemon(True)
+                kwargs={'thread_number': i}, daemon=True)
             t.start()
 
             # add this thread to thread_list
             self.thread_list.append(t)
-
-        # run saveInfo thread for updating control file
-        save_control_thread = threading.Thread(
-            target=self.saveInfo)
-        save_control_thread.setDaemon(True)
-        save_control_thread.start()
-
-        # add this thread to thread_list
-        self.thread_list.append(save_control_thread)
+            self.download_thread_list.append(t)
 
     # this method checks and manages download progress.
     def checkDownloadProgress(self):
-        # Run this loop until the download is finished.
-        while (self.download_status == 'downloading' or self.download_status == 'paused') and \
-              (self.finished_threads != self.number_of_threads):
+        while True:
+            # Run this loop until the download is finished.
+            while (self.download_status == 'downloading' or self.download_status == 'paused') and \
+                  (self.finished_threads != self.number_of_threads):
 
-            # Calculate download percent
-            if self.file_size:
-                self.download_percent = int((self.downloaded_size / self.file_size) * 100)
-            else:
-                self.download_percent = 0
+                # Calculate download percent
+                if self.file_size:
+                    self.download_percent = int((self.downloaded_size / self.file_size) * 100)
+                else:
+                    self.download_percent = 0
+
+                # Calculate number of active threads
+                self.number_of_active_connections = min(self.number_of_threads - self.finished_threads, self.connectionLimit())
+
+                # change number of connections in adaptive mode.
+                self.adaptConnections()
 
-            # Calculate number of active threads
-            self.number_of_active_connections = self.number_of_threads - self.finished_threads
-            time.sleep(1)
+                # drop slow connections.
+                self.checkLowestSpeed()
 
-            # Check if all parts downloaded completely.
-            number_of_completed_parts = 0
-            for i in range(0, self.number_of_parts):
-                if self.download_infromation_list[i][2] == 'complete':
-                    number_of_completed_parts += 1
-            if number_of_completed_parts == self.number_of_parts:
-                # Download complete!
-                self.download_status = 'complete'
+                # part_scheduler sets finished_event when the last part is finished.
+                # So download is finished immediately and information is updated every second.
+                if self.part_scheduler.finished_event.wait(1):
+                    break
+
+            # threads that wait for more connections exit now.
+            self.wakeUpWaiters()
+
+            if not self.hasVerifier():
+                break
+
+            # verify download file after download threads are finished.
+            # Parts that don't match are downloaded by new threads.
+            for thread in self.download_thread_list:
+                thread.join()
+
+            if not self.verifyDownload():
+                break
+
+            self.startDownloadThreads()
+
+        self.finishDownload()
+
+    # this method sets final status of download when all download threads are finished.
+    def finishDownload(self):
+        # wait until queued data is written. see QueuedOutputSink
+        # download status is changed to 'error' if writing fails.
+        if self.output_sink is not None:
+            self.output_sink.flush()
+
+        # Check if all parts downloaded completely.
+        # download file that doesn't match expected_hash is not complete.
+        if self.download_status in ['downloading', 'paused'] and self.part_scheduler.isComplete() and \
+                self.hash_verified is not False:
+            self.download_status = 'complete'
+
+        # wake up threads that are waiting for new part.
+        self.part_scheduler.stop()
+        self.wakeUpWaiters()
+
+        if self.connection_controller is not None:
+            self.connection_controller.finish()
 
         # Calculate download percent
         if self.file_size:
@@ -1002,6 +2071,10 @@ class Download():
         else:
             self.download_percent = 0
 
+        # send the last progress to observers.
+        if self.observers:
+            self.observers.notifyProgress(self.downloaded_size, force=True)
+
         if self.download_status == 'complete':
             sendToLog('Download complete.')
 
@@ -1010,23 +2083,41 @@ class Download():
 
             self.download_status = 'error'
             sendToLog('Error')
+            self.observers.notify('on_error', 'Download failed.')
 
         elif self.download_status == 'stopped':
 
             sendToLog('Download stopped.')
 
-        print('\r', flush=True)
+        if self.progress_bar is True:
+            print('\r', flush=True)
 
     # this method starts download
     def start(self):
+        if self.prepareDownload():
+            self.runProgressBar()
+
+            self.runDownloadThreads()
+
+            self.checkDownloadProgress()
+
+        self.close()
+
+    # this method gets file information, creates download file and control file and defines parts.
+    # It returns True if parts are ready for downloading.
+    def prepareDownload(self):
         # create new download session.
         self.createSession()
         header = self.getFileSize()
-        if header != {}:
+        if header != {} and self.checkMirrors():
             self.setRetry()
             self.download_status = 'creating download file'
             self.resumingSupport()
 
+            # open connections of the first download threads while download file is created.
+            if self.warm_up:
+                self.warmUpConnections()
+
             self.getFileName()
 
             self.getFileTag()
@@ -1037,28 +2128,44 @@ class Download():
                 if enough_free_space:
                     self.definePartSizes()
 
-                    self.runProgressBar()
+                    # every thread uses one receive buffer at a time. see receiveData
+                    if self.receive_mode == 'readinto':
+                        self.buffer_pool = BufferPool(self.receive_buffer_size, self.number_of_threads)
+
+                    # open download file for writing.
+                    self.createOutputSink()
 
-                    self.runDownloadThreads()
+                    # save the first snapshot of parts.
+                    self.compactControlFile()
 
-                    self.checkDownloadProgress()
+                    # threads of warmUpConnections start downloading parts.
+                    self.parts_ready_event.set()
+                    return True
                 else:
                     self.download_status = 'error'
 
-            self.close()
-
         else:
             self.download_status = 'error'
-            self.close()
 
-    def stop(self, signum, frame):
+        # threads of warmUpConnections exit.
+        self.parts_ready_event.set()
+        return False
+
+    def stop(self, signum=None, frame=None):
         self.download_status = 'stopped'
 
+        # wake up threads that are waiting for new part.
+        if self.part_scheduler is not None:
+            self.part_scheduler.stop()
+
+    # finished downloads are not paused.
     def downloadPause(self):
-        self.download_status = 'paused'
+        if self.download_status == 'downloading':
+            self.download_status = 'paused'
 
     def downloadUnpause(self):
-        self.download_status = 'downloading'
+        if self.download_status == 'paused':
+            self.download_status = 'downloading'
 
     # This method returns download status
     def tellStatus(self):
@@ -1068,6 +2175,14 @@ class Download():
         if self.eta == '0s':
             self.eta = ''
 
+        # number of requests that are sent over new connections and reused keep-alive connections.
+        if self.connection_statistics is not None:
+            new_connections = self.connection_statistics.new_connections
+            reused_connections = self.connection_statistics.reused_connections
+        else:
+            new_connections = 0
+            reused_connections = 0
+
         # return information in dictionary format
         download_info = {
             'file_name': self.file_name,
@@ -1078,34 +2193,177 @@ class Download():
             'connections': str(self.number_of_active_connections),
             'rate': self.download_speed_str,
             'estimate_time_left': self.eta,
-            'link': self.link
+            'link': self.link,
+            'new_connections': str(new_connections),
+            'reused_connections': str(reused_connections),
+            # numeric values. rates are in bytes per second.
+            'download_rate': int(self.not_converted_download_speed),
+            'connection_rates': self.connectionRates(),
+            'part_rates': self.partRates(),
+            'estimate_time_left_seconds': self.eta_second,
+            # number of connections in adaptive mode.
+            'target_connections': self.connectionLimit(),
+            'settled_connections': self.connection_controller.settled_connections if self.connection_controller is not None else None,
+            # True if download file matches expected_hash. None if it's not verified.
+            'hash_verified': self.hash_verified,
+            # download rate of every mirror in bytes per second.
+            'mirror_rates': self.mirror_list.rates() if self.mirror_list is not None else {}
         }
 
         return download_info
 
     # This method limits download speed.
-    # limit_value is between 1 to 10.
+    # bytes_per_second is the maximum download rate of all connections. 0 or None means no limit speed.
+    # It can be changed during downloading.
+    # limit_value is the old way of limiting speed and it's between 1 to 10.
     # 10 means no limit speed.
-    def limitSpeed(self, limit_value):
-        # Calculate sleep time between data receiving. It's reduce download speed.
-        self.sleep_for_speed_limiting = (10 - limit_value) * 0.005 * (self.number_of_active_connections)
+    def limitSpeed(self, limit_value=None, bytes_per_second=None):
+        if limit_value is None:
+            self.sleep_for_speed_limiting = 0
+            self.speed_limiter.setRate(bytes_per_second)
+        else:
+            # Calculate sleep time between data receiving. It's reduce download speed.
+            self.speed_limiter.setRate(None)
+            self.sleep_for_speed_limiting = (10 - limit_value) * 0.005 * (self.number_of_active_connections)
+
+    # this method returns size of every read from response in bytes.
+    # If download speed is limited, connections read smaller chunks, so the rate stays smooth.
+    def readChunkSize(self):
+        chunk_size = 1024 * self.python_request_chunk_size
+        rate = self.speed_limiter.rate
+        if rate is not None:
+            chunk_size = int(min(chunk_size, max(rate / (10 * self.number_of_threads), 16 * 1024)))
+        return chunk_size
+
+    # this method returns size of the next read of connection in 'readinto' receive mode.
+    # A connection reads about receive_interval seconds of its download rate at a time.
+    # So slow connections use small reads and fast connections read up to receive_buffer_size bytes.
+    def receiveSize(self, thread_number):
+        size = self.readChunkSize()
+        connection_rate = self.connection_rate_dict.get(thread_number)
+        if connection_rate is not None and self.speed_limiter.rate is None:
+            size = max(size, int(connection_rate.getRate() * self.receive_interval))
+        return min(size, self.receive_buffer_size)
+
+    # this generator yields chunks of response body.
+    # In 'iter_content' receive mode, chunks are read by response.iter_content.
+    # When stream=True is set on the request, this avoids reading the content at once into memory.
+    # The chunk size is the number of bytes it should read into memory. This is not necessarily
+    # the length of each item returned as decoding can take place. default is 100 Kib
+    # In 'readinto' receive mode, http.client response reads socket into a buffer of buffer_pool
+    # and memoryviews of the buffer are yielded. A chunk is valid until the next chunk is yielded.
+    # Compressed responses must be decoded by urllib3, so they are read by iter_content.
+    def receiveData(self, response, thread_number):
+        # wait for tokens of the first read. see reserveFirstRead
+        speed_limit_delay = self.reserveFirstRead(thread_number)
+        if speed_limit_delay:
+            time.sleep(speed_limit_delay)
 
-    def close(self):
-        # if download complete, so delete control file
-        if self.download_status == 'complete':
-            os.remove(self.control_json_file_path)
+        try:
+            raw_response = getattr(response.raw, '_fp', None)
+            if self.buffer_pool is None or raw_response is None or \
+                    response.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+                yield from response.iter_content(chunk_size=self.readChunkSize())
+                return
+
+            buffer = self.buffer_pool.take()
+            try:
+                view = memoryview(buffer)
+                while True:
+                    size = raw_response.readinto(view[:self.receiveSize(thread_number)])
+                    if not size:
+                        break
+                    yield view[:size]
+
+                # http.client returns 0 if server closes connection before sending Content-Length bytes.
+                if raw_response.length:
+                    raise ConnectionError('Connection closed before receiving the whole response')
+
+                # response is read completely. So its connection returns to the pool for the next part.
+                response.raw.release_conn()
+            finally:
+                self.buffer_pool.give(buffer)
+        finally:
+            self.refundFirstRead(thread_number)
+
+    # this method returns seconds that a connection must wait after receiving size bytes.
+    # It's 0 if download speed is not limited.
+    # If tokens are reserved for the connection by reserveFirstRead, they pay for the received bytes
+    # and tokens of the next read are reserved instead. So every read is paid before receiving it
+    # and a connection never has more than one reserved read.
+    def speedLimitDelay(self, size, thread_number=None):
+        reserved_size = self.reserved_tokens.pop(thread_number, 0)
+        if self.speed_limiter.rate is None:
+            return self.sleep_for_speed_limiting
+
+        if not reserved_size:
+            return self.speed_limiter.consume(size)
+
+        next_reserved_size = self.readChunkSize()
+        self.reserved_tokens[thread_number] = next_reserved_size
+        charge = size - reserved_size + next_reserved_size
+        if charge < 0:
+            self.speed_limiter.refund(-charge)
+            return 0
+        return self.speed_limiter.consume(charge)
+
+    # this method takes tokens for the first read of a response and returns seconds that the connection
+    # must wait before reading. The next reads are reserved by speedLimitDelay.
+    # So connections that start together don't receive a burst of data before the limit takes effect.
+    # Reserved tokens are saved for the connection and tokens of the last reservation
+    # are given back by refundFirstRead when the response is finished.
+    def reserveFirstRead(self, thread_number=None):
+        if self.speed_limiter.rate is not None:
+            reserved_size = self.readChunkSize()
+            self.reserved_tokens[thread_number] = reserved_size
+            return self.speed_limiter.consume(reserved_size)
+        return 0
+
+    def refundFirstRead(self, thread_number=None):
+        reserved_size = self.reserved_tokens.pop(thread_number, 0)
+        if reserved_size:
+            self.speed_limiter.refund(reserved_size)
 
+    def close(self):
         # delete last line
         if self.progress_bar is True:
             sys.stdout.write('\x1b[2K')
             sys.stdout.write('  persepolis_lib is closed!\n')
             sys.stdout.flush()
 
+        # threads of warmUpConnections exit, if preparing download failed.
+        self.parts_ready_event.set()
+
+        # response of GET probe is not used, if download is not started.
+        self.closeProbeResponse()
+
         # close requests session
-        self.requests_session.close()
+        if self.requests_session is not None:
+            self.requests_session.close()
 
         # ask threads for exiting.
         for thread in self.thread_list:
             thread.join()
 
+        # threads are finished, so control file is not written after this.
+        # if download complete, so delete control file and journal.
+        if self.download_status == 'complete':
+            if self.control_journal is not None:
+                self.control_journal.remove()
+            os.remove(self.control_json_file_path)
+
+        # save the last state of parts for resuming.
+        elif self.control_journal is not None and self.output_sink is not None:
+            try:
+                self.compactControlFile()
+            except OSError as e:
+                sendToLog('Control file error: ' + str(e), 'ERROR')
+            self.control_journal.closeJournal()
+
+        # close download file
+        if self.output_sink is not None:
+            self.output_sink.close()
+
         sendToLog("persepolis_lib is closed!")
+
+        self.finished_event.set()
@@ -0,0 +1,635 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+from persepolis_lib.persepolis_lib import Download
+from persepolis_lib.part_table import PartStatus
+from persepolis_lib.output_sink import OutputSink
+from persepolis_lib.buffer_pool import BufferPool
+from persepolis_lib.rate_estimator import RateEstimator
+from persepolis_lib.rate_limiter import TokenBucket
+from persepolis_lib.useful_tools import sendToLog
+
+# every connection has a slot of slot_fields numbers in shared memory.
+# slot_control is written by main process. 0 means downloading, 1 means paused and 2 means stop.
+# slot_end is the end of part (not part of it). main process moves it backward when the part is splitted.
+# slot_position is written by worker process. Bytes before it are written to download file.
+# slot_hold_until is the time (time.monotonic in microseconds) that connection must wait for speed limit
+# that is set by limit_value. Speed limit in bytes per second is applied by speed_limiter in worker processes.
+# slot_reserved is written by worker process before writing data. Bytes before it may be written to download file.
+# slot_end and slot_reserved are changed with the lock of slot, so the part is never splitted before slot_reserved.
+slot_control = 0
+slot_end = 1
+slot_position = 2
+slot_hold_until = 3
+slot_reserved = 4
+slot_fields = 5
+
+control_downloading = 0
+control_paused = 1
+control_stop = 2
+
+# every worker process has statistics_fields numbers after slots.
+# They are numbers of new connections, reused connections, throttled responses and failed requests.
+statistics_fields = 4
+
+
+# ProcessDownload downloads parts in worker processes, so receiving data is not limited by one GIL.
+# Main process does everything else like Download class. It gets file information, creates download file
+# and control file, gives parts to threads by part_scheduler and writes control file.
+# Every download thread of main process sends its part to a connection of a worker process and
+# waits until the connection finishes it. One monitor thread waits for results of all connections
+# and reads their progress from shared memory. So part_table, tellStatus, pause, stop,
+# speed limit and control file work like Download class.
+# Every worker process has its own requests session and download file descriptor.
+# Data is written with os.pwrite at disjoint offsets of the same file. Parts are hashed from download file.
+# write_mode and cache_policy are not used by worker processes.
+# If server doesn't support resuming or file size is unknown, parts are downloaded by threads of main process.
+# Response of GET probe is used by a thread of main process for part 0 too.
+#
+# usage:
+#     download_session = ProcessDownload(add_link_dictionary, number_of_threads=64, number_of_processes=4)
+#     download_session.start()
+class ProcessDownload(Download):
+    def __init__(self, add_link_dictionary, *args, number_of_processes=None, **kwargs):
+        super().__init__(add_link_dictionary, *args, **kwargs)
+
+        # worker processes create Download objects with the same arguments.
+        self.download_arguments = (add_link_dictionary, args, kwargs)
+
+        if number_of_processes is None:
+            number_of_processes = os.cpu_count() or 1
+        self.number_of_processes = max(min(int(number_of_processes), self.number_of_threads), 1)
+
+        # progress of main process is updated from slots every progress_interval seconds.
+        self.progress_interval = 0.05
+
+        self.process_list = []
+        # connection of every download thread to its slot in worker process. keys are thread numbers.
+        self.slot_connection_dict = {}
+        self.slot_array = None
+        # locks of slot_end and slot_reserved and events that wake paused connections. see SlotJob
+        self.slot_lock_list = []
+        self.slot_event_list = []
+
+        # parts that are downloading by worker processes. keys are thread numbers.
+        # It's changed with condition of part_scheduler, so splitEnd finds the slots of splitted part.
+        self.job_dict = {}
+        # job_event is set when a job is added, so monitor thread doesn't wait when no job is running.
+        self.job_event = threading.Event()
+        self.monitor_thread = None
+        self.monitor_stopped = False
+
+        # the last statistics of every worker process. see addStatistics
+        self.process_statistics_list = []
+        self.statistics_lock = threading.Lock()
+
+        # worker processes receive data faster than main process reads progress of slots,
+        # so they take tokens for received data themselves. see limitSpeed
+        self.speed_limiter = SharedTokenBucket(multiprocessing.get_context('spawn'))
+
+    # worker processes are started while download file is created.
+    # Their sessions open connections when the first parts are sent to them.
+    def warmUpConnections(self):
+        if self.resuming_suppurt is False or not self.file_size:
+            return super().warmUpConnections()
+
+        self.startWorkerProcesses()
+
+    # spawn is used, because fork copies locks of running threads.
+    def startWorkerProcesses(self):
+        context = multiprocessing.get_context('spawn')
+        self.slot_array = context.RawArray('q', self.number_of_threads * slot_fields +
+                                           self.number_of_processes * statistics_fields)
+        self.process_statistics_list = [[0] * statistics_fields for i in range(0, self.number_of_processes)]
+        self.slot_lock_list = [context.Lock() for i in range(0, self.number_of_threads)]
+        self.slot_event_list = [context.Event() for i in range(0, self.number_of_threads)]
+
+        # thread i uses a connection of process (i % number_of_processes).
+        for process_number in range(0, self.number_of_processes):
+            slot_list = list(range(process_number, self.number_of_threads, self.number_of_processes))
+            worker_connection_list = []
+            for thread_number in slot_list:
+                main_connection, worker_connection = context.Pipe()
+                self.slot_connection_dict[thread_number] = main_connection
+                worker_connection_list.append(worker_connection)
+
+            process = context.Process(target=workerProcess,
+                                      args=(self.download_arguments, process_number, slot_list,
+                                            worker_connection_list, self.slot_array, self.speed_limiter,
+                                            [self.slot_lock_list[i] for i in slot_list],
+                                            [self.slot_event_list[i] for i in slot_list]))
+            process.daemon = True
+            process.start()
+            self.process_list.append(process)
+
+            # main process doesn't use these ends of pipes.
+            for worker_connection in worker_connection_list:
+                worker_connection.close()
+
+        self.monitor_thread = threading.Thread(target=self.monitorHandler)
+        self.monitor_thread.daemon = True
+        self.monitor_thread.start()
+
+        sendToLog(str(self.number_of_processes) + ' worker processes are started.')
+
+    # this method returns True if the part can be downloaded by worker process of thread.
+    def hasWorker(self, thread_number):
+        if not self.process_list or thread_number not in self.slot_connection_dict:
+            return False
+        return self.process_list[thread_number % self.number_of_processes].is_alive()
+
+    # this method sends the part to the connection of thread in worker process and waits until
+    # monitor thread receives the result. see monitorHandler
+    # If worker process is not running, the part is downloaded by this thread.
+    # The part that starts from the first byte is downloaded by this thread with response of GET probe.
+    def downloadPart(self, part_number, thread_number):
+        if not self.hasWorker(thread_number) or \
+                (self.probe_response is not None and self.part_table.start[part_number] + self.part_table.downloaded[part_number] == 0):
+            return super().downloadPart(part_number, thread_number)
+
+        self.takePart(part_number, thread_number)
+
+        # the other thread of a hedged part may finish the part before this thread starts.
+        if self.part_table.remaining(part_number) == 0:
+            self.completePart(part_number)
+            self.leavePart(part_number, thread_number)
+            return
+
+        mirror = self.mirror_list.choose()
+        job = SlotJob(part_number, thread_number, self.slot_connection_dict[thread_number], mirror)
+        slot = thread_number * slot_fields
+
+        # end of part is read and job is added with condition of part_scheduler,
+        # so the part is not splitted before the slot knows its end. see splitEnd
+        with self.part_scheduler.condition:
+            start = self.part_table.start[part_number] + self.part_table.downloaded[part_number]
+            end = self.part_table.end[part_number]
+            self.slot_array[slot + slot_control] = control_downloading
+            self.slot_array[slot + slot_end] = end
+            self.slot_array[slot + slot_position] = start
+            self.slot_array[slot + slot_reserved] = start
+            self.slot_array[slot + slot_hold_until] = 0
+            self.slot_event_list[thread_number].set()
+            job.position = start
+            self.job_dict[thread_number] = job
+
+        try:
+            job.connection.send((part_number, mirror.link, start, end, self.file_path))
+        except (OSError, ValueError) as error:
+            with self.part_scheduler.condition:
+                self.job_dict.pop(thread_number, None)
+            job.error = error
+            job.finished_event.set()
+
+        self.job_event.set()
+        job.finished_event.wait()
+
+        if job.error is None:
+            self.addStatistics(thread_number % self.number_of_processes, job.process_statistics)
+
+            if job.error_text:
+                error_text = 'part_number: ' + str(part_number) + ' ' + job.error_text
+                sendToLog(error_text)
+                self.observers.notify('on_error', error_text)
+                self.mirror_list.addFailure(mirror)
+
+        # worker process is terminated. Pipes of a process are closed before is_alive returns False,
+        # so the connection of this thread is removed and the next parts are downloaded by this thread.
+        # It's not an error of the part, so no number is added to the number of retries.
+        else:
+            error_text = 'part_number: ' + str(part_number) + ' worker process error: ' + str(job.error)
+            sendToLog(error_text, 'ERROR')
+            self.observers.notify('on_error', error_text)
+            self.slot_connection_dict.pop(thread_number, None)
+            job.connection.close()
+            self.part_table.retry[part_number] -= 1
+
+        # this thread doesn't download the part anymore.
+        # It must be called before releasing the part, because another thread may take the part after releasing.
+        self.leavePart(part_number, thread_number)
+        self.mirror_list.leave(mirror)
+
+        if self.part_table.downloaded[part_number] == self.part_table.partSize(part_number):
+            self.mirror_list.addSuccess(mirror)
+            self.completePart(part_number)
+        elif job.is_break or job.result == 'stopped':
+            self.part_scheduler.release(part_number, PartStatus.STOPPED)
+        else:
+            self.part_scheduler.release(part_number, PartStatus.ERROR)
+
+    # this method waits for results of all running jobs with one multiprocessing.connection.wait call and
+    # updates progress and control of their slots every progress_interval seconds.
+    # It runs until worker processes are stopped and results of all jobs are received.
+    def monitorHandler(self):
+        while not self.monitor_stopped or self.job_dict:
+            job_list = list(self.job_dict.values())
+            if not job_list:
+                self.job_event.wait()
+                self.job_event.clear()
+                continue
+
+            try:
+                ready_list = multiprocessing.connection.wait([job.connection for job in job_list],
+                                                             self.progress_interval)
+            except (OSError, ValueError):
+                # connection of a job is closed by its thread, because sending the part failed.
+                continue
+
+            for job in job_list:
+                self.updateJob(job, job.connection in ready_list)
+
+    # this method updates downloaded size of the part from slot and sets control of slot.
+    # If finished is True, result of the job is received and the download thread of job is woken.
+    def updateJob(self, job, finished):
+        part_number = job.part_number
+        thread_number = job.thread_number
+        slot = thread_number * slot_fields
+
+        if finished:
+            try:
+                job.result, job.error_text, job.process_statistics = job.connection.recv()
+            except (EOFError, OSError, ValueError) as error:
+                job.error = error
+
+        # update downloaded size of the part.
+        # bytes that are written before sending result are added too.
+        new_position = self.slot_array[slot + slot_position]
+        if new_position > job.position:
+            self.addSlotProgress(part_number, job.position, new_position - job.position, thread_number, job.mirror)
+            job.position = new_position
+
+        if finished:
+            with self.part_scheduler.condition:
+                self.job_dict.pop(thread_number, None)
+            job.finished_event.set()
+            return
+
+        if self.download_status not in ['downloading', 'paused']:
+            job.is_break = True
+            self.setControl(thread_number, control_stop)
+
+        # this part is completed by another thread or this thread is dropped by checkLowestSpeed.
+        elif not self.ownsPart(part_number, thread_number):
+            if self.slot_array[slot + slot_control] != control_stop:
+                # This loop does not end due to an error in the request.
+                # Therefore, no number should be added to the number of retries.
+                self.part_table.retry[part_number] -= 1
+                self.setControl(thread_number, control_stop)
+
+        elif self.download_status == 'paused':
+            self.setControl(thread_number, control_paused)
+        else:
+            self.setControl(thread_number, control_downloading)
+
+    # paused connection of worker process waits for event of its slot.
+    # So event is cleared before pausing and set after resuming or stopping.
+    def setControl(self, thread_number, control):
+        slot = thread_number * slot_fields
+        if self.slot_array[slot + slot_control] == control:
+            return
+
+        if control == control_paused:
+            self.slot_event_list[thread_number].clear()
+            self.slot_array[slot + slot_control] = control
+        else:
+            self.slot_array[slot + slot_control] = control
+            self.slot_event_list[thread_number].set()
+
+    # this method moves end of the slots that download the splitted part.
+    # The locks of the slots are held, so worker processes don't write after the new end.
+    # If a worker process has reserved bytes after end, the part is splitted after them.
+    # It's called with condition of part_scheduler, before the new part is given to another thread.
+    def splitEnd(self, part_number, end):
+        thread_list = sorted(thread_number for thread_number, job in list(self.job_dict.items())
+                             if job.part_number == part_number)
+        lock_list = [self.slot_lock_list[thread_number] for thread_number in thread_list]
+
+        for lock in lock_list:
+            lock.acquire()
+        try:
+            for thread_number in thread_list:
+                end = max(end, self.slot_array[thread_number * slot_fields + slot_reserved])
+
+            # the rest of the part is too small for a new part.
+            if self.part_table.end[part_number] - end < self.part_scheduler.min_split_size:
+                return None
+
+            for thread_number in thread_list:
+                self.slot_array[thread_number * slot_fields + slot_end] = end
+            return end
+        finally:
+            for lock in lock_list:
+                lock.release()
+
+    # size bytes of the part are written at offset by worker process.
+    # Parts are hashed from download file when they are complete. see savePartDigest
+    # If download speed is limited by limit_value, the connection waits in worker process until slot_hold_until.
+    # Tokens of speed_limiter are taken by worker process.
+    def addSlotProgress(self, part_number, offset, size, thread_number, mirror):
+        update_size = self.part_scheduler.updatePart(part_number, offset, size)
+        self.addProgress(part_number, update_size, size, thread_number)
+        self.mirror_list.addData(mirror, size)
+
+        if self.speed_limiter.rate is not None:
+            return
+
+        speed_limit_delay = self.speedLimitDelay(size)
+        if speed_limit_delay:
+            slot = thread_number * slot_fields
+            hold_until = int((time.monotonic() + speed_limit_delay) * 10**6)
+            self.slot_array[slot + slot_hold_until] = max(hold_until, self.slot_array[slot + slot_hold_until])
+
+    # this method adds the new statistics of worker process to connection_statistics.
+    # Worker process sends its total numbers, so only the difference with the last numbers is added.
+    def addStatistics(self, process_number, process_statistics):
+        if self.connection_statistics is None:
+            return
+
+        with self.statistics_lock:
+            last_statistics = self.process_statistics_list[process_number]
+            difference = [max(new - last, 0) for new, last in zip(process_statistics, last_statistics)]
+            self.process_statistics_list[process_number] = [max(new, last)
+                                                            for new, last in zip(process_statistics, last_statistics)]
+
+        with self.connection_statistics.lock:
+            self.connection_statistics.new_connections += difference[0]
+            self.connection_statistics.reused_connections += difference[1]
+            self.connection_statistics.throttled_responses += difference[2]
+            self.connection_statistics.failed_requests += difference[3]
+
+    # worker processes exit after their connections are closed.
+    # Monitor thread is stopped after worker processes, so it receives results of the last jobs.
+    def stopWorkerProcesses(self):
+        for connection in list(self.slot_connection_dict.values()):
+            try:
+                connection.send(None)
+            except (OSError, ValueError):
+                pass
+
+        for process in self.process_list:
+            process.join(self.timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.process_list = []
+
+        self.monitor_stopped = True
+        self.job_event.set()
+        if self.monitor_thread is not None:
+            self.monitor_thread.join()
+            self.monitor_thread = None
+
+        for connection in list(self.slot_connection_dict.values()):
+            connection.close()
+        self.slot_connection_dict = {}
+
+    def close(self):
+        super().close()
+
+        self.stopWorkerProcesses()
+
+
+# SlotJob is a part that is sent to a connection of worker process.
+# Download thread waits for finished_event and monitor thread sets it after receiving result of the job.
+# error is the exception of pipe, if worker process is terminated.
+class SlotJob():
+    def __init__(self, part_number, thread_number, connection, mirror):
+        self.part_number = part_number
+        self.thread_number = thread_number
+        self.connection = connection
+        self.mirror = mirror
+
+        # bytes of the part before position are added to part_table.
+        self.position = 0
+        self.is_break = False
+
+        self.result = 'error'
+        self.error_text = None
+        self.process_statistics = [0] * statistics_fields
+        self.error = None
+        self.finished_event = threading.Event()
+
+
+# SharedTokenBucket is a TokenBucket in shared memory of a multiprocessing context.
+# It's sent to worker processes when they are started, so main process and worker processes use the same tokens.
+# rate, capacity, tokens and last_time are saved in state. None is saved as -1.
+class SharedTokenBucket(TokenBucket):
+    def __init__(self, context, rate=None, capacity=None):
+        self.state = context.RawArray('d', [-1, -1, 0, time.monotonic()])
+        self.lock = context.Lock()
+        self.setRate(rate, capacity)
+
+    def getState(self, index):
+        value = self.state[index]
+        return None if value == -1 else value
+
+    def setState(self, index, value):
+        self.state[index] = -1 if value is None else value
+
+    @property
+    def rate(self):
+        return self.getState(0)
+
+    @rate.setter
+    def rate(self, value):
+        self.setState(0, value)
+
+    @property
+    def capacity(self):
+        return self.getState(1)
+
+    @capacity.setter
+    def capacity(self, value):
+        self.setState(1, value)
+
+    # tokens can be negative, so it's saved without changing.
+    @property
+    def tokens(self):
+        return self.state[2]
+
+    @tokens.setter
+    def tokens(self, value):
+        self.state[2] = value
+
+    @property
+    def last_time(self):
+        return self.getState(3)
+
+    @last_time.setter
+    def last_time(self, value):
+        self.setState(3, value)
+
+
+# this function runs in worker process. Every connection of slot_list is served by a thread.
+def workerProcess(download_arguments, process_number, slot_list, connection_list, slot_array, speed_limiter,
+                  lock_list, event_list):
+    # Ctrl+C stops download in main process. Then main process stops this process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    add_link_dictionary, args, kwargs = download_arguments
+    download_item = Download(add_link_dictionary, *args, **kwargs)
+    download_item.createSession()
+    download_item.setRetry()
+    download_item.speed_limiter = speed_limiter
+
+    if download_item.receive_mode == 'readinto':
+        download_item.buffer_pool = BufferPool(download_item.receive_buffer_size, len(slot_list))
+
+    worker = ProcessWorker(download_item, process_number, slot_array)
+
+    thread_list = []
+    for thread_number, connection, lock, event in zip(slot_list, connection_list, lock_list, event_list):
+        thread = threading.Thread(target=worker.connectionHandler, args=(thread_number, connection, lock, event))
+        thread.daemon = True
+        thread.start()
+        thread_list.append(thread)
+
+    for thread in thread_list:
+        thread.join()
+
+    worker.close()
+    download_item.requests_session.close()
+
+
+# ProcessWorker downloads the parts that main process sends to connections of worker process.
+# download_item is a Download object in worker process. Its session and receiveData are used.
+class ProcessWorker():
+    def __init__(self, download_item, process_number, slot_array):
+        self.download_item = download_item
+        self.process_number = process_number
+        self.slot_array = slot_array
+
+        # download file is opened when the first part is received.
+        self.output_sink = None
+        self.output_sink_lock = threading.Lock()
+
+    def openOutputSink(self, file_path):
+        with self.output_sink_lock:
+            if self.output_sink is None:
+                self.output_sink = OutputSink(file_path)
+                self.output_sink.open()
+
+    # this method receives parts from main process until the connection is closed.
+    # lock and event belong to the slot of connection. see downloadPart
+    def connectionHandler(self, thread_number, connection, lock, event):
+        self.download_item.connection_rate_dict[thread_number] = RateEstimator()
+        while True:
+            try:
+                job = connection.recv()
+            except (EOFError, OSError):
+                break
+
+            if job is None:
+                break
+
+            result, error_text = self.downloadPart(thread_number, lock, event, *job)
+            try:
+                connection.send((result, error_text, self.statistics()))
+            except (EOFError, OSError):
+                break
+
+        connection.close()
+
+    # this method returns numbers of connection_statistics of worker process.
+    def statistics(self):
+        connection_statistics = self.download_item.connection_statistics
+        with connection_statistics.lock:
+            return [connection_statistics.new_connections,
+                    connection_statistics.reused_connections,
+                    connection_statistics.throttled_responses,
+                    connection_statistics.failed_requests]
+
+    # this method downloads from start to the end of part in slot and writes progress in slot.
+    # Every write is reserved in slot with lock, so main process doesn't split the part before the written bytes.
+    # Paused connection waits until main process sets event.
+    # It returns result and error text. result is 'complete', 'stopped' or 'error'.
+    def downloadPart(self, thread_number, lock, event, part_number, link, start, end, file_path):
+        download_item = self.download_item
+        slot = thread_number * slot_fields
+        response = None
+        offset = start
+        try:
+            self.openOutputSink(file_path)
+
+            # end byte number of the part is not part of it.
+            chunk_headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+            response = download_item.requests_session.get(
+                link, headers=chunk_headers, allow_redirects=True, stream=True,
+                timeout=download_item.timeout, verify=download_item.check_certificate)
+
+            # server must send the requested range.
+            if not (response.status_code == 206 or (response.status_code == 200 and start == 0)):
+                raise ConnectionError('HTTP error - ' + str(response.status_code) + ' ' + response.reason)
+
+            for data in download_item.receiveData(response, thread_number):
+                # main process moves end of part backward when the part is splitted.
+                with lock:
+                    part_end = self.slot_array[slot + slot_end]
+                    if len(data) > (part_end - offset):
+                        data = data[:max(part_end - offset, 0)]
+                    self.slot_array[slot + slot_reserved] = offset + len(data)
+
+                self.output_sink.write(offset, data)
+                offset += len(data)
+                self.slot_array[slot + slot_position] = offset
+                download_item.connection_rate_dict[thread_number].add(len(data))
+
+                # If the end of part moved backward by splitting, the rest of the response belongs to another part.
+                # Else the response is finished too and its connection returns to the pool after the loop.
+                if offset >= part_end and part_end != end:
+                    return 'complete', None
+
+                if self.slot_array[slot + slot_control] == control_stop:
+                    return 'stopped', None
+
+                while self.slot_array[slot + slot_control] == control_paused:
+                    event.wait()
+
+                # speed limit in bytes per second.
+                if download_item.speed_limiter.rate is not None:
+                    speed_limit_delay = download_item.speedLimitDelay(len(data), thread_number)
+                    if speed_limit_delay:
+                        time.sleep(speed_limit_delay)
+
+                # speed limit of main process.
+                hold_time = (self.slot_array[slot + slot_hold_until] / 10**6) - time.monotonic()
+                if hold_time > 0:
+                    time.sleep(hold_time)
+
+            if offset >= self.slot_array[slot + slot_end]:
+                return 'complete', None
+            return 'error', 'Connection closed before receiving the whole part'
+
+        except Exception as e:
+            # connection failed during reading response. Failed requests are counted by http_adapter.
+            if response is not None:
+                download_item.connection_statistics.addFailure()
+            return 'error', str(e)
+
+        finally:
+            # If response is read completely, its connection is already returned to the pool for reusing.
+            # Else the connection is closed.
+            if response is not None:
+                response.close()
+
+    def close(self):
+        if self.output_sink is not None:
+            self.output_sink.close()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import threading
+import time
+
+
+# RateEstimator calculates smoothed download rate in bytes per second.
+# Received bytes are collected for at least min_interval seconds and then rate of these bytes
+# is added to an exponentially weighted moving average.
+# Weight of old samples decays by time, so after time_constant seconds only 37% of the old rate remains.
+# So rate follows changes in a few seconds, but it doesn't jump by every chunk.
+# Rate decays to 0 when no data is received. e.g. download is paused or connection is stalled.
+class RateEstimator():
+    def __init__(self, time_constant=2, min_interval=0.1):
+        self.time_constant = time_constant
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+
+        # smoothed rate. It's None until the first data is received.
+        self.rate = None
+        # bytes that are received since the last update
+        self.pending_bytes = 0
+        self.total_bytes = 0
+        self.last_update_time = time.monotonic()
+
+    # add size bytes that are received now.
+    def add(self, size):
+        with self.lock:
+            # time before the first data is not counted.
+            # the first chunk starts the clock. Its bytes are received before the clock is started,
+            # so they are not counted in rate too.
+            if self.total_bytes == 0:
+                self.last_update_time = time.monotonic()
+            else:
+                self.pending_bytes += size
+
+            self.total_bytes += size
+            self.update(time.monotonic())
+
+    # this method returns smoothed rate in bytes per second.
+    def getRate(self):
+        with self.lock:
+            self.update(time.monotonic())
+            if self.rate is None:
+                return 0
+            return self.rate
+
+    # add pending bytes to moving average, if min_interval seconds is passed.
+    # lock must be acquired before calling this method.
+    def update(self, now):
+        elapsed_time = now - self.last_update_time
+        if elapsed_time < self.min_interval:
+            return
+
+        if self.rate is None:
+            if self.pending_bytes == 0:
+                return
+            self.rate = self.pending_bytes / elapsed_time
+        else:
+            weight = 1 - math.exp(-elapsed_time / self.time_constant)
+            self.rate += weight * ((self.pending_bytes / elapsed_time) - self.rate)
+
+        self.pending_bytes = 0
+        self.last_update_time = now
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+
+# TokenBucket limits download rate of all connections of a download.
+# Tokens are added to the bucket at rate bytes per second. Bucket can't hold more than capacity tokens,
+# so after an idle time only capacity bytes can be received without waiting.
+# When rate is set, bucket is empty and tokens are added after the first consume() call.
+# So time before receiving the first data, e.g. sending requests and creating download file, doesn't make a burst.
+# Every connection takes tokens for the data that it received. If there isn't enough tokens,
+# the bucket goes into debt and consume() returns the time that the connection must wait.
+# So the rate is correct even if chunks are bigger than capacity.
+# rate is None if download rate is unlimited.
+class TokenBucket():
+    # default capacity is the amount of data that is received in burst_time seconds.
+    burst_time = 0.25
+    min_capacity = 16 * 1024
+
+    def __init__(self, rate=None, capacity=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.capacity = None
+        self.tokens = 0
+        self.last_time = time.monotonic()
+        self.setRate(rate, capacity)
+
+    # change rate at runtime. rate is in bytes per second.
+    # 0 or None means unlimited.
+    def setRate(self, rate, capacity=None):
+        with self.lock:
+            self.addTokens()
+            if not rate:
+                self.rate = None
+                self.capacity = None
+                self.tokens = 0
+                return
+
+            if self.rate is None:
+                self.last_time = None
+
+            self.rate = float(rate)
+            if capacity is None:
+                capacity = max(self.rate * self.burst_time, self.min_capacity)
+            self.capacity = float(capacity)
+
+            # don't let old debt or old tokens of previous rate affect new rate much.
+            self.tokens = max(min(self.tokens, self.capacity), -self.capacity)
+
+    # add tokens for elapsed time since the last call.
+    # lock must be acquired before calling this method.
+    def addTokens(self):
+        now = time.monotonic()
+        if self.rate is not None and self.last_time is not None:
+            self.tokens = min(self.tokens + (now - self.last_time) * self.rate, self.capacity)
+        self.last_time = now
+
+    # take tokens for size bytes and return seconds that caller must wait before reading more data.
+    def consume(self, size):
+        with self.lock:
+            if self.rate is None:
+                return 0
+
+            self.addTokens()
+            self.tokens = self.tokens - size
+            if self.tokens >= 0:
+                return 0
+
+            return -self.tokens / self.rate
+
+    # give back tokens of size bytes that were taken by consume() but were not received.
+    def refund(self, size):
+        with self.lock:
+            if self.rate is None:
+                return
+
+            self.addTokens()
+            self.tokens = min(self.tokens + size, self.capacity)
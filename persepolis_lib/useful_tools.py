@@ -13,11 +13,11 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from pathlib import Path
 import urllib.parse
 import logging
 import os
-import requests
+import errno
+import re
 # define logging object
 logObj = logging.getLogger("Persepolis")
 logObj.setLevel(logging.INFO)
@@ -25,18 +25,43 @@ logObj.setLevel(logging.INFO)
 # don't show log in console
 logObj.propagate = False
 
-log_file = os.path.join(os.path.expanduser('~'), 'persepolis_lib_log.log')
+# Log is not written in a file until setupLogging is called. So importing persepolis_lib doesn't create any file.
+# NullHandler keeps errors out of console too.
+logObj.addHandler(logging.NullHandler())
 
-# create a file handler
-handler = logging.FileHandler(log_file)
-handler.setLevel(logging.INFO)
-# create a logging format
-formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
 
-# add the handlers to the logger
-logObj.addHandler(handler)
+# this function writes log in log_file. default is persepolis_lib_log.log in home directory.
+# Log file is opened when the first message is written.
+# It returns False if log file can't be written. e.g. home directory is read-only.
+def setupLogging(log_file=None):
+    if log_file is None:
+        log_file = os.path.join(os.path.expanduser('~'), 'persepolis_lib_log.log')
+
+    if os.path.exists(log_file):
+        writable = os.access(log_file, os.W_OK)
+    else:
+        writable = os.access(os.path.dirname(os.path.abspath(log_file)), os.W_OK)
+
+    if not writable:
+        return False
+
+    # remove file handler of the previous setupLogging call.
+    for handler in list(logObj.handlers):
+        if isinstance(handler, logging.FileHandler):
+            logObj.removeHandler(handler)
+            handler.close()
+
+    # create a file handler
+    handler = logging.FileHandler(log_file, delay=True)
+    handler.setLevel(logging.INFO)
+    # create a logging format
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+
+    # add the handlers to the logger
+    logObj.addHandler(handler)
+    return True
 
 
 def sendToLog(text="", type="INFO"):
@@ -44,6 +69,8 @@ def sendToLog(text="", type="INFO"):
         logObj.info(text)
     elif type == "ERROR":
         logObj.error(text)
+    elif type == "DEBUG":
+        logObj.debug(text)
     else:
         logObj.warning(text)
 
@@ -110,6 +137,24 @@ def convertHeaderToDictionary(headers):
     return dic
 
 
+# this function returns (first byte, last byte, total size) of Content-Range header.
+# e.g. 'bytes 0-999/1000' -> (0, 999, 1000). total size is None if it's unknown ('*').
+# It returns None if header is not valid.
+def parseContentRange(content_range):
+    if not content_range:
+        return None
+
+    match = re.match(r'\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*$', content_range)
+    if match is None:
+        return None
+
+    total_size = None
+    if match.group(3) != '*':
+        total_size = int(match.group(3))
+
+    return int(match.group(1)), int(match.group(2)), total_size
+
+
 def readCookieJar(load_cookies):
     jar = None
     if os.path.isfile(load_cookies):
@@ -117,7 +162,8 @@ def readCookieJar(load_cookies):
         cookies_txt = open(load_cookies, 'r')
 
         # Initialize RequestsCookieJar
-        jar = requests.cookies.RequestsCookieJar()
+        from requests.cookies import RequestsCookieJar
+        jar = RequestsCookieJar()
 
         for line in cookies_txt.readlines():
             words = line.split()
@@ -132,7 +178,9 @@ def readCookieJar(load_cookies):
 
 # get file name from link string.
 def getFileNameFromLink(link):
-    link = requests.utils.unquote(link)
+    from pathlib import Path
+
+    link = urllib.parse.unquote(link)
     parsed_linkd = urllib.parse.urlparse(link)
     file_name = Path(parsed_linkd.path).name
 
@@ -140,24 +188,85 @@ def getFileNameFromLink(link):
 
 
 # this function checks free space in hard disk.
+# Free space is the space that is available for users that are not root.
+# os.statvfs is not available on Windows. So shutil.disk_usage is used.
 def freeSpace(dir):
     try:
-        import psutil
-    except:
-        print('psutil is not installed!')
-        return None
+        if hasattr(os, 'statvfs'):
+            dir_space = os.statvfs(dir)
+            return int(dir_space.f_bavail * dir_space.f_frsize)
 
-    try:
-        dir_space = psutil.disk_usage(dir)
-        free_space = dir_space.free
-        return int(free_space)
+        import shutil
+        return int(shutil.disk_usage(dir).free)
 
     except Exception as e:
         # log in to the log file
-        print('persepolis couldn\'t find free space value:\n' + str(e))
+        sendToLog('persepolis couldn\'t find free space value: ' + str(e), 'ERROR')
         return None
 
 
+# this function allocates file_size bytes on disk for download file.
+# allocation_method can be:
+# 'fallocate': reserves disk blocks without writing them (os.posix_fallocate).
+# 'sparse': only sets the file size (ftruncate). Disk blocks are allocated while data is written.
+# 'zero': writes zero bytes to the file. This is the slowest method.
+# If 'fallocate' is not supported by os or file system, 'sparse' will be used.
+# is_canceled is a function that returns True if user canceled allocation.
+# It returns False if allocation is canceled.
+def allocateFile(fp, file_size, allocation_method='fallocate', is_canceled=None):
+    if is_canceled is None:
+        def is_canceled():
+            return False
+
+    if allocation_method == 'fallocate':
+        if hasattr(os, 'posix_fallocate'):
+            # Allocate 1 GiB in every step, so user can cancel allocation
+            # if file system doesn't support fallocate and glibc emulates it by writing.
+            STEP_SIZE = 1024**3
+            offset = 0
+            try:
+                while offset < file_size:
+                    if is_canceled():
+                        return False
+                    length = min(STEP_SIZE, file_size - offset)
+                    os.posix_fallocate(fp.fileno(), offset, length)
+                    offset += length
+                return True
+            except OSError as e:
+                # fallocate is not supported by file system.
+                if e.errno not in [errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL]:
+                    raise
+        allocation_method = 'sparse'
+
+    if allocation_method == 'sparse':
+        os.ftruncate(fp.fileno(), file_size)
+        return True
+
+    # sets the size of each chunk to 1MiB
+    CHUNK_SIZE = (1024 ** 2)
+    # creates a byte string of zeroes with a size of 1MiB.
+    # These bytes will be used for writing to the file later.
+    zero_chunk = b'\0' * CHUNK_SIZE
+    # This variable indicates how many bytes still need to be written.
+    remaining = file_size
+
+    # continue the loop until writing ends.
+    while remaining > 0:
+        if is_canceled():
+            return False
+        # determines how much data should be written in this iteration.
+        # This value can be equal to CHUNK_SIZE,
+        # but if remaining is less than CHUNK_SIZE, only the remaining amount will be written.
+        to_write = min(CHUNK_SIZE, remaining)
+
+        # writes the zero data up to the calculated amount (to_write) to the file.
+        fp.write(zero_chunk[:to_write])
+        # updates the remaining amount to indicate how much of the file still needs to be written.
+        remaining -= to_write
+
+    return True
+
+
 # Return a new name for the file, if a file with the current name exists.
 def returnNewFileName(folder_path, file_name):
     i = 1
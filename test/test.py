@@ -40,6 +40,7 @@ parent_dir = os.path.dirname(run_dir)
 sys.path.insert(0, parent_dir)
 
 from persepolis_lib.persepolis_lib import Download
+from persepolis_lib.useful_tools import setupLogging
 
 # create  terminal arguments
 parser = argparse.ArgumentParser(
@@ -165,6 +166,9 @@ else:
 
 
 if __name__ == '__main__':
+    # write log in ~/persepolis_lib_log.log
+    setupLogging()
+
     # create download object
     download_item = Download(add_link_dictionary, int(number_of_threads),
                              int(chunk_size), progress_bar=True, threads_progress_bar=False)
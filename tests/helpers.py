@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests download files from the local server of benchmark package.
+# run tests:
+#     python3 -m unittest discover tests
+# or
+#     python3 -m pytest
+
+import shutil
+import tempfile
+import unittest
+from benchmark.server import startServer, verifyFile
+
+
+# DownloadTestCase starts a local server and creates a temporary download folder for every test.
+class DownloadTestCase(unittest.TestCase):
+    bandwidth = 0
+    latency = 0
+
+    def setUp(self):
+        self.server = startServer(bandwidth=self.bandwidth, latency=self.latency)
+        self.port = self.server.server_address[1]
+        self.download_path = tempfile.mkdtemp(prefix='persepolis_test_')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.download_path, ignore_errors=True)
+
+    # this method returns add_link_dictionary for a file of file_size bytes on the local server.
+    def linkDictionary(self, file_size, out='file.bin'):
+        return {'link': 'http://127.0.0.1:%d/%d/file.bin' % (self.port, file_size),
+                'out': out,
+                'download_path': self.download_path,
+                'ip': None,
+                'port': None,
+                'proxy_user': None,
+                'proxy_passwd': None,
+                'proxy_type': None,
+                'download_user': None,
+                'download_passwd': None,
+                'header': None,
+                'user_agent': None,
+                'load_cookies': None,
+                'referer': None,
+                'check_certificate': True}
+
+    # this method checks that download is complete and its file matches the file of server.
+    def assertDownloaded(self, download_item, file_size):
+        self.assertEqual(download_item.download_status, 'complete')
+        self.assertTrue(verifyFile(download_item.file_path, file_size))
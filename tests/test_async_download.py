@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+from persepolis_lib.async_download import AsyncDownload
+from persepolis_lib.output_sink import QueuedOutputSink
+from persepolis_lib.part_scheduler import PartScheduler
+from persepolis_lib.part_table import PartTable
+from tests.helpers import DownloadTestCase
+
+
+class AsyncDownloadTest(DownloadTestCase):
+    def testDownload(self):
+        file_size = 8 * 1024**2
+        download_item = AsyncDownload(self.linkDictionary(file_size), 8, 100)
+        download_item.start()
+        self.assertDownloaded(download_item, file_size)
+
+    # writing to a slow disk must not block event loop.
+    # Every batch of the queue sink takes 0.3 seconds and the queue is small, so download tasks wait for it.
+    def testSlowDiskDoesNotBlockEventLoop(self):
+        file_size = 8 * 1024**2
+        write_batch = QueuedOutputSink.writeBatch
+
+        def slowWriteBatch(output_sink, *args):
+            time.sleep(0.3)
+            return write_batch(output_sink, *args)
+
+        download_item = AsyncDownload(self.linkDictionary(file_size), 8, 100, write_mode='queue')
+        download_item.write_queue_size = 1024**2
+
+        # this coroutine returns the longest delay of event loop during download.
+        async def runAndMeasureLag():
+            download_task = asyncio.ensure_future(download_item.run())
+            max_lag = 0
+            while not download_task.done():
+                begin_time = time.monotonic()
+                await asyncio.sleep(0.01)
+                max_lag = max(max_lag, time.monotonic() - begin_time - 0.01)
+            await download_task
+            return max_lag
+
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch.object(QueuedOutputSink, 'writeBatch', slowWriteBatch):
+                max_lag = loop.run_until_complete(runAndMeasureLag())
+        finally:
+            loop.close()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertLess(max_lag, 0.15)
+
+    # received chunks are passed to writer threads in batches, not one by one.
+    def testWritesAreBatched(self):
+        file_size = 8 * 1024**2
+        download_item = AsyncDownload(self.linkDictionary(file_size), 4, 64)
+        with mock.patch.object(AsyncDownload, 'storeData', autospec=True,
+                               side_effect=AsyncDownload.storeData) as store_data:
+            download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        number_of_chunks = file_size // (64 * 1024)
+        self.assertLess(store_data.call_count, number_of_chunks // 4)
+        self.assertEqual(sum(len(call.args[3]) for call in store_data.call_args_list), file_size)
+
+
+    # tasks that wait for a part are woken up by stop() from another thread without polling.
+    def testStopWakesWaitingTasks(self):
+        download_item = AsyncDownload(self.linkDictionary(1024**2), 8, 64)
+        download_item.part_table = PartTable()
+        download_item.part_table.addPart(0, 1024**2)
+        download_item.part_scheduler = PartScheduler(download_item.part_table, retry=0)
+        download_item.download_status = 'downloading'
+
+        # the only part is downloading by another task. So claimPart waits.
+        async def claimPart():
+            download_item.loop = asyncio.get_event_loop()
+            download_item.part_condition = asyncio.Condition()
+            self.assertEqual(download_item.part_scheduler.claim(), 0)
+
+            stop_timer = threading.Timer(0.2, download_item.stop)
+            stop_timer.start()
+            begin_time = time.monotonic()
+            part_number = await download_item.claimPart()
+            stop_timer.join()
+            return part_number, time.monotonic() - begin_time
+
+        loop = asyncio.new_event_loop()
+        try:
+            part_number, wait_time = loop.run_until_complete(claimPart())
+        finally:
+            loop.close()
+
+        self.assertIsNone(part_number)
+        self.assertLess(wait_time, 0.6)
+
+
+if __name__ == '__main__':
+    unittest.main()
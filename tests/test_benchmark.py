@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import http.client
+import time
+import unittest
+from benchmark.run_benchmark import parseSize, runCaseProcess
+from benchmark.server import fileContent
+from tests.helpers import DownloadTestCase
+
+
+class BenchmarkServerTest(DownloadTestCase):
+    file_size = 3 * 1024**2 + 100
+
+    def request(self, method='GET', headers={}):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        self.addCleanup(connection.close)
+        connection.request(method, '/%d/file.bin' % self.file_size, headers=headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def testHead(self):
+        response, body = self.request('HEAD')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, b'')
+        self.assertEqual(response.getheader('Content-Length'), str(self.file_size))
+        self.assertEqual(response.getheader('Accept-Ranges'), 'bytes')
+        self.assertEqual(response.getheader('ETag'), '"benchmark-%d"' % self.file_size)
+
+    def testWholeFile(self):
+        response, body = self.request()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, fileContent(0, self.file_size))
+
+    def testRange(self):
+        response, body = self.request(headers={'Range': 'bytes=1048570-2097160'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes 1048570-2097160/%d' % self.file_size)
+        self.assertEqual(body, fileContent(1048570, 2097160 - 1048570 + 1))
+
+    def testOpenAndSuffixRanges(self):
+        response, body = self.request(headers={'Range': 'bytes=%d-' % (self.file_size - 10)})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, fileContent(self.file_size - 10, 10))
+
+        response, body = self.request(headers={'Range': 'bytes=-500'})
+        self.assertEqual(body, fileContent(self.file_size - 500, 500))
+
+    def testInvalidRange(self):
+        response, body = self.request(headers={'Range': 'bytes=%d-' % self.file_size})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes */%d' % self.file_size)
+
+    # requests of a keep-alive connection are answered one by one.
+    def testKeepAlive(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        self.addCleanup(connection.close)
+        for start in (0, 1000):
+            connection.request('GET', '/%d/file.bin' % self.file_size,
+                               headers={'Range': 'bytes=%d-%d' % (start, start + 99)})
+            self.assertEqual(connection.getresponse().read(), fileContent(start, 100))
+
+
+class BandwidthTest(DownloadTestCase):
+    bandwidth = 1024**2
+
+    # every connection is limited by bandwidth of server.
+    def testBandwidth(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        self.addCleanup(connection.close)
+        begin_time = time.monotonic()
+        connection.request('GET', '/%d/file.bin' % (1024**2))
+        self.assertEqual(len(connection.getresponse().read()), 1024**2)
+        self.assertAlmostEqual(time.monotonic() - begin_time, 1, delta=0.2)
+
+
+class RunBenchmarkTest(DownloadTestCase):
+    def testParseSize(self):
+        self.assertEqual(parseSize('64M'), 64 * 1024**2)
+        self.assertEqual(parseSize('1.5k'), 1536)
+        self.assertEqual(parseSize('1000'), 1000)
+
+    # every case runs in a new process and reports its numbers.
+    def testRunCase(self):
+        case = {'engine': 'thread', 'size': 4 * 1024**2, 'threads': 4, 'chunk_size': 100, 'speed_limit': 0}
+        result = runCaseProcess(case, self.port)
+
+        self.assertEqual(result['status'], 'complete', result.get('error'))
+        self.assertTrue(result['verified'])
+        for key in ['mb_per_second', 'time_to_first_byte', 'cpu_seconds_per_gib', 'peak_rss_mib',
+                    'new_connections', 'reused_connections']:
+            self.assertIn(key, result)
+        self.assertGreater(result['mb_per_second'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
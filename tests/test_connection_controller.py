@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from persepolis_lib.connection_controller import ConnectionController
+
+
+class ConnectionControllerTest(unittest.TestCase):
+    # download rate grows with every new connection and connections are never decreased.
+    def testRampUpWithoutDecrease(self):
+        controller = ConnectionController(16, initial_connections=4, increase_step=2)
+        rate = 0
+        while controller.target_connections < 16:
+            rate += 10**6
+            controller.update(rate, 0)
+            self.assertIsNotNone(controller.settled_connections)
+
+        controller.update(rate * 2, 0)
+        self.assertEqual(controller.settled_connections, 16)
+
+    # new connections don't increase download rate.
+    def testFlatRate(self):
+        controller = ConnectionController(16, initial_connections=4, increase_step=2)
+        controller.update(10**6, 0)
+        controller.update(10**6, 0)
+        self.assertEqual(controller.settled_connections, 4)
+        self.assertEqual(controller.target_connections, 4)
+
+    # server errors decrease connections.
+    def testDecrease(self):
+        controller = ConnectionController(16, initial_connections=8)
+        controller.update(10**6, 3)
+        self.assertEqual(controller.settled_connections, 4)
+        self.assertEqual(controller.target_connections, 4)
+
+    # download is finished before the first interval.
+    def testFinishBeforeFirstInterval(self):
+        controller = ConnectionController(16, initial_connections=4)
+        self.assertIsNone(controller.settled_connections)
+        controller.finish()
+        self.assertEqual(controller.settled_connections, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from persepolis_lib.control_journal import ControlJournal, JOURNAL_HEADER, RECORD_SIZE
+from persepolis_lib.output_sink import OutputSink
+from persepolis_lib.part_table import PartTable, PartStatus
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# this function returns a table of number_of_parts parts of 1 MiB.
+def createPartTable(number_of_parts):
+    part_table = PartTable()
+    for i in range(0, number_of_parts):
+        part_table.addPart(i * 1024**2, (i + 1) * 1024**2)
+    return part_table
+
+
+class ControlJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='persepolis_test_')
+        self.control_file_path = os.path.join(self.directory, 'file.bin.persepolis')
+        self.control_journal = ControlJournal(self.control_file_path)
+
+    def tearDown(self):
+        self.control_journal.closeJournal()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # this method writes a snapshot of part_table and returns journal_id of control file.
+    def writeSnapshot(self, part_table):
+        self.control_journal.writeSnapshot({'part_table': part_table.toDict()})
+        with open(self.control_file_path) as control_file:
+            return json.load(control_file)['journal_id']
+
+    # this method returns part_table of control file with the records of journal.
+    def readPartTable(self):
+        with open(self.control_file_path) as control_file:
+            control_dict = json.load(control_file)
+        part_table = PartTable.fromDict(control_dict['part_table'])
+        number_of_records = ControlJournal(self.control_file_path).replay(part_table, control_dict['journal_id'])
+        return part_table, number_of_records
+
+    def testReplay(self):
+        self.writeSnapshot(createPartTable(2))
+
+        # part 0 is complete, part 1 is splitted and its upper half is part 2.
+        self.control_journal.append([(0, 0, 1024**2, 1024**2, 0, PartStatus.COMPLETE),
+                                     (1, 1024**2, 1536 * 1024, 1000, 0, PartStatus.DOWNLOADING),
+                                     (2, 1536 * 1024, 2 * 1024**2, 2000, 0, PartStatus.DOWNLOADING)])
+
+        part_table, number_of_records = self.readPartTable()
+        self.assertEqual(number_of_records, 3)
+        self.assertEqual(len(part_table), 3)
+        self.assertEqual(part_table.status[0], PartStatus.COMPLETE)
+        self.assertEqual(part_table.end[1], 1536 * 1024)
+        self.assertEqual(part_table.start[2], 1536 * 1024)
+        self.assertEqual(list(part_table.downloaded), [1024**2, 1000, 2000])
+
+    # a record that is cut by crash ends the journal.
+    def testTruncatedRecord(self):
+        self.writeSnapshot(createPartTable(2))
+        self.control_journal.append([(0, 0, 1024**2, 1000, 0, PartStatus.DOWNLOADING)])
+        self.control_journal.append([(1, 1024**2, 2 * 1024**2, 2000, 0, PartStatus.DOWNLOADING)])
+        self.control_journal.closeJournal()
+
+        journal_file_path = self.control_file_path + '.journal'
+        with open(journal_file_path, 'r+b') as journal_file:
+            journal_file.truncate(os.path.getsize(journal_file_path) - 3)
+
+        part_table, number_of_records = self.readPartTable()
+        self.assertEqual(number_of_records, 1)
+        self.assertEqual(list(part_table.downloaded), [1000, 0])
+
+    # a record with wrong crc and the records after it are not applied.
+    def testCorruptRecord(self):
+        self.writeSnapshot(createPartTable(3))
+        self.control_journal.append([(0, 0, 1024**2, 1000, 0, PartStatus.DOWNLOADING),
+                                     (1, 1024**2, 2 * 1024**2, 2000, 0, PartStatus.DOWNLOADING),
+                                     (2, 2 * 1024**2, 3 * 1024**2, 3000, 0, PartStatus.DOWNLOADING)])
+        self.control_journal.closeJournal()
+
+        # change downloaded size of the second record.
+        with open(self.control_file_path + '.journal', 'r+b') as journal_file:
+            journal_file.seek(JOURNAL_HEADER.size + RECORD_SIZE + 20)
+            journal_file.write(b'\xff')
+
+        part_table, number_of_records = self.readPartTable()
+        self.assertEqual(number_of_records, 1)
+        self.assertEqual(list(part_table.downloaded), [1000, 0, 0])
+
+    # journal of an older snapshot is ignored.
+    def testJournalOfOlderSnapshot(self):
+        journal_id = self.writeSnapshot(createPartTable(1))
+        self.control_journal.append([(0, 0, 1024**2, 1000, 0, PartStatus.DOWNLOADING)])
+
+        part_table = createPartTable(1)
+        self.assertEqual(ControlJournal(self.control_file_path).replay(part_table, '00' * 8), 0)
+        self.assertEqual(ControlJournal(self.control_file_path).replay(part_table, journal_id), 1)
+
+    # compaction writes all parts in control file and starts an empty journal with a new id.
+    def testCompaction(self):
+        part_table = createPartTable(1)
+        old_journal_id = self.writeSnapshot(part_table)
+        for downloaded in range(1, 1026):
+            self.control_journal.append([(0, 0, 1024**2, downloaded, 0, PartStatus.DOWNLOADING)])
+            part_table.downloaded[0] = downloaded
+        self.assertTrue(self.control_journal.needsCompaction(len(part_table)))
+
+        new_journal_id = self.writeSnapshot(part_table)
+        self.assertNotEqual(new_journal_id, old_journal_id)
+        self.assertFalse(self.control_journal.needsCompaction(len(part_table)))
+        self.assertEqual(os.path.getsize(self.control_file_path + '.journal'), JOURNAL_HEADER.size)
+
+        part_table, number_of_records = self.readPartTable()
+        self.assertEqual(number_of_records, 0)
+        self.assertEqual(part_table.downloaded[0], 1025)
+
+    # all records of a checkpoint are written by one write and synced by one fdatasync (group commit).
+    def testGroupCommit(self):
+        self.writeSnapshot(createPartTable(100))
+        records = [(i, i * 1024**2, (i + 1) * 1024**2, 1000, 0, PartStatus.DOWNLOADING) for i in range(0, 100)]
+
+        with mock.patch('os.write', side_effect=os.write) as os_write, \
+                mock.patch('os.fdatasync', side_effect=os.fdatasync) as os_fdatasync:
+            self.control_journal.append(records)
+
+        self.assertEqual(os_write.call_count, 1)
+        self.assertEqual(os_fdatasync.call_count, 1)
+        self.assertEqual(os.path.getsize(self.control_file_path + '.journal'), JOURNAL_HEADER.size + 100 * RECORD_SIZE)
+
+    # control file is replaced by renaming, so the old control file stays valid until the new one is complete.
+    def testSnapshotIsAtomic(self):
+        old_journal_id = self.writeSnapshot(createPartTable(1))
+        with mock.patch('os.replace', side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                self.control_journal.writeSnapshot({'part_table': createPartTable(2).toDict()})
+
+        part_table, number_of_records = self.readPartTable()
+        self.assertEqual(len(part_table), 1)
+        with open(self.control_file_path) as control_file:
+            self.assertEqual(json.load(control_file)['journal_id'], old_journal_id)
+
+
+class CheckpointTest(DownloadTestCase):
+    bandwidth = 4 * 1024**2
+
+    # download file is synced before the changed parts are appended to journal.
+    # So journal never describes data that is not on the disk.
+    def testDataIsSyncedBeforeJournal(self):
+        call_list = []
+        sync = OutputSink.sync
+        append = ControlJournal.append
+
+        def syncData(output_sink):
+            call_list.append('sync')
+            return sync(output_sink)
+
+        def appendRecords(control_journal, records):
+            call_list.append('append')
+            return append(control_journal, records)
+
+        file_size = 8 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 4, 100)
+        with mock.patch.object(OutputSink, 'sync', syncData), \
+                mock.patch.object(ControlJournal, 'append', appendRecords):
+            download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertIn('append', call_list)
+        for index, call in enumerate(call_list):
+            if call == 'append':
+                self.assertEqual(call_list[index - 1], 'sync')
+
+
+# this script downloads the file slowly until it's killed.
+crash_script = '''
+import sys
+from persepolis_lib.persepolis_lib import Download
+download_item = Download(eval(sys.argv[1]), 4, 100)
+download_item.limitSpeed(bytes_per_second=2 * 1024**2)
+download_item.start()
+'''
+
+
+class ResumeAfterCrashTest(DownloadTestCase):
+    # download process is killed. Parts that are saved in control file and journal are not downloaded again.
+    def testResumeAfterCrash(self):
+        file_size = 16 * 1024**2
+        link_dictionary = self.linkDictionary(file_size)
+        file_path = os.path.join(self.download_path, 'file.bin')
+        control_file_path = file_path + '.persepolis'
+
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = parent_dir + os.pathsep + environment.get('PYTHONPATH', '')
+        process = subprocess.Popen([sys.executable, '-c', crash_script, repr(link_dictionary)], env=environment,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # wait until some checkpoints are appended to journal.
+            deadline = time.monotonic() + 30
+            while time.monotonic() < deadline:
+                if os.path.isfile(control_file_path + '.journal') and \
+                        os.path.getsize(control_file_path + '.journal') > JOURNAL_HEADER.size + 4 * RECORD_SIZE:
+                    break
+                time.sleep(0.1)
+        finally:
+            process.kill()
+            process.wait()
+
+        with open(control_file_path) as control_file:
+            control_dict = json.load(control_file)
+        part_table = PartTable.fromDict(control_dict['part_table'])
+        self.assertGreater(ControlJournal(control_file_path).replay(part_table, control_dict['journal_id']), 0)
+        saved_size = part_table.totalDownloaded()
+        self.assertGreater(saved_size, 0)
+        self.assertLess(saved_size, file_size)
+
+        download_item = Download(link_dictionary, 4, 100)
+        download_item.start()
+
+        self.assertTrue(download_item.resume)
+        self.assertDownloaded(download_item, file_size)
+        self.assertFalse(os.path.exists(control_file_path))
+        self.assertFalse(os.path.exists(control_file_path + '.journal'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import unittest
+import warnings
+from unittest import mock
+from requests.adapters import HTTPAdapter
+import persepolis_lib
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+package_dir = os.path.dirname(os.path.abspath(persepolis_lib.__file__))
+
+
+class DownloadTest(DownloadTestCase):
+    # this method downloads a file and returns number of connections that are opened by warmUpConnections.
+    def downloadAndCountWarmConnections(self, **kwargs):
+        file_size = 8 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 8, 100, **kwargs)
+        with mock.patch.object(Download, 'openConnection', autospec=True,
+                               side_effect=Download.openConnection) as open_connection:
+            download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        return open_connection.call_count
+
+    # number of parts doesn't depend on number of threads and it can be more than 64.
+    def testMoreThan64Parts(self):
+        file_size = 80 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 4, 100, part_size=1)
+        download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(download_item.number_of_threads, 4)
+        self.assertGreaterEqual(len(download_item.part_table), 80)
+        self.assertEqual(download_item.part_table.totalDownloaded(), file_size)
+
+    # persepolis_lib doesn't use deprecated methods of python.
+    def testNoDeprecationWarnings(self):
+        with warnings.catch_warnings(record=True) as warning_list:
+            warnings.simplefilter('always')
+            self.downloadAndCountWarmConnections()
+
+        deprecation_list = [str(warning.message) for warning in warning_list
+                            if issubclass(warning.category, DeprecationWarning) and
+                            os.path.abspath(warning.filename).startswith(package_dir)]
+        self.assertEqual(deprecation_list, [])
+
+    # connections of download threads are opened while download file is created.
+    def testWarmUpConnections(self):
+        self.assertGreater(self.downloadAndCountWarmConnections(), 0)
+
+    # only connect_concurrency connections are opened while download file is created.
+    # Connection of HEAD request is open already, so one of them is not opened again.
+    def testWarmUpConcurrency(self):
+        self.assertEqual(self.downloadAndCountWarmConnections(connect_concurrency=3), 2)
+
+    # connections are opened by download threads. No other thread is started for warm-up.
+    def testWarmUpThreads(self):
+        target_list = []
+
+        file_size = 8 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 8, 100, connect_concurrency=4)
+
+        # threads of server are not recorded.
+        class RecordingThread(threading.Thread):
+            def __init__(self, *args, **kwargs):
+                if getattr(kwargs.get('target'), '__self__', None) is download_item:
+                    target_list.append(kwargs['target'])
+                super().__init__(*args, **kwargs)
+
+        with mock.patch('threading.Thread', RecordingThread):
+            download_item.prepareDownload()
+            prepare_target_list = list(target_list)
+            download_item.runDownloadThreads()
+            download_item.checkDownloadProgress()
+        download_item.close()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(prepare_target_list, [download_item.threadHandler] * 4)
+        self.assertEqual(target_list.count(download_item.threadHandler), download_item.number_of_threads)
+
+    # requests older than 2.32 doesn't have get_connection_with_tls_context.
+    # requests sends requests by it, so only warmUpConnections runs without it.
+    def testWarmUpConnectionsWithOldRequests(self):
+        download_item = Download(self.linkDictionary(8 * 1024**2), 8, 100)
+        download_item.createSession()
+        download_item.getFileSize()
+        download_item.resumingSupport()
+
+        # connection is returned to pool immediately.
+        download_item.parts_ready_event.set()
+
+        get_connection_with_tls_context = HTTPAdapter.get_connection_with_tls_context
+        del HTTPAdapter.get_connection_with_tls_context
+        try:
+            with warnings.catch_warnings(), \
+                    mock.patch.object(Download, 'openConnection', autospec=True,
+                                      side_effect=Download.openConnection) as open_connection:
+                # get_connection is deprecated in new versions of requests.
+                warnings.simplefilter('ignore', DeprecationWarning)
+                download_item.warmUpConnection()
+        finally:
+            HTTPAdapter.get_connection_with_tls_context = get_connection_with_tls_context
+            download_item.close()
+
+        self.assertGreater(open_connection.call_count, 0)
+        for call in open_connection.call_args_list:
+            self.assertTrue(getattr(call.args[1], 'warm_connection', False))
+
+
+if __name__ == '__main__':
+    unittest.main()
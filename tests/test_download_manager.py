@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+from persepolis_lib.download_manager import DownloadManager
+from benchmark.server import BenchmarkRequestHandler, BenchmarkServer, verifyFile
+from tests.helpers import DownloadTestCase
+
+
+# CountingCondition counts the times that waiting threads wake up.
+class CountingCondition(threading.Condition):
+    wake_ups = 0
+
+    def wait(self, timeout=None):
+        result = super().wait(timeout)
+        CountingCondition.wake_ups += 1
+        return result
+
+
+# CountingRequestHandler counts open connections of server and saves the maximum number of them.
+class CountingRequestHandler(BenchmarkRequestHandler):
+    lock = threading.Lock()
+    open_connections = 0
+    max_open_connections = 0
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            CountingRequestHandler.open_connections += 1
+            CountingRequestHandler.max_open_connections = max(CountingRequestHandler.max_open_connections,
+                                                              CountingRequestHandler.open_connections)
+
+    def finish(self):
+        with self.lock:
+            CountingRequestHandler.open_connections -= 1
+        super().finish()
+
+
+class DownloadManagerTest(DownloadTestCase):
+    # downloads of manager don't write on console.
+    def testDownloadsWithoutConsoleOutput(self):
+        file_size = 2 * 1024**2
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            manager = DownloadManager(max_active_downloads=2, max_connections=8, number_of_threads=4)
+            for i in range(0, 3):
+                manager.add(self.linkDictionary(file_size, out='file%d.bin' % i))
+            self.assertTrue(manager.join(timeout=60))
+            status_list = manager.tellAll()
+            manager.close()
+
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual([status['status'] for status in status_list], ['complete'] * 3)
+        for i in range(0, 3):
+            self.assertTrue(verifyFile(os.path.join(self.download_path, 'file%d.bin' % i), file_size))
+
+    # worker threads and housekeeping thread don't wake up when no download is active.
+    def testIdleThreadsDontWakeUp(self):
+        with mock.patch('persepolis_lib.download_manager.threading.Condition', CountingCondition):
+            manager = DownloadManager(max_active_downloads=2, max_connections=16, number_of_threads=4)
+
+        manager.add(self.linkDictionary(1024**2))
+        self.assertTrue(manager.join(timeout=60))
+
+        # wait until finished download is closed and threads are waiting again.
+        time.sleep(0.5)
+        wake_ups = CountingCondition.wake_ups
+        time.sleep(1.5)
+        self.assertEqual(CountingCondition.wake_ups, wake_ups)
+
+        manager.close()
+        self.assertEqual(manager.tellAll()[0]['status'], 'complete')
+
+
+
+class ConnectionLimitTest(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server.shutdown()
+        self.server.server_close()
+
+        CountingRequestHandler.open_connections = 0
+        CountingRequestHandler.max_open_connections = 0
+        self.server = BenchmarkServer(('127.0.0.1', 0), CountingRequestHandler)
+        self.port = self.server.server_address[1]
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    # server never has more than max_connections connections of manager.
+    def testMaxConnections(self):
+        file_size = 64 * 1024**2
+        manager = DownloadManager(max_active_downloads=4, max_connections=8)
+        for i in range(0, 4):
+            manager.add(self.linkDictionary(file_size, out='file%d.bin' % i))
+        self.assertTrue(manager.join(timeout=120))
+        status_list = manager.tellAll()
+        manager.close()
+
+        self.assertEqual([status['status'] for status in status_list], ['complete'] * 4)
+        for i in range(0, 4):
+            self.assertTrue(verifyFile(os.path.join(self.download_path, 'file%d.bin' % i), file_size))
+        self.assertLessEqual(CountingRequestHandler.max_open_connections, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+from unittest import mock
+from benchmark.server import BenchmarkRequestHandler, BenchmarkServer
+from persepolis_lib.part_scheduler import PartScheduler
+from persepolis_lib.part_table import PartTable
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+
+# SlowFirstRequestHandler sends the first GET request slowly. Other requests are sent without limit.
+class SlowFirstRequestHandler(BenchmarkRequestHandler):
+    lock = threading.Lock()
+    number_of_requests = 0
+    slow_bandwidth = 32 * 1024
+    # Range header of the slow request
+    slow_range = None
+
+    def do_GET(self):
+        with self.lock:
+            SlowFirstRequestHandler.number_of_requests += 1
+            if SlowFirstRequestHandler.number_of_requests == 1:
+                SlowFirstRequestHandler.slow_range = self.headers.get('Range')
+                self.bandwidth = self.slow_bandwidth
+        self.sendFile(send_body=True)
+
+
+class HedgePartTest(unittest.TestCase):
+    def setUp(self):
+        self.part_table = PartTable()
+        self.part_table.addPart(0, 1024**2)
+        self.part_table.addPart(1024**2, 2 * 1024**2)
+        self.rate_dict = {0: 100 * 1024, 1: 10 * 1024}
+        self.part_scheduler = PartScheduler(self.part_table, retry=0, min_split_size=1024**2, end_game=True,
+                                            rate_function=self.rate_dict.get)
+        self.part_scheduler.claim()
+        self.part_scheduler.claim()
+
+    # the part that finishes last is given to the second connection.
+    def testSlowestPartIsHedged(self):
+        self.assertEqual(self.part_scheduler.claim(block=False), 1)
+        self.assertEqual(self.part_scheduler.hedged_parts, {1})
+
+        # a part is not downloaded by more than two connections.
+        self.assertEqual(self.part_scheduler.claim(block=False), 0)
+        self.assertIsNone(self.part_scheduler.claim(block=False))
+
+    # A part without rate is stalled and finishes last.
+    def testStalledPartIsHedged(self):
+        self.rate_dict[0] = 0
+        self.assertEqual(self.part_scheduler.claim(block=False), 0)
+
+    # parts with a few remaining bytes are not hedged.
+    def testMinHedgeSize(self):
+        self.part_scheduler.updatePart(1, 1024**2, 1024**2 - 1024)
+        self.assertEqual(self.part_scheduler.claim(block=False), 0)
+        self.assertIsNone(self.part_scheduler.claim(block=False))
+
+    # parts are hedged only in end game.
+    def testWithoutEndGame(self):
+        self.part_scheduler.end_game = False
+        self.assertIsNone(self.part_scheduler.claim(block=False))
+
+    # If one connection of a hedged part fails, the other connection continues downloading it.
+    def testReleaseHedgedPart(self):
+        self.part_scheduler.claim(block=False)
+        self.part_scheduler.release(1)
+        self.assertEqual(self.part_scheduler.hedged_parts, set())
+        self.assertIn(1, self.part_scheduler.downloading_parts)
+
+        # the first connection that completes the part wins.
+        self.part_scheduler.claim(block=False)
+        self.part_scheduler.updatePart(1, 1024**2, 1024**2)
+        self.assertTrue(self.part_scheduler.complete(1))
+        self.assertFalse(self.part_scheduler.complete(1))
+        self.assertEqual(self.part_scheduler.hedged_parts, set())
+
+
+class SlowConnectionTestCase(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server.shutdown()
+        self.server.server_close()
+
+        SlowFirstRequestHandler.number_of_requests = 0
+        SlowFirstRequestHandler.slow_range = None
+        self.server = BenchmarkServer(('127.0.0.1', 0), SlowFirstRequestHandler)
+        self.port = self.server.server_address[1]
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    # this method downloads file and returns download time.
+    def download(self, download_item, file_size):
+        begin_time = time.monotonic()
+        download_thread = threading.Thread(target=download_item.start)
+        download_thread.start()
+        download_thread.join(60)
+        download_time = time.monotonic() - begin_time
+        self.assertDownloaded(download_item, file_size)
+        return download_time
+
+
+class EndGameTest(SlowConnectionTestCase):
+    # the slow part is downloaded by a second connection.
+    # Without end game, the last MiB of the slow part is downloaded at 32 KiB/s.
+    def testEndGame(self):
+        file_size = 4 * 1024**2
+        hedged_parts = []
+        original_hedge_part = PartScheduler.hedgePart
+
+        def hedgePart(part_scheduler):
+            part_number = original_hedge_part(part_scheduler)
+            if part_number is not None:
+                hedged_parts.append(part_number)
+            return part_number
+
+        download_item = Download(self.linkDictionary(file_size), 4, 100, end_game=True)
+        with mock.patch.object(PartScheduler, 'hedgePart', hedgePart):
+            download_time = self.download(download_item, file_size)
+
+        # other parts may be hedged at the end too.
+        slow_part_start = int(SlowFirstRequestHandler.slow_range.split('=')[1].split('-')[0])
+        self.assertIn(download_item.part_table.start.index(slow_part_start), hedged_parts)
+        self.assertLess(download_time, 10)
+
+
+class LowestSpeedTest(SlowConnectionTestCase):
+    # the slow connection is dropped and its part is downloaded by a new connection.
+    # Without lowest_speed_limit, the file is downloaded at 32 KiB/s.
+    def testSlowConnectionIsDropped(self):
+        file_size = 4 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 1, 100,
+                                 lowest_speed_limit=256 * 1024, lowest_speed_time=1)
+        download_time = self.download(download_item, file_size)
+
+        # one request for every part and one request for the rest of the slow part.
+        self.assertEqual(SlowFirstRequestHandler.number_of_requests, download_item.number_of_parts + 1)
+        self.assertLess(download_time, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+
+class ConnectionPoolTest(DownloadTestCase):
+    # every thread keeps its connection alive and reuses it for its next parts.
+    def testConnectionsAreReused(self):
+        file_size = 32 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 4, 100, part_size=1)
+        download_item.start()
+        self.assertDownloaded(download_item, file_size)
+
+        self.assertEqual(download_item.http_adapter._pool_maxsize, download_item.number_of_threads)
+
+        status = download_item.tellStatus()
+        new_connections = int(status['new_connections'])
+        reused_connections = int(status['reused_connections'])
+
+        # 32 parts and the request for file information are downloaded by 4 threads.
+        self.assertGreaterEqual(new_connections + reused_connections, 33)
+        self.assertLessEqual(new_connections, download_item.number_of_threads + 1)
+        self.assertGreater(reused_connections, new_connections)
+
+    # Range header is sent with every request. Headers of shared session are not changed.
+    def testSessionHeadersAreNotChanged(self):
+        file_size = 8 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 4, 100, part_size=1)
+        download_item.start()
+        self.assertDownloaded(download_item, file_size)
+
+        self.assertNotIn('Range', download_item.requests_session.headers)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from benchmark.import_time import default_modules, deferred_modules, parent_dir
+
+
+# Importing persepolis_lib must be fast. requests and urllib3 are imported when download starts
+# and no file, e.g. log file, is created at import time. see benchmark/import_time.py
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.home_dir = tempfile.mkdtemp(prefix='persepolis_import_')
+
+    def tearDown(self):
+        shutil.rmtree(self.home_dir, ignore_errors=True)
+
+    # this method imports module in a new python process and returns deferred modules that are imported.
+    def importedDeferredModules(self, module):
+        environment = dict(os.environ)
+        environment['HOME'] = self.home_dir
+        environment['USERPROFILE'] = self.home_dir
+        environment['PYTHONPATH'] = parent_dir + os.pathsep + environment.get('PYTHONPATH', '')
+
+        code = ('import sys\n'
+                'import ' + module + '\n'
+                'print(",".join(name for name in %r if name in sys.modules))' % deferred_modules)
+        process = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True, env=environment)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        return [name for name in process.stdout.strip().split(',') if name]
+
+    def testLazyImports(self):
+        for module in default_modules:
+            with self.subTest(module=module):
+                self.assertEqual(self.importedDeferredModules(module), [])
+                self.assertEqual(os.listdir(self.home_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import threading
+import unittest
+from unittest import mock
+from benchmark.server import BenchmarkRequestHandler, BenchmarkServer, fileContent, verifyFile
+from persepolis_lib.async_download import AsyncDownload
+from persepolis_lib.download_manager import DownloadManager
+from persepolis_lib.integrity import PieceVerifier
+from persepolis_lib.metalink import readMetalink
+from persepolis_lib.part_scheduler import PartScheduler
+from persepolis_lib.part_table import PartTable, PartStatus
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+PIECE_LENGTH = 256 * 1024
+
+
+# this function returns sha-256 digests of pieces of a file of file_size bytes on the benchmark server.
+def pieceHashes(file_size, piece_length=PIECE_LENGTH):
+    return [hashlib.sha256(fileContent(start, min(piece_length, file_size - start))).hexdigest()
+            for start in range(0, file_size, piece_length)]
+
+
+# CorruptingRequestHandler changes the byte at corrupt_offset in the first corrupt_times responses.
+# So data is corrupted on the network, but the server file is not changed.
+# Range headers of GET requests are saved in range_list.
+class CorruptingRequestHandler(BenchmarkRequestHandler):
+    lock = threading.Lock()
+    corrupt_offset = None
+    corrupt_times = 0
+    range_list = []
+
+    def do_GET(self):
+        with self.lock:
+            CorruptingRequestHandler.range_list.append(self.headers.get('Range'))
+        self.sendFile(send_body=True)
+
+    def fileData(self, offset, length):
+        data = super().fileData(offset, length)
+        if offset <= self.corrupt_offset < offset + length:
+            with self.lock:
+                if CorruptingRequestHandler.corrupt_times > 0:
+                    CorruptingRequestHandler.corrupt_times -= 1
+                    data = bytearray(data)
+                    data[self.corrupt_offset - offset] ^= 0xff
+                    data = bytes(data)
+        return data
+
+
+class PieceVerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.file_size = 4 * PIECE_LENGTH + 1000
+        self.piece_verifier = PieceVerifier('sha256', PIECE_LENGTH, pieceHashes(self.file_size))
+
+    # only the pieces that are inside complete ranges are checked.
+    def testUncheckedPieces(self):
+        self.assertEqual(self.piece_verifier.uncheckedPieces([(0, 100)], self.file_size), [])
+        self.assertEqual(self.piece_verifier.uncheckedPieces([(100, 3 * PIECE_LENGTH)], self.file_size), [1, 2])
+        self.assertEqual(self.piece_verifier.uncheckedPieces([(0, PIECE_LENGTH), (3 * PIECE_LENGTH, self.file_size)],
+                                                             self.file_size), [0, 3, 4])
+
+    # pieces are read from download file. Verified pieces are not checked again.
+    def testCheckPiece(self):
+        content = bytearray(fileContent(0, self.file_size))
+        content[PIECE_LENGTH + 10] ^= 0xff
+
+        def read(offset, size):
+            return bytes(content[offset:offset + size])
+
+        self.assertTrue(self.piece_verifier.checkPiece(0, read, self.file_size))
+        self.assertFalse(self.piece_verifier.checkPiece(1, read, self.file_size))
+        self.assertTrue(self.piece_verifier.checkPiece(4, read, self.file_size))
+        self.assertEqual(self.piece_verifier.failure_dict, {1: 1})
+        self.assertEqual(self.piece_verifier.uncheckedPieces([(0, self.file_size)], self.file_size), [1, 2, 3])
+
+
+class ReopenRangeTest(unittest.TestCase):
+    # complete parts are splitted at the bounds of range and only the range is downloaded again.
+    def testReopenRange(self):
+        part_table = PartTable()
+        part_table.addPart(0, 1000, downloaded=1000, status=PartStatus.COMPLETE)
+        part_table.addPart(1000, 2000, downloaded=1000, status=PartStatus.COMPLETE)
+        part_table.addPart(2000, 3000)
+        part_scheduler = PartScheduler(part_table, retry=0)
+
+        changed_parts = part_scheduler.reopenRange(800, 1200)
+        self.assertEqual(sorted(changed_parts), [0, 1, 3, 4])
+        self.assertEqual(part_scheduler.completeRanges(), [(0, 800), (1200, 2000)])
+        self.assertEqual(part_scheduler.number_of_completed_parts, 2)
+
+        # parts are claimed in order of their numbers. part 2 was pending before.
+        self.assertEqual([part_scheduler.claim(block=False) for i in range(0, 3)], [1, 2, 3])
+        self.assertEqual((part_table.start[1], part_table.end[1], part_table.downloaded[1]), (1000, 1200, 0))
+        self.assertEqual((part_table.start[3], part_table.end[3], part_table.downloaded[3]), (800, 1000, 0))
+        self.assertIsNone(part_scheduler.claim(block=False))
+
+    # parts that are not complete are not changed.
+    def testDownloadingPart(self):
+        part_table = PartTable()
+        part_table.addPart(0, 1000)
+        part_scheduler = PartScheduler(part_table, retry=0)
+        part_scheduler.claim()
+        self.assertEqual(part_scheduler.reopenRange(0, 500), [])
+        self.assertEqual(part_table.status[0], PartStatus.DOWNLOADING)
+
+
+class MetalinkPiecesTest(unittest.TestCase):
+    def setUp(self):
+        self.metalink_path = os.path.join(os.path.dirname(__file__), 'pieces_test.meta4')
+        self.addCleanup(lambda: os.path.exists(self.metalink_path) and os.remove(self.metalink_path))
+
+    # this method writes a metalink file with pieces_xml.
+    def writeMetalink(self, pieces_xml):
+        with open(self.metalink_path, 'w') as metalink_file:
+            metalink_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                                '<metalink xmlns="urn:ietf:params:xml:ns:metalink">\n'
+                                '<file name="file.bin"><size>600000</size>\n'
+                                '<url>http://127.0.0.1/600000/file.bin</url>\n' + pieces_xml +
+                                '</file></metalink>\n')
+
+    # stronger hash is used and unsupported pieces are ignored.
+    def testPieces(self):
+        hash_list = pieceHashes(600000)
+        self.writeMetalink('<pieces length="%d" type="sha-1"><hash>%s</hash></pieces>\n'
+                           % (PIECE_LENGTH, hashlib.sha1(b'').hexdigest()) +
+                           '<pieces length="%d" type="sha-256">' % PIECE_LENGTH +
+                           ''.join('<hash>%s</hash>' % digest for digest in hash_list) + '</pieces>\n'
+                           '<pieces length="1024" type="unknown"><hash>00</hash></pieces>\n')
+        pieces = readMetalink(self.metalink_path)['pieces']
+        self.assertEqual(pieces, {'algorithm': 'sha256', 'length': PIECE_LENGTH, 'hashes': hash_list})
+
+    def testInvalidPieces(self):
+        self.writeMetalink('<pieces length="abc" type="sha-256"><hash>%s</hash></pieces>\n'
+                           '<pieces length="1024" type="sha-1"><hash>not a digest</hash></pieces>\n'
+                           % hashlib.sha256(b'').hexdigest())
+        self.assertIsNone(readMetalink(self.metalink_path)['pieces'])
+
+
+class PieceDownloadTest(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server.shutdown()
+        self.server.server_close()
+
+        CorruptingRequestHandler.range_list = []
+        self.server = BenchmarkServer(('127.0.0.1', 0), CorruptingRequestHandler)
+        self.port = self.server.server_address[1]
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    # this method returns add_link_dictionary with digests of pieces.
+    def linkDictionary(self, file_size, out='file.bin'):
+        add_link_dictionary = super().linkDictionary(file_size, out)
+        add_link_dictionary['pieces'] = {'algorithm': 'sha-256', 'length': PIECE_LENGTH,
+                                         'hashes': pieceHashes(file_size)}
+        return add_link_dictionary
+
+    # this method downloads file and returns download item.
+    def download(self, add_link_dictionary, corrupt_offset, corrupt_times, retry=2, download_class=Download):
+        CorruptingRequestHandler.corrupt_offset = corrupt_offset
+        CorruptingRequestHandler.corrupt_times = corrupt_times
+        download_item = download_class(add_link_dictionary, 4, 100, retry=retry, retry_wait=0)
+        download_thread = threading.Thread(target=download_item.start)
+        download_thread.start()
+        download_thread.join(60)
+        return download_item
+
+    # only the piece that is corrupted on the network is downloaded again.
+    def testCorruptedPiece(self):
+        file_size = 4 * 1024**2
+        piece_number = 6
+        download_item = self.download(self.linkDictionary(file_size), piece_number * PIECE_LENGTH + 100, 1)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertTrue(download_item.hash_verified)
+        self.assertEqual(download_item.downloaded_size, file_size)
+        self.assertEqual(len(CorruptingRequestHandler.range_list), download_item.number_of_parts + 1)
+        self.assertEqual(CorruptingRequestHandler.range_list[-1],
+                         'bytes=%d-%d' % (piece_number * PIECE_LENGTH, (piece_number + 1) * PIECE_LENGTH - 1))
+
+    def testCorruptedPieceAsync(self):
+        file_size = 2 * 1024**2
+        download_item = self.download(self.linkDictionary(file_size), PIECE_LENGTH, 1, download_class=AsyncDownload)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertTrue(download_item.hash_verified)
+        self.assertEqual(len(CorruptingRequestHandler.range_list), download_item.number_of_parts + 1)
+
+    def testCorruptedPieceInManager(self):
+        file_size = 2 * 1024**2
+        CorruptingRequestHandler.corrupt_offset = file_size // 2
+        CorruptingRequestHandler.corrupt_times = 1
+        manager = DownloadManager(max_active_downloads=1, max_connections=4, number_of_threads=4)
+        manager.add(self.linkDictionary(file_size))
+        self.assertTrue(manager.join(timeout=60))
+        status = manager.tellAll()[0]
+        manager.close()
+
+        self.assertEqual(status['status'], 'complete')
+        self.assertTrue(status['hash_verified'])
+        self.assertTrue(verifyFile(os.path.join(self.download_path, 'file.bin'), file_size))
+
+    # pieces and expected_hash are both checked.
+    def testCorruptedPieceWithExpectedHash(self):
+        file_size = 2 * 1024**2
+        add_link_dictionary = self.linkDictionary(file_size)
+        add_link_dictionary['expected_hash'] = 'sha-256=' + hashlib.sha256(fileContent(0, file_size)).hexdigest()
+        download_item = self.download(add_link_dictionary, file_size - 1, 1)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertTrue(download_item.hash_verified)
+
+    # download fails if piece doesn't match after retry attempts.
+    def testRetryLimit(self):
+        file_size = 2 * 1024**2
+        download_item = self.download(self.linkDictionary(file_size), 100, 10, retry=1)
+
+        self.assertEqual(download_item.download_status, 'error')
+        self.assertFalse(download_item.hash_verified)
+        self.assertEqual(CorruptingRequestHandler.range_list.count('bytes=0-%d' % (PIECE_LENGTH - 1)), 1)
+
+    # download file is hashed by verify thread. Writing control file doesn't read download file.
+    def testCheckpointDoesntReadFile(self):
+        file_size = 8 * 1024**2
+        add_link_dictionary = self.linkDictionary(file_size)
+        add_link_dictionary['expected_hash'] = 'sha-256=' + hashlib.sha256(fileContent(0, file_size)).hexdigest()
+        checkpoint = threading.local()
+        hash_list = []
+        write_control_file = Download.writeControlFile
+        hash_downloaded_data = Download.hashDownloadedData
+
+        def writeControlFile(download_item):
+            checkpoint.running = True
+            try:
+                write_control_file(download_item)
+            finally:
+                checkpoint.running = False
+
+        def hashDownloadedData(download_item, limit=None):
+            hash_list.append(getattr(checkpoint, 'running', False))
+            hash_downloaded_data(download_item, limit)
+
+        with mock.patch.object(Download, 'writeControlFile', writeControlFile), \
+                mock.patch.object(Download, 'hashDownloadedData', hashDownloadedData):
+            download_item = self.download(add_link_dictionary, -1, 0)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertTrue(download_item.hash_verified)
+        self.assertTrue(hash_list)
+        self.assertNotIn(True, hash_list)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import threading
+import unittest
+from unittest import mock
+from benchmark.server import BenchmarkRequestHandler, BenchmarkServer, fileContent
+from persepolis_lib.metalink import readMetalink
+from persepolis_lib.mirror_list import MirrorList
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+
+# CountingRequestHandler counts GET requests of every server.
+class CountingRequestHandler(BenchmarkRequestHandler):
+    lock = threading.Lock()
+    request_dict = {}
+
+    def do_GET(self):
+        port = self.server.server_address[1]
+        with self.lock:
+            CountingRequestHandler.request_dict[port] = CountingRequestHandler.request_dict.get(port, 0) + 1
+        self.sendFile(send_body=True)
+
+
+# SlowRequestHandler sends every response at 2 MiB/s.
+class SlowRequestHandler(CountingRequestHandler):
+    bandwidth = 2 * 1024**2
+
+
+# FailingRequestHandler answers HEAD requests, but GET requests fail.
+class FailingRequestHandler(CountingRequestHandler):
+    def sendFile(self, send_body):
+        if not send_body:
+            return super().sendFile(send_body)
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+# OtherFileRequestHandler serves a file with a different ETag.
+class OtherFileRequestHandler(CountingRequestHandler):
+    def send_header(self, keyword, value):
+        if keyword == 'ETag':
+            value = '"other-file"'
+        super().send_header(keyword, value)
+
+
+class MirrorListTest(unittest.TestCase):
+    def setUp(self):
+        self.mirror_list = MirrorList(['http://a', 'http://b', 'http://c'])
+
+    # mirrors without connections are chosen first, so rate of every mirror is measured.
+    def testNewMirrorsFirst(self):
+        mirrors = [self.mirror_list.choose() for i in range(0, 3)]
+        self.assertEqual([mirror.link for mirror in mirrors], ['http://a', 'http://b', 'http://c'])
+
+    # the mirror with the highest rate per connection is chosen.
+    def testRatePerConnection(self):
+        mirrors = [self.mirror_list.choose() for i in range(0, 3)]
+        rate_dict = {'http://a': 300, 'http://b': 1000, 'http://c': 200}
+        for mirror in mirrors:
+            mirror.rate_estimator = mock.Mock()
+            mirror.rate_estimator.getRate.return_value = rate_dict[mirror.link]
+
+        self.assertEqual(self.mirror_list.choose().link, 'http://b')
+        # b has 2 connections now. 1000 / 2 > 300
+        self.assertEqual(self.mirror_list.choose().link, 'http://b')
+        # 1000 / 3 > 300
+        self.assertEqual(self.mirror_list.choose().link, 'http://b')
+        # 1000 / 4 < 300
+        self.assertEqual(self.mirror_list.choose().link, 'http://a')
+
+        self.mirror_list.leave(mirrors[1])
+        self.assertEqual(mirrors[1].connections, 3)
+
+    # mirror is dropped after max_failures failures in a row, but the last mirror is always used.
+    def testFailures(self):
+        mirror_a, mirror_b, mirror_c = self.mirror_list.mirror_list
+        for i in range(0, 2):
+            self.mirror_list.addFailure(mirror_a)
+        self.mirror_list.addSuccess(mirror_a)
+        self.mirror_list.addFailure(mirror_a)
+        self.assertFalse(mirror_a.disabled)
+
+        for mirror in [mirror_a, mirror_b, mirror_c]:
+            for i in range(0, 3):
+                self.mirror_list.addFailure(mirror)
+
+        self.assertEqual([mirror.disabled for mirror in self.mirror_list.mirror_list], [True, True, False])
+        self.assertEqual(list(self.mirror_list.rates().keys()), ['http://c'])
+        self.assertEqual(self.mirror_list.choose().link, 'http://c')
+
+    # mirror of a link is returned for the response of GET probe.
+    def testChooseLink(self):
+        self.assertEqual(self.mirror_list.choose('http://c').link, 'http://c')
+
+
+class MetalinkTest(unittest.TestCase):
+    def setUp(self):
+        self.metalink_path = os.path.join(os.path.dirname(__file__), 'mirrors_test.meta4')
+        self.addCleanup(lambda: os.path.exists(self.metalink_path) and os.remove(self.metalink_path))
+
+    # this method writes a metalink file that contains files_xml.
+    def writeMetalink(self, files_xml, namespace='urn:ietf:params:xml:ns:metalink'):
+        with open(self.metalink_path, 'w') as metalink_file:
+            metalink_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                                '<metalink xmlns="%s">\n%s</metalink>\n' % (namespace, files_xml))
+
+    # links are sorted by priority and stronger hash is used.
+    def testReadMetalink(self):
+        sha256 = hashlib.sha256(b'').hexdigest()
+        self.writeMetalink('<file name="../dir/file.iso"><size>1000</size>\n'
+                           '<hash type="md5">%s</hash>\n'
+                           '<hash type="sha-256">%s</hash>\n'
+                           '<url>http://no-priority/file.iso</url>\n'
+                           '<url priority="2">http://second/file.iso</url>\n'
+                           '<url priority="1">http://first/file.iso</url>\n'
+                           '</file>\n' % (hashlib.md5(b'').hexdigest(), sha256))
+        metalink_dict = readMetalink(self.metalink_path)
+        self.assertEqual(metalink_dict['file_name'], 'file.iso')
+        self.assertEqual(metalink_dict['file_size'], 1000)
+        self.assertEqual(metalink_dict['links'], ['http://first/file.iso', 'http://second/file.iso',
+                                                  'http://no-priority/file.iso'])
+        self.assertEqual(metalink_dict['expected_hash'], 'sha-256=' + sha256)
+        self.assertIsNone(metalink_dict['pieces'])
+
+    # size and hash are optional.
+    def testWithoutSizeAndHash(self):
+        self.writeMetalink('<file name="file.iso"><url>http://first/file.iso</url></file>\n')
+        metalink_dict = readMetalink(self.metalink_path)
+        self.assertIsNone(metalink_dict['file_size'])
+        self.assertIsNone(metalink_dict['expected_hash'])
+
+    def testInvalidMetalink(self):
+        for files_xml, namespace in [('<file name="file.iso"></file>', 'urn:ietf:params:xml:ns:metalink'),
+                                     ('', 'urn:ietf:params:xml:ns:metalink'),
+                                     ('<file name="file.iso"><url>http://a/file.iso</url></file>',
+                                      'http://www.metalinker.org/'),
+                                     ('<file', 'urn:ietf:params:xml:ns:metalink')]:
+            with self.subTest(files_xml=files_xml, namespace=namespace):
+                self.writeMetalink(files_xml, namespace)
+                self.assertRaises(ValueError, readMetalink, self.metalink_path)
+
+
+class MirrorDownloadTest(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        CountingRequestHandler.request_dict = {}
+        self.mirror_server_list = []
+
+    def tearDown(self):
+        for server in self.mirror_server_list:
+            server.shutdown()
+            server.server_close()
+        super().tearDown()
+
+    # this method starts a mirror server and returns link of file of file_size bytes on it.
+    def startMirror(self, handler, file_size):
+        server = BenchmarkServer(('127.0.0.1', 0), handler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.mirror_server_list.append(server)
+        return 'http://127.0.0.1:%d/%d/file.bin' % (server.server_address[1], file_size)
+
+    # this method returns GET requests of mirror.
+    def mirrorRequests(self, link):
+        return CountingRequestHandler.request_dict.get(int(link.split(':')[2].split('/')[0]), 0)
+
+    # this method downloads links and returns download item.
+    def download(self, link, file_size, **kwargs):
+        add_link_dictionary = self.linkDictionary(file_size)
+        add_link_dictionary['link'] = link
+        add_link_dictionary.update(kwargs)
+        download_item = Download(add_link_dictionary, 8, 100, retry=3, retry_wait=0)
+        download_thread = threading.Thread(target=download_item.start)
+        download_thread.start()
+        download_thread.join(60)
+        return download_item
+
+    # download starts from the first link that responds and parts are downloaded from all mirrors.
+    def testMirrors(self):
+        file_size = 16 * 1024**2
+        mirror_link_list = [self.startMirror(CountingRequestHandler, file_size) for i in range(0, 2)]
+        dead_link = 'http://127.0.0.1:1/%d/file.bin' % file_size
+        download_item = self.download([dead_link] + mirror_link_list, file_size)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(len(download_item.mirror_list), 2)
+        for link in mirror_link_list:
+            self.assertGreater(self.mirrorRequests(link), 0)
+
+    # parts that fail on a mirror are downloaded from the other mirror and the failing mirror is dropped.
+    def testFailover(self):
+        file_size = 16 * 1024**2
+        main_link = self.startMirror(SlowRequestHandler, file_size)
+        failing_link = self.startMirror(FailingRequestHandler, file_size)
+        download_item = self.download([main_link, failing_link], file_size)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(list(download_item.mirror_list.rates().keys()), [main_link])
+        self.assertEqual(self.mirrorRequests(failing_link), download_item.mirror_list.max_failures)
+
+    # mirror of another file is not used.
+    def testDifferentFile(self):
+        file_size = 4 * 1024**2
+        main_link = self.startMirror(CountingRequestHandler, file_size)
+        other_link = self.startMirror(OtherFileRequestHandler, file_size)
+        other_size_link = self.startMirror(CountingRequestHandler, file_size + 1)
+        download_item = self.download([main_link, other_link, other_size_link], file_size)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(len(download_item.mirror_list), 1)
+        self.assertEqual(self.mirrorRequests(other_link) + self.mirrorRequests(other_size_link), 0)
+
+    # links, size and hash are read from metalink.
+    def testMetalink(self):
+        file_size = 4 * 1024**2
+        metalink_path = os.path.join(self.download_path, 'file.meta4')
+        with open(metalink_path, 'w') as metalink_file:
+            metalink_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                                '<metalink xmlns="urn:ietf:params:xml:ns:metalink">\n'
+                                '<file name="metalink.bin"><size>%d</size>\n'
+                                '<hash type="sha-256">%s</hash>\n'
+                                '<url priority="2">%s</url>\n'
+                                '<url priority="1">http://127.0.0.1:1/%d/file.bin</url>\n'
+                                '</file></metalink>\n'
+                                % (file_size, hashlib.sha256(fileContent(0, file_size)).hexdigest(),
+                                   self.startMirror(CountingRequestHandler, file_size), file_size))
+
+        download_item = self.download(None, file_size, metalink=metalink_path, out=None)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertTrue(download_item.hash_verified)
+        self.assertEqual(os.path.basename(download_item.file_path), 'metalink.bin')
+
+    # download fails if size of file is different from size in metalink.
+    def testMetalinkSize(self):
+        file_size = 1024**2
+        metalink_path = os.path.join(self.download_path, 'file.meta4')
+        with open(metalink_path, 'w') as metalink_file:
+            metalink_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                                '<metalink xmlns="urn:ietf:params:xml:ns:metalink">\n'
+                                '<file name="metalink.bin"><size>%d</size><url>%s</url></file></metalink>\n'
+                                % (file_size + 1, self.startMirror(CountingRequestHandler, file_size)))
+
+        download_item = self.download(None, file_size, metalink=metalink_path, out=None)
+        self.assertEqual(download_item.download_status, 'error')
+
+
+if __name__ == '__main__':
+    unittest.main()
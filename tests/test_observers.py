@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+from unittest import mock
+from persepolis_lib.async_download import AsyncDownload
+from persepolis_lib.download_observer import DownloadObserver, ObserverList
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+
+# RecordingObserver saves all events of download.
+class RecordingObserver(DownloadObserver):
+    def __init__(self):
+        self.state_list = []
+        self.part_list = []
+        self.progress_list = []
+        self.error_list = []
+
+    def on_part_complete(self, part_number):
+        self.part_list.append(part_number)
+
+    def on_progress(self, downloaded_size):
+        self.progress_list.append(downloaded_size)
+
+    def on_state_change(self, status):
+        self.state_list.append(status)
+
+    def on_error(self, error_message):
+        self.error_list.append(error_message)
+
+
+# CountingCondition counts the times that waiting threads wake up.
+class CountingCondition(threading.Condition):
+    wake_ups = 0
+
+    def wait(self, timeout=None):
+        result = super().wait(timeout)
+        CountingCondition.wake_ups += 1
+        return result
+
+
+class ObserverTest(DownloadTestCase):
+    def testEvents(self):
+        file_size = 8 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 4, 100)
+        observer = RecordingObserver()
+        download_item.addObserver(observer, progress_interval=0)
+        download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(observer.state_list, ['creating download file', 'downloading', 'complete'])
+        self.assertEqual(sorted(observer.part_list), list(range(0, len(download_item.part_table))))
+        self.assertEqual(observer.progress_list[-1], file_size)
+        self.assertEqual(observer.progress_list, sorted(observer.progress_list))
+        self.assertEqual(observer.error_list, [])
+
+    def testErrorEvents(self):
+        link_dictionary = self.linkDictionary(1024)
+        link_dictionary['link'] = 'http://127.0.0.1:%d/not_found' % self.port
+        download_item = Download(link_dictionary, 4, 100, retry=0)
+        observer = RecordingObserver()
+        download_item.addObserver(observer)
+        download_item.start()
+
+        self.assertEqual(observer.state_list[-1], 'error')
+        self.assertNotEqual(observer.error_list, [])
+
+    # download is finished the moment the last part is finished.
+    def testSmallFileFinishesImmediately(self):
+        download_item = Download(self.linkDictionary(1024), 4, 100)
+        begin_time = time.monotonic()
+        download_item.start()
+
+        self.assertDownloaded(download_item, 1024)
+        self.assertLess(time.monotonic() - begin_time, 0.5)
+        self.assertTrue(download_item.finished_event.is_set())
+
+    # on_progress calls are coalesced by progress_interval.
+    def testProgressInterval(self):
+        observer_list = ObserverList()
+        observer = RecordingObserver()
+        observer_list.add(observer, progress_interval=60)
+        for downloaded_size in range(1, 100):
+            observer_list.notifyProgress(downloaded_size)
+        observer_list.notifyProgress(100, force=True)
+        self.assertEqual(observer.progress_list, [1, 100])
+
+
+class PauseTest(DownloadTestCase):
+    bandwidth = 512 * 1024
+
+    # this method pauses download for 1 second and checks that nothing is downloaded during pause.
+    # Paused connections wait on resume_event and don't wake up until download is unpaused.
+    def pauseAndResume(self, download_item, file_size):
+        observer = RecordingObserver()
+        download_item.addObserver(observer)
+        download_thread = threading.Thread(target=download_item.start)
+        download_thread.start()
+
+        time.sleep(0.7)
+        with mock.patch.object(download_item.resume_event, 'wait',
+                               side_effect=download_item.resume_event.wait) as resume_wait:
+            download_item.downloadPause()
+
+            # chunks that are received before pausing are written.
+            time.sleep(0.3)
+            paused_size = download_item.downloaded_size
+            time.sleep(1)
+            self.assertEqual(download_item.downloaded_size, paused_size)
+            download_item.downloadUnpause()
+
+        download_thread.join(30)
+        self.assertDownloaded(download_item, file_size)
+        self.assertLess(paused_size, file_size)
+        self.assertEqual(observer.state_list[-3:], ['paused', 'downloading', 'complete'])
+        return resume_wait.call_count
+
+    def testPauseWithoutPolling(self):
+        file_size = 4 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 4, 100)
+        self.assertLessEqual(self.pauseAndResume(download_item, file_size), 2 * download_item.number_of_threads)
+
+    def testAsyncPause(self):
+        file_size = 4 * 1024**2
+        download_item = AsyncDownload(self.linkDictionary(file_size), 4, 100)
+        self.pauseAndResume(download_item, file_size)
+
+
+class AdaptiveIdleThreadTest(DownloadTestCase):
+    bandwidth = 2 * 1024**2
+
+    # threads that are more than the number of connections wait until number of connections is changed.
+    def testIdleThreadsDontPoll(self):
+        file_size = 16 * 1024**2
+        with mock.patch('persepolis_lib.persepolis_lib.threading.Condition', CountingCondition):
+            download_item = Download(self.linkDictionary(file_size), 16, 100, adaptive_connections=True)
+
+        download_thread = threading.Thread(target=download_item.start)
+        download_thread.start()
+        time.sleep(1)
+        wake_ups = CountingCondition.wake_ups
+        time.sleep(1.5)
+        idle_wake_ups = CountingCondition.wake_ups - wake_ups
+        download_thread.join(60)
+
+        self.assertDownloaded(download_item, file_size)
+
+        # connection_controller is updated every 2 seconds. Polling threads wake up 5 times a second.
+        self.assertLess(idle_wake_ups, 2 * download_item.number_of_threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import mmap
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from benchmark.server import fileContent
+from persepolis_lib.output_sink import OutputSink, MmapOutputSink, QueuedOutputSink, DirectOutputSink
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+
+class OutputSinkTestCase(unittest.TestCase):
+    file_size = 4 * 1024**2
+    chunk_size = 64 * 1024
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='persepolis_test_')
+        self.file_path = os.path.join(self.directory, 'file.bin')
+        with open(self.file_path, 'wb') as download_file:
+            download_file.truncate(self.file_size)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # this method writes the file in 4 parts by 4 threads through output_sink.
+    # Chunks of parts are written in reverse order, so writes don't depend on a file cursor.
+    def writeParts(self, output_sink):
+        part_size = self.file_size // 4
+
+        def writePart(part_number):
+            part_start = part_number * part_size
+            for offset in reversed(range(part_start, part_start + part_size, self.chunk_size)):
+                output_sink.write(offset, fileContent(offset, self.chunk_size))
+
+        thread_list = [threading.Thread(target=writePart, args=(i,)) for i in range(0, 4)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+
+    def assertFileContent(self):
+        with open(self.file_path, 'rb') as download_file:
+            self.assertEqual(download_file.read(), fileContent(0, self.file_size))
+
+
+class OutputSinkTest(OutputSinkTestCase):
+    # all threads share one file descriptor.
+    def testPwrite(self):
+        output_sink = OutputSink(self.file_path)
+        with mock.patch('os.open', side_effect=os.open) as os_open:
+            output_sink.open()
+            self.writeParts(output_sink)
+            output_sink.sync()
+            self.assertEqual(output_sink.read(self.chunk_size, 10), fileContent(self.chunk_size, 10))
+            output_sink.close()
+
+        self.assertEqual(os_open.call_count, 1)
+        self.assertIsNone(output_sink.fd)
+        self.assertFileContent()
+
+    # os.pwrite is not available on Windows.
+    def testWithoutPwrite(self):
+        output_sink = OutputSink(self.file_path)
+        output_sink.has_pwrite = False
+        output_sink.open()
+        self.writeParts(output_sink)
+        self.assertEqual(output_sink.read(self.chunk_size, 10), fileContent(self.chunk_size, 10))
+        output_sink.close()
+        self.assertFileContent()
+
+    # os.pwrite may write less than the given data.
+    def testShortWrite(self):
+        def shortPwrite(fd, data, offset):
+            return pwrite(fd, data[:1000], offset)
+
+        pwrite = os.pwrite
+        output_sink = OutputSink(self.file_path)
+        output_sink.open()
+        with mock.patch('os.pwrite', side_effect=shortPwrite):
+            output_sink.write(100, fileContent(100, 5000))
+        output_sink.close()
+
+        with open(self.file_path, 'rb') as download_file:
+            download_file.seek(100)
+            self.assertEqual(download_file.read(5000), fileContent(100, 5000))
+
+
+# RecordingMmap saves ranges of flush calls.
+class RecordingMmap(mmap.mmap):
+    flush_list = []
+
+    def flush(self, *args):
+        RecordingMmap.flush_list.append(args)
+        return super().flush(*args)
+
+
+class MmapOutputSinkTest(OutputSinkTestCase):
+    def setUp(self):
+        super().setUp()
+        RecordingMmap.flush_list = []
+
+        # disk space of file is allocated.
+        with open(self.file_path, 'wb') as download_file:
+            download_file.write(bytes(self.file_size))
+
+    def testMmap(self):
+        output_sink = MmapOutputSink(self.file_path, self.file_size)
+        with mock.patch('mmap.mmap', RecordingMmap):
+            output_sink.open()
+        self.assertIsNotNone(output_sink.mapping)
+
+        self.writeParts(output_sink)
+        self.assertEqual(output_sink.read(self.chunk_size, 10), fileContent(self.chunk_size, 10))
+        output_sink.sync()
+        output_sink.close()
+
+        # contiguous dirty blocks are flushed by one msync.
+        self.assertEqual(RecordingMmap.flush_list, [(0, self.file_size)])
+        self.assertIsNone(output_sink.mapping)
+        self.assertFileContent()
+
+    # only blocks that are written after the last sync are flushed.
+    def testDirtyBlocks(self):
+        output_sink = MmapOutputSink(self.file_path, self.file_size)
+        with mock.patch('mmap.mmap', RecordingMmap):
+            output_sink.open()
+
+        block_size = output_sink.block_size
+        output_sink.write(block_size - 10, b'a' * 20)
+        output_sink.write(3 * block_size, b'b' * 10)
+        self.assertEqual(output_sink.dirty_blocks, {0, 1, 3})
+        output_sink.sync()
+        output_sink.sync()
+        output_sink.close()
+
+        self.assertEqual(RecordingMmap.flush_list, [(0, 2 * block_size), (3 * block_size, block_size)])
+
+    # sparse file is not mapped, because writing into its mapping kills process if disk is full.
+    def testSparseFile(self):
+        with open(self.file_path, 'wb') as download_file:
+            download_file.truncate(self.file_size)
+
+        output_sink = MmapOutputSink(self.file_path, self.file_size)
+        output_sink.open()
+        self.assertIsNone(output_sink.mapping)
+        self.writeParts(output_sink)
+        output_sink.sync()
+        output_sink.close()
+        self.assertFileContent()
+
+    # data after the end of mapping is written by pwrite.
+    def testWriteAfterEnd(self):
+        output_sink = MmapOutputSink(self.file_path, self.file_size)
+        output_sink.open()
+        output_sink.write(self.file_size - 5, b'0123456789')
+        output_sink.close()
+
+        with open(self.file_path, 'rb') as download_file:
+            download_file.seek(self.file_size - 5)
+            self.assertEqual(download_file.read(), b'0123456789')
+
+
+class QueuedOutputSinkTest(OutputSinkTestCase):
+    def testQueue(self):
+        output_sink = QueuedOutputSink(self.file_path)
+        output_sink.open()
+        self.writeParts(output_sink)
+        self.assertEqual(output_sink.read(self.chunk_size, 10), fileContent(self.chunk_size, 10))
+        output_sink.close()
+        self.assertFileContent()
+
+    # adjacent chunks are written together by one pwritev call.
+    @unittest.skipUnless(hasattr(os, 'pwritev'), 'os.pwritev is not available.')
+    def testCoalescing(self):
+        output_sink = QueuedOutputSink(self.file_path)
+
+        # chunks are queued before writer thread starts, so they are written in one batch.
+        for offset in reversed(range(0, self.file_size, self.chunk_size)):
+            output_sink.write(offset, fileContent(offset, self.chunk_size))
+
+        with mock.patch('os.pwritev', side_effect=os.pwritev) as pwritev, \
+                mock.patch('os.pwrite', side_effect=os.pwrite) as pwrite:
+            output_sink.open()
+            output_sink.flush()
+
+        output_sink.close()
+        self.assertEqual(pwritev.call_count, 1)
+        self.assertEqual(pwrite.call_count, 0)
+        self.assertFileContent()
+
+    # write() waits if max_queue_size bytes are waiting for writer thread.
+    def testMaxQueueSize(self):
+        write_event = threading.Event()
+        output_sink = QueuedOutputSink(self.file_path, max_queue_size=4 * self.chunk_size)
+        output_sink.open()
+        write_group = output_sink.writeGroup
+
+        def writeGroup(offset, data_list, size):
+            write_event.wait()
+            write_group(offset, data_list, size)
+
+        def writeChunks():
+            for offset in range(0, 8 * self.chunk_size, self.chunk_size):
+                output_sink.write(offset, fileContent(offset, self.chunk_size))
+
+        with mock.patch.object(output_sink, 'writeGroup', side_effect=writeGroup):
+            write_thread = threading.Thread(target=writeChunks)
+            write_thread.start()
+            write_thread.join(0.3)
+            self.assertTrue(write_thread.is_alive())
+            self.assertLessEqual(output_sink.queued_size, 5 * self.chunk_size)
+
+            write_event.set()
+            write_thread.join(10)
+            output_sink.flush()
+
+        self.assertFalse(write_thread.is_alive())
+        output_sink.close()
+        with open(self.file_path, 'rb') as download_file:
+            self.assertEqual(download_file.read(8 * self.chunk_size), fileContent(0, 8 * self.chunk_size))
+
+    # receive buffers are reused, so data is copied before queuing.
+    def testBufferIsCopied(self):
+        output_sink = QueuedOutputSink(self.file_path)
+        buffer = bytearray(fileContent(0, self.chunk_size))
+        output_sink.write(0, memoryview(buffer))
+        buffer[:] = bytes(self.chunk_size)
+        output_sink.open()
+        output_sink.close()
+
+        with open(self.file_path, 'rb') as download_file:
+            self.assertEqual(download_file.read(self.chunk_size), fileContent(0, self.chunk_size))
+
+    # write error is sent to error_function and sync raises it.
+    def testWriteError(self):
+        error_list = []
+        output_sink = QueuedOutputSink(self.file_path, error_function=error_list.append)
+        output_sink.open()
+        with mock.patch('os.pwrite', side_effect=OSError(28, 'No space left on device')):
+            output_sink.write(0, b'data')
+            self.assertRaises(OSError, output_sink.sync)
+
+        self.assertEqual(len(error_list), 1)
+        self.assertRaises(OSError, output_sink.write, 10, b'data')
+        output_sink.close()
+
+
+@unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'os.posix_fadvise is not available.')
+class CachePolicyTest(OutputSinkTestCase):
+    # this method returns (offset, length) of POSIX_FADV_DONTNEED calls.
+    def dontneedCalls(self, posix_fadvise):
+        return [call.args[1:3] for call in posix_fadvise.call_args_list if call.args[3] == os.POSIX_FADV_DONTNEED]
+
+    # written ranges are removed from page cache after sync. Adjacent ranges are merged.
+    def testDontneed(self):
+        output_sink = OutputSink(self.file_path, cache_policy='dontneed')
+        output_sink.open()
+        with mock.patch('os.posix_fadvise') as posix_fadvise:
+            self.writeParts(output_sink)
+            self.assertEqual(posix_fadvise.call_count, 0)
+            output_sink.sync()
+            self.assertEqual(self.dontneedCalls(posix_fadvise), [(0, self.file_size)])
+
+            # ranges are removed once.
+            output_sink.sync()
+            self.assertEqual(posix_fadvise.call_count, 1)
+
+            # data that is read for hashing is removed too.
+            output_sink.read(100, 10)
+            self.assertEqual(self.dontneedCalls(posix_fadvise)[-1], (100, 10))
+
+            # data that is written after the last sync is synced and removed before closing.
+            output_sink.write(1000, fileContent(1000, 4))
+            output_sink.close()
+            self.assertEqual(self.dontneedCalls(posix_fadvise)[-1], (1000, 4))
+
+        self.assertFileContent()
+
+    # page cache is not changed by default.
+    def testDefault(self):
+        output_sink = OutputSink(self.file_path)
+        output_sink.open()
+        with mock.patch('os.posix_fadvise') as posix_fadvise:
+            self.writeParts(output_sink)
+            output_sink.sync()
+            output_sink.read(0, 10)
+            output_sink.close()
+
+        self.assertEqual(posix_fadvise.call_count, 0)
+        self.assertFileContent()
+
+    # queued writer removes ranges that are written by pwritev too.
+    def testQueueDontneed(self):
+        output_sink = QueuedOutputSink(self.file_path, cache_policy='dontneed')
+        output_sink.open()
+        with mock.patch('os.posix_fadvise') as posix_fadvise:
+            self.writeParts(output_sink)
+            output_sink.sync()
+            output_sink.close()
+
+        self.assertEqual(self.dontneedCalls(posix_fadvise), [(0, self.file_size)])
+        self.assertFileContent()
+
+
+class DirectOutputSinkTest(OutputSinkTestCase):
+    # this method returns os.pwrite calls of direct file descriptor.
+    def directWrites(self, output_sink, pwrite):
+        return [call for call in pwrite.call_args_list if call.args[0] == output_sink.direct_fd]
+
+    def testDirect(self):
+        output_sink = DirectOutputSink(self.file_path)
+        output_sink.open()
+        if not output_sink.use_direct:
+            self.skipTest('O_DIRECT is not supported.')
+
+        with mock.patch('os.pwrite', side_effect=os.pwrite) as pwrite:
+            self.writeParts(output_sink)
+            output_sink.sync()
+
+            # aligned blocks are written with O_DIRECT.
+            direct_writes = self.directWrites(output_sink, pwrite)
+            self.assertTrue(direct_writes)
+            for call in direct_writes:
+                self.assertEqual(call.args[2] % output_sink.alignment, 0)
+                self.assertEqual(len(call.args[1]) % output_sink.alignment, 0)
+
+        output_sink.close()
+        self.assertFileContent()
+
+    # bytes before the first aligned offset and at the end of buffer are written normally.
+    def testUnalignedWrites(self):
+        output_sink = DirectOutputSink(self.file_path, buffer_size=64 * 1024)
+        output_sink.open()
+        offset = 1000
+        for size in [10, 5000, 70000, 3, 300000]:
+            output_sink.write(offset, fileContent(offset, size))
+            offset += size
+        self.assertEqual(output_sink.read(1000, offset - 1000), fileContent(1000, offset - 1000))
+        output_sink.close()
+
+        with open(self.file_path, 'rb') as download_file:
+            download_file.seek(1000)
+            self.assertEqual(download_file.read(offset - 1000), fileContent(1000, offset - 1000))
+
+    # file system may accept O_DIRECT in open, but not in write. Then file is written normally.
+    def testDirectWriteError(self):
+        pwrite = os.pwrite
+        output_sink = DirectOutputSink(self.file_path)
+        output_sink.open()
+        if not output_sink.use_direct:
+            self.skipTest('O_DIRECT is not supported.')
+
+        def failingPwrite(fd, data, offset):
+            if fd == output_sink.direct_fd:
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            return pwrite(fd, data, offset)
+
+        with mock.patch('os.pwrite', side_effect=failingPwrite):
+            self.writeParts(output_sink)
+            output_sink.close()
+
+        self.assertFalse(output_sink.use_direct)
+        self.assertFileContent()
+
+
+class DownloadFileTest(DownloadTestCase):
+    # download file is opened once for all parts and threads.
+    def testFileIsOpenedOnce(self):
+        file_size = 32 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 8, 100, part_size=1)
+        file_path = os.path.join(self.download_path, 'file.bin')
+
+        with mock.patch('os.open', side_effect=os.open) as os_open, \
+                mock.patch('builtins.open', side_effect=open) as builtin_open:
+            download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        file_opens = [call for call in os_open.call_args_list if call.args[0] == file_path]
+        self.assertEqual(len(file_opens), 1)
+
+        # download file is not opened again for writing parts.
+        file_reopens = [call for call in builtin_open.call_args_list
+                        if call.args and call.args[0] == file_path and 'r+' in call.args[1:2]]
+        self.assertEqual(file_reopens, [])
+
+    # download file is written through its memory mapping in 'mmap' write mode.
+    def testMmapWriteMode(self):
+        file_size = 16 * 1024**2 + 123
+        download_item = Download(self.linkDictionary(file_size), 8, 100, write_mode='mmap')
+        with mock.patch.object(OutputSink, 'write', side_effect=AssertionError):
+            download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertIsInstance(download_item.output_sink, MmapOutputSink)
+
+    # download is stopped with error, if download file can't be written.
+    def testQueueWriteError(self):
+        file_size = 16 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 4, 100, write_mode='queue')
+        with mock.patch.object(QueuedOutputSink, 'writeBatch', side_effect=OSError(28, 'No space left on device')):
+            download_item.start()
+
+        self.assertEqual(download_item.download_status, 'error')
+
+    def testCachePolicy(self):
+        file_size = 16 * 1024**2 + 123
+        for cache_policy in ['dontneed', 'direct']:
+            with self.subTest(cache_policy=cache_policy):
+                download_item = Download(self.linkDictionary(file_size, out=cache_policy + '.bin'), 4, 100,
+                                         cache_policy=cache_policy)
+                download_item.start()
+                self.assertDownloaded(download_item, file_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
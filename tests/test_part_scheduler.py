@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+from persepolis_lib.part_scheduler import PartScheduler
+from persepolis_lib.part_table import PartTable, PartStatus
+
+
+# this function returns a table of number_of_parts parts of part_size bytes.
+def createPartTable(number_of_parts, part_size):
+    part_table = PartTable()
+    for i in range(0, number_of_parts):
+        part_table.addPart(i * part_size, (i + 1) * part_size)
+    return part_table
+
+
+class PartSchedulerTest(unittest.TestCase):
+    # many threads claim and complete parts at the same time. Every part is given to one thread.
+    def testConcurrentClaim(self):
+        number_of_parts = 2000
+        part_table = createPartTable(number_of_parts, 1024)
+        part_scheduler = PartScheduler(part_table, retry=0)
+        claimed_parts = []
+        start_barrier = threading.Barrier(16)
+
+        def claimParts():
+            thread_parts = []
+            start_barrier.wait()
+            while True:
+                part_number = part_scheduler.claim()
+                if part_number is None:
+                    break
+                thread_parts.append(part_number)
+                part_scheduler.updatePart(part_number, part_table.start[part_number], 1024)
+                part_scheduler.complete(part_number)
+            claimed_parts.extend(thread_parts)
+
+        thread_list = [threading.Thread(target=claimParts) for i in range(0, 16)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join(30)
+
+        self.assertEqual(sorted(claimed_parts), list(range(0, number_of_parts)))
+        self.assertTrue(part_scheduler.isComplete())
+        self.assertTrue(part_scheduler.finished_event.is_set())
+
+    # pending parts are given in order of their numbers.
+    def testClaimOrder(self):
+        part_table = createPartTable(3, 100)
+        part_table.status[1] = PartStatus.COMPLETE
+        part_scheduler = PartScheduler(part_table, retry=0)
+        self.assertEqual(part_scheduler.claim(), 0)
+        self.assertEqual(part_scheduler.claim(), 2)
+        self.assertIsNone(part_scheduler.claim(block=False))
+
+    # the biggest remaining range is splitted at its midpoint.
+    def testSplitPart(self):
+        part_table = createPartTable(2, 1000)
+        part_scheduler = PartScheduler(part_table, retry=0, min_split_size=100)
+        self.assertEqual(part_scheduler.claim(), 0)
+        self.assertEqual(part_scheduler.claim(), 1)
+        part_scheduler.updatePart(0, 0, 600)
+        part_scheduler.updatePart(1, 1000, 200)
+
+        # part 1 has 800 remaining bytes. Its upper half is [1600, 2000).
+        self.assertEqual(part_scheduler.claim(), 2)
+        self.assertEqual(list(part_table.end), [1000, 1600, 2000])
+        self.assertEqual(part_table.start[2], 1600)
+        self.assertEqual(part_table.status[2], PartStatus.DOWNLOADING)
+
+        # the parts cover the file without gap and overlap.
+        ranges = part_scheduler.downloadedRanges()
+        for (start, downloaded_end, end, part_number), next_range in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_range[0])
+
+        # writing after the new end isn't counted for the splitted part.
+        self.assertEqual(part_scheduler.updatePart(1, 1200, 600), 400)
+        self.assertEqual(part_table.downloaded[1], 600)
+
+        # remaining ranges are smaller than 2 * min_split_size now.
+        part_scheduler.updatePart(2, 1600, 300)
+        part_scheduler.updatePart(0, 600, 300)
+        self.assertIsNone(part_scheduler.claim(block=False))
+
+    def testSplitIsDisabled(self):
+        part_scheduler = PartScheduler(createPartTable(1, 10**6), retry=0)
+        self.assertEqual(part_scheduler.claim(), 0)
+        self.assertIsNone(part_scheduler.claim(block=False))
+
+    # a waiting thread gets the part that is released by another thread.
+    def testReleaseWakesWaitingThread(self):
+        part_table = createPartTable(1, 100)
+        part_scheduler = PartScheduler(part_table, retry=1)
+        self.assertEqual(part_scheduler.claim(), 0)
+
+        claimed_parts = []
+        waiting_thread = threading.Thread(target=lambda: claimed_parts.append(part_scheduler.claim()))
+        waiting_thread.start()
+        waiting_thread.join(0.2)
+        self.assertTrue(waiting_thread.is_alive())
+
+        part_scheduler.release(0, PartStatus.ERROR)
+        waiting_thread.join(5)
+        self.assertEqual(claimed_parts, [0])
+        self.assertEqual(part_table.retry[0], 1)
+
+    # stopped parts are not given again and the waiting threads return None.
+    def testReleaseStopped(self):
+        part_table = createPartTable(2, 100)
+        part_scheduler = PartScheduler(part_table, retry=5)
+        self.assertEqual(part_scheduler.claim(), 0)
+        self.assertEqual(part_scheduler.claim(), 1)
+        part_scheduler.release(0, PartStatus.STOPPED)
+        self.assertFalse(part_scheduler.finished_event.is_set())
+        part_scheduler.release(1, PartStatus.STOPPED)
+        self.assertTrue(part_scheduler.finished_event.is_set())
+        self.assertIsNone(part_scheduler.claim())
+        self.assertFalse(part_scheduler.isComplete())
+
+    # finished_event is set when the last part is complete and cleared by reopen.
+    def testFinishedEventAndReopen(self):
+        part_table = createPartTable(2, 100)
+        part_scheduler = PartScheduler(part_table, retry=0)
+        for part_number in (part_scheduler.claim(), part_scheduler.claim()):
+            self.assertFalse(part_scheduler.finished_event.is_set())
+            part_scheduler.updatePart(part_number, part_table.start[part_number], 100)
+            part_scheduler.complete(part_number)
+        self.assertTrue(part_scheduler.finished_event.is_set())
+        self.assertTrue(part_scheduler.isComplete())
+
+        part_scheduler.reopen([1])
+        self.assertFalse(part_scheduler.finished_event.is_set())
+        self.assertFalse(part_scheduler.isComplete())
+        self.assertEqual(part_table.downloaded[1], 0)
+        self.assertEqual(part_scheduler.claim(), 1)
+        self.assertEqual(part_table.retry[1], 0)
+
+    # the scheduler that is created from a complete table is finished.
+    def testCompleteTable(self):
+        part_table = createPartTable(2, 100)
+        part_table.status[0] = part_table.status[1] = PartStatus.COMPLETE
+        part_scheduler = PartScheduler(part_table, retry=0)
+        self.assertTrue(part_scheduler.finished_event.is_set())
+        self.assertIsNone(part_scheduler.claim())
+
+    # stop wakes up the waiting threads.
+    def testStop(self):
+        part_scheduler = PartScheduler(createPartTable(1, 100), retry=0)
+        self.assertEqual(part_scheduler.claim(), 0)
+        claimed_parts = []
+        waiting_thread = threading.Thread(target=lambda: claimed_parts.append(part_scheduler.claim()))
+        waiting_thread.start()
+        part_scheduler.stop()
+        waiting_thread.join(5)
+        self.assertEqual(claimed_parts, [None])
+        self.assertTrue(part_scheduler.finished_event.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+from persepolis_lib.part_scheduler import PartScheduler
+from persepolis_lib.part_table import PartTable, PartStatus
+
+
+class PartTableTest(unittest.TestCase):
+    # every column is saved in control file and is loaded again without change.
+    def testDictRoundTrip(self):
+        part_table = PartTable()
+        part_table.addPart(0, 1000, 1000, PartStatus.COMPLETE, 2)
+        part_table.addPart(1000, 2**40, 12345, PartStatus.DOWNLOADING, 0)
+        part_table.addPart(2**40, -1, 0)
+
+        # control file is a json file.
+        table_dict = json.loads(json.dumps(part_table.toDict()))
+        loaded_table = PartTable.fromDict(table_dict)
+
+        self.assertEqual(len(loaded_table), 3)
+        for column in PartTable.columns:
+            self.assertEqual(list(getattr(loaded_table, column)), list(getattr(part_table, column)))
+        self.assertEqual(loaded_table.partSize(1), 2**40 - 1000)
+        self.assertIsNone(loaded_table.partSize(2))
+
+    def testEmptyTable(self):
+        self.assertEqual(len(PartTable.fromDict(PartTable().toDict())), 0)
+
+    # download_infromation_list of older control files.
+    def testFromList(self):
+        download_infromation_list = [[0, 100, 'complete', 0],
+                                     [100, 50, 'pending', 1],
+                                     [200, 0, 'downloading', 2, 250],
+                                     [250, 10, 'stopped', -1]]
+        part_table = PartTable.fromList(download_infromation_list, 4, 300)
+
+        self.assertEqual(list(part_table.start), [0, 100, 200, 250])
+        # end of the parts without end is start of the next part or file size.
+        self.assertEqual(list(part_table.end), [100, 200, 250, 300])
+        self.assertEqual(list(part_table.downloaded), [100, 50, 0, 10])
+        self.assertEqual(list(part_table.retry), [0, 1, 2, -1])
+        # only complete parts keep their status. Others are downloaded again.
+        self.assertEqual(list(part_table.status), [PartStatus.COMPLETE, PartStatus.PENDING,
+                                                   PartStatus.PENDING, PartStatus.PENDING])
+        self.assertEqual(part_table.remaining(1), 50)
+
+    # file size is unspecified in older control files of single stream downloads.
+    def testFromListWithoutFileSize(self):
+        part_table = PartTable.fromList([[0, 500, 'pending', 0, None]], 1, None)
+        self.assertEqual(part_table.end[0], -1)
+        self.assertIsNone(part_table.partSize(0))
+
+        part_table = PartTable.fromList([[0, 500, 'pending', 0]], 1, None)
+        self.assertEqual(part_table.end[0], -1)
+
+    # status of parts is changed by part_scheduler.
+    def testStatusTransitions(self):
+        part_table = PartTable()
+        for i in range(0, 3):
+            part_table.addPart(i * 100, (i + 1) * 100)
+        part_scheduler = PartScheduler(part_table, retry=1)
+        self.assertEqual(list(part_table.status), [PartStatus.PENDING] * 3)
+
+        self.assertEqual(part_scheduler.claim(), 0)
+        self.assertEqual(part_table.status[0], PartStatus.DOWNLOADING)
+        self.assertEqual(part_table.retry[0], 0)
+
+        # pending -> downloading -> complete
+        part_scheduler.updatePart(0, 0, 100)
+        self.assertTrue(part_scheduler.complete(0))
+        self.assertEqual(part_table.status[0], PartStatus.COMPLETE)
+        self.assertFalse(part_scheduler.complete(0))
+
+        # downloading -> error -> pending
+        self.assertEqual(part_scheduler.claim(), 1)
+        part_scheduler.release(1, PartStatus.ERROR)
+        self.assertEqual(part_table.status[1], PartStatus.PENDING)
+
+        # downloading -> stopped
+        self.assertEqual(part_scheduler.claim(), 1)
+        self.assertEqual(part_table.retry[1], 1)
+        part_scheduler.release(1, PartStatus.STOPPED)
+        self.assertEqual(part_table.status[1], PartStatus.STOPPED)
+
+        # the retry limit is reached, so the failed part is not pending again.
+        self.assertEqual(part_scheduler.claim(), 2)
+        part_table.retry[2] = 2
+        self.assertEqual(part_scheduler.claim(block=False), None)
+        part_scheduler.release(2, PartStatus.ERROR)
+        self.assertEqual(part_table.status[2], PartStatus.ERROR)
+        self.assertTrue(part_scheduler.isFinished())
+        self.assertFalse(part_scheduler.isComplete())
+
+        # complete part is downloaded again
+        part_scheduler.reopen([0])
+        self.assertEqual(part_table.status[0], PartStatus.PENDING)
+        self.assertEqual(part_table.downloaded[0], 0)
+        self.assertEqual(part_scheduler.claim(), 0)
+
+        # changes are saved in order of part numbers.
+        records = part_scheduler.takeDirtyParts()
+        self.assertEqual([record[0] for record in records], [0, 1, 2])
+        self.assertEqual(records[0][5], PartStatus.DOWNLOADING)
+        self.assertEqual(part_scheduler.takeDirtyParts(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+from benchmark.server import BenchmarkRequestHandler, BenchmarkServer
+from persepolis_lib.async_download import AsyncDownload
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+from tests.test_observers import RecordingObserver
+
+
+# NoSizeRequestHandler sends file without Content-Length and Range support.
+# End of response is the end of connection.
+class NoSizeRequestHandler(BenchmarkRequestHandler):
+    def send_header(self, keyword, value):
+        if keyword not in ['Content-Length', 'Accept-Ranges', 'Content-Range']:
+            super().send_header(keyword, value)
+
+    def send_response(self, code, message=None):
+        # Range is not supported. So whole file is sent.
+        if code == 206:
+            code = 200
+        super().send_response(code, message)
+
+    def requestedRange(self, file_size):
+        return 0, file_size
+
+    def sendFile(self, send_body):
+        self.close_connection = True
+        super().sendFile(send_body)
+
+
+class NoSizeTest(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server.shutdown()
+        self.server.server_close()
+
+        self.server = BenchmarkServer(('127.0.0.1', 0), NoSizeRequestHandler)
+        self.port = self.server.server_address[1]
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    # file without size is downloaded by one connection and observers don't receive any error.
+    def testNoSize(self):
+        file_size = 3 * 1024**2 + 123
+        for download_class in [Download, AsyncDownload]:
+            for probe in ['head', 'get']:
+                with self.subTest(download_class=download_class.__name__, probe=probe):
+                    add_link_dictionary = self.linkDictionary(file_size, out='%s_%s.bin' % (download_class.__name__, probe))
+                    download_item = download_class(add_link_dictionary, 4, 100, probe=probe)
+                    observer = RecordingObserver()
+                    download_item.addObserver(observer)
+                    download_item.start()
+
+                    self.assertDownloaded(download_item, file_size)
+                    self.assertEqual(download_item.number_of_threads, 1)
+                    self.assertEqual(download_item.file_size, file_size)
+                    self.assertEqual(observer.error_list, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+import unittest
+from unittest import mock
+from benchmark.server import BenchmarkRequestHandler, BenchmarkServer
+from persepolis_lib.part_scheduler import PartScheduler
+from persepolis_lib.part_table import PartTable
+from persepolis_lib.process_download import ProcessDownload, SlotJob, slot_fields, slot_end, slot_reserved
+from tests.helpers import DownloadTestCase
+
+
+# FlakyRequestHandler sends 503 for the first GET request of every range.
+class FlakyRequestHandler(BenchmarkRequestHandler):
+    lock = threading.Lock()
+    failed_ranges = set()
+
+    def do_GET(self):
+        with self.lock:
+            is_first_request = self.headers.get('Range') not in self.failed_ranges
+            self.failed_ranges.add(self.headers.get('Range'))
+
+        if is_first_request:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.sendFile(send_body=True)
+
+
+# CountingRequestHandler counts GET requests.
+class CountingRequestHandler(BenchmarkRequestHandler):
+    lock = threading.Lock()
+    number_of_requests = 0
+
+    def do_GET(self):
+        with self.lock:
+            CountingRequestHandler.number_of_requests += 1
+        super().do_GET()
+
+
+# ErrorObserver saves errors of download.
+class ErrorObserver():
+    def __init__(self):
+        self.error_list = []
+
+    def on_error(self, error_text):
+        self.error_list.append(error_text)
+
+
+class ProcessDownloadTest(DownloadTestCase):
+    def testDownload(self):
+        file_size = 8 * 1024**2
+        download_item = ProcessDownload(self.linkDictionary(file_size), 8, 100, number_of_processes=2)
+        download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+
+    # retry settings of setRetry are used by sessions of worker processes,
+    # so 503 responses are retried by the session and parts don't fail.
+    def testRetryInWorkerProcess(self):
+        self.server.shutdown()
+        self.server.server_close()
+        handler = type('FlakyRequestHandler', (FlakyRequestHandler,), {'failed_ranges': set()})
+        self.server = BenchmarkServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+
+        file_size = 8 * 1024**2
+        download_item = ProcessDownload(self.linkDictionary(file_size), 8, 100, retry=3, retry_wait=0,
+                                        number_of_processes=2)
+        observer = ErrorObserver()
+        download_item.addObserver(observer)
+        download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(observer.error_list, [])
+        self.assertGreater(len(handler.failed_ranges), 1)
+
+    # one monitor thread waits for results of all connections. Download threads don't poll their pipes.
+    def testMonitorThread(self):
+        wait = multiprocessing.connection.wait
+        thread_set = set()
+
+        # Process.join waits for sentinels of processes by wait too.
+        def recordingWait(object_list, timeout=None):
+            if any(isinstance(item, multiprocessing.connection.Connection) for item in object_list):
+                thread_set.add(threading.get_ident())
+            return wait(object_list, timeout)
+
+        file_size = 8 * 1024**2
+        download_item = ProcessDownload(self.linkDictionary(file_size), 8, 100, number_of_processes=2)
+        with mock.patch('multiprocessing.connection.wait', side_effect=recordingWait), \
+                mock.patch('multiprocessing.connection.Connection.poll') as poll:
+            download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(len(thread_set), 1)
+        self.assertEqual(poll.call_count, 0)
+        self.assertIsNone(download_item.monitor_thread)
+
+    # response of GET probe is used for part 0, so no request is wasted.
+    def testGetProbe(self):
+        self.server.shutdown()
+        self.server.server_close()
+        CountingRequestHandler.number_of_requests = 0
+        self.server = BenchmarkServer(('127.0.0.1', 0), CountingRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+
+        file_size = 8 * 1024**2
+        download_item = ProcessDownload(self.linkDictionary(file_size), 8, 100, number_of_processes=2, probe='get')
+        download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(CountingRequestHandler.number_of_requests, download_item.number_of_parts)
+
+
+# paused connections of worker processes wait for the events of their slots.
+class PauseTest(DownloadTestCase):
+    bandwidth = 4 * 1024**2
+
+    def testPause(self):
+        file_size = 8 * 1024**2
+        download_item = ProcessDownload(self.linkDictionary(file_size), 4, 100, number_of_processes=2)
+        thread = threading.Thread(target=download_item.start)
+        thread.start()
+
+        while download_item.downloaded_size == 0 and thread.is_alive():
+            time.sleep(0.05)
+        download_item.downloadPause()
+
+        # connections stop after their current reads.
+        time.sleep(1)
+        downloaded_size = download_item.downloaded_size
+        time.sleep(1)
+        self.assertEqual(download_item.downloaded_size, downloaded_size)
+        self.assertLess(downloaded_size, file_size)
+        for thread_number in list(download_item.job_dict):
+            self.assertFalse(download_item.slot_event_list[thread_number].is_set())
+
+        download_item.downloadUnpause()
+        thread.join()
+        self.assertDownloaded(download_item, file_size)
+
+
+# splitEnd moves end of the slots of splitted part. The part is not splitted before the bytes
+# that are reserved by worker process.
+class SplitEndTest(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.download_item = ProcessDownload(self.linkDictionary(4 * 1024**2), 2, 100, number_of_processes=1)
+        self.download_item.slot_array = multiprocessing.RawArray('q', 2 * slot_fields)
+        self.download_item.slot_lock_list = [threading.Lock(), threading.Lock()]
+
+        self.part_table = PartTable()
+        self.part_table.addPart(0, 4 * 1024**2)
+        self.download_item.part_table = self.part_table
+        self.download_item.part_scheduler = PartScheduler(self.part_table, retry=0, min_split_size=1024**2,
+                                                          split_function=self.download_item.splitEnd)
+        self.part_scheduler = self.download_item.part_scheduler
+        self.assertEqual(self.part_scheduler.claim(), 0)
+
+        # part 0 is downloading by thread 1.
+        self.download_item.job_dict[1] = SlotJob(0, 1, None, None)
+        self.slot = 1 * slot_fields
+        self.download_item.slot_array[self.slot + slot_end] = 4 * 1024**2
+
+    def testSplitAtMiddle(self):
+        self.download_item.slot_array[self.slot + slot_reserved] = 1024**2
+        self.assertEqual(self.part_scheduler.claim(), 1)
+        self.assertEqual(list(self.part_table.end), [2 * 1024**2, 4 * 1024**2])
+        self.assertEqual(self.download_item.slot_array[self.slot + slot_end], 2 * 1024**2)
+
+    # progress of part_table is behind the worker process.
+    def testSplitAfterReserved(self):
+        reserved = 2 * 1024**2 + 1000
+        self.download_item.slot_array[self.slot + slot_reserved] = reserved
+        self.assertEqual(self.part_scheduler.claim(), 1)
+        self.assertEqual(self.part_table.end[0], reserved)
+        self.assertEqual(self.part_table.start[1], reserved)
+        self.assertEqual(self.download_item.slot_array[self.slot + slot_end], reserved)
+
+    # the rest of the part is too small for a new part.
+    def testNoSplit(self):
+        self.download_item.slot_array[self.slot + slot_reserved] = 3 * 1024**2 + 1
+        self.assertIsNone(self.part_scheduler.claim(block=False))
+        self.assertEqual(list(self.part_table.end), [4 * 1024**2])
+        self.assertEqual(self.download_item.slot_array[self.slot + slot_end], 4 * 1024**2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+from unittest import mock
+from persepolis_lib.part_scheduler import PartScheduler
+from persepolis_lib.part_table import PartTable
+from persepolis_lib.persepolis_lib import Download
+from persepolis_lib.rate_estimator import RateEstimator
+from tests.helpers import DownloadTestCase
+
+
+# FakeClock replaces time.monotonic, so tests don't wait.
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RateEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        monotonic_patch = mock.patch('time.monotonic', self.clock)
+        monotonic_patch.start()
+        self.addCleanup(monotonic_patch.stop)
+
+    # this method adds rate bytes per second in chunks of 0.05 seconds for duration seconds.
+    def receive(self, rate_estimator, rate, duration):
+        for i in range(0, int(duration / 0.05)):
+            self.clock.sleep(0.05)
+            rate_estimator.add(int(rate * 0.05))
+
+    def testSteadyRate(self):
+        rate_estimator = RateEstimator()
+        self.assertEqual(rate_estimator.getRate(), 0)
+        self.receive(rate_estimator, 1024**2, 3)
+        self.assertAlmostEqual(rate_estimator.getRate(), 1024**2, delta=1024**2 * 0.01)
+
+    # rate follows changes smoothly. It doesn't jump to the new rate by one chunk.
+    def testRateChange(self):
+        rate_estimator = RateEstimator(time_constant=2)
+        self.receive(rate_estimator, 1024**2, 10)
+        self.receive(rate_estimator, 2 * 1024**2, 0.2)
+        self.assertLess(rate_estimator.getRate(), 1.2 * 1024**2)
+
+        # after time_constant seconds, 37% of the old rate remains.
+        self.receive(rate_estimator, 2 * 1024**2, 1.8)
+        self.assertAlmostEqual(rate_estimator.getRate(), (2 - 0.37) * 1024**2, delta=0.05 * 1024**2)
+
+    # rate decays when nothing is received.
+    def testStalledConnection(self):
+        rate_estimator = RateEstimator()
+        self.receive(rate_estimator, 1024**2, 3)
+        self.clock.sleep(10)
+        self.assertLess(rate_estimator.getRate(), 1024**2 * 0.02)
+
+    # time before the first data is not counted.
+    def testFirstData(self):
+        rate_estimator = RateEstimator()
+        self.clock.sleep(60)
+        self.receive(rate_estimator, 1024**2, 1)
+        self.assertAlmostEqual(rate_estimator.getRate(), 1024**2, delta=1024**2 * 0.01)
+
+
+class TimeLeftTest(unittest.TestCase):
+    def setUp(self):
+        self.download_item = Download({'link': 'http://127.0.0.1/file.bin', 'out': 'file.bin', 'download_path': '/tmp',
+                                       'ip': None, 'port': None, 'proxy_user': None, 'proxy_passwd': None,
+                                       'proxy_type': None, 'download_user': None, 'download_passwd': None,
+                                       'header': None, 'user_agent': None, 'load_cookies': None, 'referer': None,
+                                       'check_certificate': True}, 4, 100)
+        part_table = PartTable()
+        part_table.addPart(0, 100 * 1024**2, downloaded=10 * 1024**2)
+        part_table.addPart(100 * 1024**2, 101 * 1024**2)
+        self.download_item.file_size = 101 * 1024**2
+        self.download_item.downloaded_size = 10 * 1024**2
+        self.download_item.part_table = part_table
+        self.download_item.part_scheduler = PartScheduler(part_table, 0, 1024**2)
+
+    # remaining bytes are shared between connections by splitting parts.
+    def testTimeLeft(self):
+        self.assertIsNone(self.download_item.estimateTimeLeft(0))
+        self.assertAlmostEqual(self.download_item.estimateTimeLeft(10 * 1024**2), 9.1)
+
+    # a part that can't be splitted is downloaded at rate of its connection.
+    def testSlowSmallPart(self):
+        part_rate = mock.Mock()
+        part_rate.getRate.return_value = 10 * 1024
+        self.download_item.part_rate_dict[1] = part_rate
+        self.assertAlmostEqual(self.download_item.estimateTimeLeft(10 * 1024**2), 102.4)
+
+
+class ConnectionRateTest(DownloadTestCase):
+    bandwidth = 1024**2
+
+    # rate of every connection is reported by tellStatus.
+    def testConnectionRates(self):
+        file_size = 8 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 4, 100)
+        download_thread = threading.Thread(target=download_item.start)
+        download_thread.start()
+        time.sleep(1.5)
+        status = download_item.tellStatus()
+        download_thread.join(30)
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(len(status['connection_rates']), 4)
+        for rate in status['connection_rates'].values():
+            self.assertAlmostEqual(rate, 1024**2, delta=0.25 * 1024**2)
+        self.assertAlmostEqual(status['download_rate'], 4 * 1024**2, delta=1024**2)
+        self.assertIsNotNone(status['estimate_time_left_seconds'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+from unittest import mock
+from persepolis_lib.persepolis_lib import Download
+from persepolis_lib.async_download import AsyncDownload
+from persepolis_lib.process_download import ProcessDownload
+from tests.helpers import DownloadTestCase
+
+
+# RateObserver saves the time of receiving the first byte and the last byte.
+class RateObserver():
+    def __init__(self):
+        self.first_progress = None
+        self.last_progress = None
+
+    def on_progress(self, downloaded_size):
+        now = time.monotonic()
+        if self.first_progress is None:
+            self.first_progress = (now, downloaded_size)
+
+        # the last progress is sent again when download is finished.
+        if self.last_progress is None or downloaded_size != self.last_progress[1]:
+            self.last_progress = (now, downloaded_size)
+
+    # this method returns download rate between the first byte and the last byte in bytes per second.
+    def rate(self):
+        first_time, first_size = self.first_progress
+        last_time, last_size = self.last_progress
+        return (last_size - first_size) / (last_time - first_time)
+
+
+# Measured rate must be within tolerance of the limit.
+class SpeedLimitTest(DownloadTestCase):
+    tolerance = 0.05
+
+    def assertRate(self, download_class, bytes_per_second, number_of_threads, **kwargs):
+        file_size = 8 * 1024**2
+        download_item = download_class(self.linkDictionary(file_size), number_of_threads, 100, **kwargs)
+        observer = RateObserver()
+        download_item.addObserver(observer, progress_interval=0)
+        download_item.limitSpeed(bytes_per_second=bytes_per_second)
+        download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        error = (observer.rate() - bytes_per_second) / bytes_per_second
+        self.assertLess(abs(error), self.tolerance, 'rate error: %.2f%%' % (error * 100))
+
+    def testThreadEngine(self):
+        self.assertRate(Download, 5 * 1024**2, 8)
+
+    def testThreadEngineOneConnection(self):
+        self.assertRate(Download, 2 * 1024**2, 1)
+
+    def testAsyncEngine(self):
+        self.assertRate(AsyncDownload, 5 * 1024**2, 8)
+
+    def testProcessEngine(self):
+        self.assertRate(ProcessDownload, 5 * 1024**2, 8, number_of_processes=2)
+
+
+
+# Tokens that are reserved for the first read pay for the first received data.
+class FirstReadTest(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.download_item = Download(self.linkDictionary(1024**2), 4, 100)
+
+        # time doesn't pass, so no token is added to the bucket.
+        self.monotonic_patch = mock.patch('time.monotonic', return_value=1000.0)
+        self.monotonic_patch.start()
+
+    def tearDown(self):
+        self.monotonic_patch.stop()
+        super().tearDown()
+
+    # every received byte is charged once. The next read is reserved after receiving a chunk.
+    def testFirstReadIsChargedOnce(self):
+        self.download_item.limitSpeed(bytes_per_second=1024**2)
+        speed_limiter = self.download_item.speed_limiter
+        reserved_size = self.download_item.readChunkSize()
+
+        self.download_item.reserveFirstRead(0)
+        self.assertEqual(speed_limiter.tokens, -reserved_size)
+
+        # the first chunk is paid by the reserved tokens.
+        self.download_item.speedLimitDelay(reserved_size, 0)
+        self.assertEqual(speed_limiter.tokens, -2 * reserved_size)
+
+        self.download_item.speedLimitDelay(1000, 0)
+        self.assertEqual(speed_limiter.tokens, -2 * reserved_size - 1000)
+
+        # tokens of the last reserved read are given back.
+        self.download_item.refundFirstRead(0)
+        self.assertEqual(speed_limiter.tokens, -reserved_size - 1000)
+
+    # the rest of the reserved tokens is given back, if the first chunk is smaller.
+    def testSmallFirstChunk(self):
+        self.download_item.limitSpeed(bytes_per_second=1024**2)
+        self.download_item.reserveFirstRead(0)
+        self.download_item.speedLimitDelay(1000, 0)
+        self.download_item.refundFirstRead(0)
+        self.assertEqual(self.download_item.speed_limiter.tokens, -1000)
+
+    # the reserved tokens are given back if rate is changed before receiving data.
+    def testRefundAfterRateChange(self):
+        self.download_item.limitSpeed(bytes_per_second=1024**2)
+        speed_limiter = self.download_item.speed_limiter
+        self.download_item.reserveFirstRead(0)
+        self.download_item.reserveFirstRead(1)
+
+        self.download_item.limitSpeed(bytes_per_second=4 * 1024**2)
+        self.assertNotEqual(self.download_item.readChunkSize(), self.download_item.reserved_tokens[0])
+        self.download_item.refundFirstRead(0)
+        self.download_item.refundFirstRead(1)
+        self.assertEqual(speed_limiter.tokens, 0)
+        self.assertEqual(self.download_item.reserved_tokens, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+from unittest import mock
+import requests
+from benchmark.server import BenchmarkRequestHandler, BenchmarkServer
+from persepolis_lib.buffer_pool import BufferPool
+from persepolis_lib.persepolis_lib import Download
+from tests.helpers import DownloadTestCase
+
+
+# TruncatingRequestHandler closes connection of the first response after truncate_size bytes.
+class TruncatingRequestHandler(BenchmarkRequestHandler):
+    lock = threading.Lock()
+    truncate_size = 100 * 1024
+    truncated = False
+
+    def fileData(self, offset, length):
+        with self.lock:
+            truncate = not TruncatingRequestHandler.truncated and offset >= self.truncate_size
+            if truncate:
+                TruncatingRequestHandler.truncated = True
+
+        if truncate:
+            self.close_connection = True
+            raise ConnectionError('response is truncated')
+        return super().fileData(offset, length)
+
+
+class BufferPoolTest(unittest.TestCase):
+    # buffers are reused after they are given back.
+    def testReuse(self):
+        buffer_pool = BufferPool(1024, 2)
+        buffer = buffer_pool.take()
+        self.assertEqual(len(buffer), 1024)
+        buffer_pool.give(buffer)
+        self.assertIs(buffer_pool.take(), buffer)
+        self.assertEqual(buffer_pool.number_of_buffers, 1)
+
+    # take() waits until a buffer is given back, if max_buffers buffers are in use.
+    def testMaxBuffers(self):
+        buffer_pool = BufferPool(1024, 2)
+        buffer_list = [buffer_pool.take(), buffer_pool.take()]
+        threading.Timer(0.2, buffer_pool.give, args=(buffer_list[0],)).start()
+
+        begin_time = time.monotonic()
+        self.assertIs(buffer_pool.take(), buffer_list[0])
+        self.assertGreaterEqual(time.monotonic() - begin_time, 0.15)
+        self.assertEqual(buffer_pool.number_of_buffers, 2)
+
+
+class ReadintoTest(DownloadTestCase):
+    # response is read into buffers of buffer_pool. iter_content is not used.
+    def testReadinto(self):
+        file_size = 16 * 1024**2 + 123
+        for write_mode in ['pwrite', 'queue']:
+            with self.subTest(write_mode=write_mode):
+                download_item = Download(self.linkDictionary(file_size, out=write_mode + '.bin'), 4, 100,
+                                         receive_mode='readinto', write_mode=write_mode)
+                # body of HEAD response is read by iter_content.
+                self.assertTrue(download_item.prepareDownload())
+                with mock.patch.object(requests.Response, 'iter_content', side_effect=AssertionError):
+                    download_item.runDownloadThreads()
+                    download_item.checkDownloadProgress()
+                download_item.close()
+
+                self.assertDownloaded(download_item, file_size)
+                self.assertLessEqual(download_item.buffer_pool.number_of_buffers, download_item.number_of_threads)
+
+    # connections return to the pool after every part, so parts reuse connections.
+    def testConnectionReuse(self):
+        file_size = 16 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 2, 100, receive_mode='readinto', part_size=1)
+        download_item.start()
+
+        self.assertDownloaded(download_item, file_size)
+        self.assertLessEqual(download_item.connection_statistics.new_connections, 2 + 1)
+
+
+class TruncatedResponseTest(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server.shutdown()
+        self.server.server_close()
+
+        TruncatingRequestHandler.truncated = False
+        self.server = BenchmarkServer(('127.0.0.1', 0), TruncatingRequestHandler)
+        self.port = self.server.server_address[1]
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    # part of a response that is closed before Content-Length bytes is downloaded again.
+    def testTruncatedResponse(self):
+        file_size = 4 * 1024**2
+        download_item = Download(self.linkDictionary(file_size), 1, 100, receive_mode='readinto', retry_wait=0)
+        download_item.start()
+
+        self.assertTrue(TruncatingRequestHandler.truncated)
+        self.assertDownloaded(download_item, file_size)
+        self.assertEqual(download_item.part_table.retry[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()